@@ -0,0 +1,235 @@
+"""
+Ingestion benchmark of s3_migrator against a local mongod, without the real MP dump.
+
+Generate a synthetic S3 layout (collections/<name>/<sub_path>/<folder>/*.gz and a manifest folder):
+    python -m benchmarks.ingest_bench generate --dir /tmp/mp_bench --docs 50000 --shards 16
+
+Run Matproj_db_migrator on it for every combination of mode and batch size:
+    python -m benchmarks.ingest_bench run --dir /tmp/mp_bench --modes serial,parallel --processes 4 --batch-bytes 1M,16M,64M
+    python -m benchmarks.ingest_bench run --dir /tmp/mp_bench --modes resume,incremental --json ingest.json
+
+Modes:
+    serial       full load with one process
+    parallel     full load with --processes worker processes
+    resume       rerun with resume=True after --fraction of the shards were left unfinished
+    incremental  update_s3_collection after --fraction of the stored documents went stale
+
+Every run happens in its own process so the peak RSS is measured per run. The report has
+docs/s, compressed and uncompressed MB/s, peak RSS and the seconds spent decompressing,
+decoding and inserting (summed over the workers in parallel mode).
+"""
+import argparse, gzip, hashlib, json, multiprocessing, os, random, resource, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.summary_bench import synthetic_summary_doc
+
+BENCH_META_FILE = "bench.json"
+MODES = ("serial", "parallel", "resume", "incremental")
+
+def _parse_bytes(value):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper()
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def band_structure_doc(rng, doc, array_size):
+    """ adds band-structure-like arrays (k-path distances and band energies) to a summary document """
+    nbands = max(1, array_size // 100)
+    nkpoints = max(1, array_size // nbands)
+    distances = [index * 0.01 for index in range(nkpoints)]
+    doc["bandstructure"] = {
+        "distance": distances,
+        "bands": {"1": [[rng.uniform(-10, 10) for _ in range(nkpoints)] for _ in range(nbands)]},
+        "branches": [{"start_index": 0, "end_index": nkpoints - 1, "name": "\\Gamma-X"}],
+        "efermi": rng.uniform(-5, 5),
+    }
+    doc["dos_energies"] = [rng.uniform(-10, 10) for _ in range(array_size)]
+    return doc
+
+def generate(args):
+    rng = random.Random(args.seed)
+    collection_path = os.path.join(args.dir, "collections", args.collection, args.sub_path)
+    folders = [f"{args.folder_prefix}{num}" for num in range(args.folders)]
+    for folder in folders + ["manifest"]:
+        os.makedirs(os.path.join(collection_path, folder), exist_ok=True)
+    manifest = []
+    compressed_bytes = uncompressed_bytes = 0
+    docs_per_shard = -(-args.docs // args.shards)
+    start_time = time.perf_counter()
+    for shard in range(args.shards):
+        folder = folders[shard % len(folders)]
+        shard_name = f"{folder}/shard-{shard:05d}.jsonl.gz"
+        path_to_file = os.path.join(collection_path, shard_name)
+        with gzip.open(path_to_file, "wb", compresslevel=args.compresslevel) as f:
+            for num in range(shard * docs_per_shard, min((shard + 1) * docs_per_shard, args.docs)):
+                doc = synthetic_summary_doc(rng, num)
+                if args.array_size:
+                    band_structure_doc(rng, doc, args.array_size)
+                line = json.dumps(doc).encode() + b"\n"
+                uncompressed_bytes += len(line)
+                f.write(line)
+        with open(path_to_file, "rb") as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        size = os.path.getsize(path_to_file)
+        compressed_bytes += size
+        manifest.append({"key": f"collections/{args.collection}/{args.sub_path}/{shard_name}".replace("//", "/"),
+                         "size": size, "md5": md5})
+        print(f"Generated {shard + 1}/{args.shards} shards\r", end="")
+    print("")
+    with open(os.path.join(collection_path, "manifest", "manifest.jsonl"), "w") as f:
+        for entry in manifest:
+            f.write(json.dumps(entry) + "\n")
+    meta = {"collection": args.collection, "sub_path": args.sub_path, "docs": args.docs, "shards": args.shards,
+            "compressed_bytes": compressed_bytes, "uncompressed_bytes": uncompressed_bytes}
+    with open(os.path.join(args.dir, BENCH_META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"{args.docs} documents in {args.shards} shards generated in {time.perf_counter() - start_time:.1f}s, "
+          f"{compressed_bytes / 1024 ** 2:.1f} MB compressed, {uncompressed_bytes / 1024 ** 2:.1f} MB uncompressed")
+    return meta
+
+def _setup(config):
+    """ brings the database to the starting state of a run, in its own process to keep it out of the measured RSS """
+    from s3_migrator import Matproj_db_migrator
+    migrator = Matproj_db_migrator(config["mongo_uri"], config["db"])
+    migrator.client.drop_database(config["db"])
+    base_path = os.path.join(config["dir"], "collections")
+    rng = random.Random(config["seed"])
+    if config["mode"] == "resume":
+        # a complete checkpointed load, then a fraction of the shards is flagged as interrupted
+        migrator.add_s3_collections_to_db(config["collection"], base_path, config["sub_path"], resume=True,
+                                          batch_bytes=config["batch_bytes"])
+        checkpoints = migrator.db_s3["ingest_checkpoints"]
+        shard_keys = [doc["_id"] for doc in checkpoints.find({"collection": config["collection"]}, {"_id": 1})]
+        interrupted = rng.sample(shard_keys, max(1, int(len(shard_keys) * config["fraction"])))
+        checkpoints.update_many({"_id": {"$in": interrupted}}, {"$set": {"status": "started"}})
+    elif config["mode"] == "incremental":
+        # a complete load, then a fraction of the documents gets a stale content hash
+        from s3_migrator import CONTENT_HASH_FIELD
+        migrator.update_s3_collection(config["collection"], base_path, config["sub_path"], batch_bytes=config["batch_bytes"])
+        collection = migrator.db_s3[config["collection"]]
+        ids = [doc["_id"] for doc in collection.find({}, {"_id": 1})]
+        stale = rng.sample(ids, int(len(ids) * config["fraction"]))
+        for first in range(0, len(stale), 10000):
+            collection.update_many({"_id": {"$in": stale[first:first + 10000]}}, {"$set": {CONTENT_HASH_FIELD: "stale"}})
+    migrator.client.close()
+
+def _run_one(config, results):
+    from s3_migrator import Matproj_db_migrator
+    migrator = Matproj_db_migrator(config["mongo_uri"], config["db"])
+    base_path = os.path.join(config["dir"], "collections")
+    stats = None
+    start_time = time.perf_counter()
+    match config["mode"]:
+        case "serial":
+            migrator.add_s3_collections_to_db(config["collection"], base_path, config["sub_path"],
+                                              batch_bytes=config["batch_bytes"])
+        case "parallel":
+            migrator.add_s3_collections_to_db(config["collection"], base_path, config["sub_path"],
+                                              processes=config["processes"], batch_bytes=config["batch_bytes"])
+        case "resume":
+            migrator.add_s3_collections_to_db(config["collection"], base_path, config["sub_path"],
+                                              processes=config["processes"], resume=True, batch_bytes=config["batch_bytes"])
+        case "incremental":
+            stats = migrator.update_s3_collection(config["collection"], base_path, config["sub_path"],
+                                                  batch_bytes=config["batch_bytes"])
+    seconds = time.perf_counter() - start_time
+    num_docs = migrator.db_s3[config["collection"]].count_documents({})
+    migrator.client.close()
+    # ru_maxrss is in KiB on Linux, for the children it's the peak of the largest worker
+    results.put({
+        "seconds": seconds,
+        "num_docs": num_docs,
+        "stage_seconds": dict(migrator.stage_seconds),
+        "update_stats": stats,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    })
+
+def _in_subprocess(target, *args):
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(target=target, args=args)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{target.__name__} failed with exit code {process.exitcode}")
+
+def run(args):
+    with open(os.path.join(args.dir, BENCH_META_FILE)) as f:
+        meta = json.load(f)
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            raise SystemExit(f"Unknown mode {mode}, expected one of {', '.join(MODES)}")
+    context = multiprocessing.get_context("spawn")
+    report = {"dataset": meta, "runs": []}
+    for mode in modes:
+        for batch_bytes in [_parse_bytes(value) for value in args.batch_bytes.split(",")]:
+            config = {"mongo_uri": args.mongo_uri, "db": args.db, "dir": args.dir, "collection": meta["collection"],
+                      "sub_path": meta["sub_path"], "mode": mode, "processes": args.processes if mode != "serial" else 1,
+                      "batch_bytes": batch_bytes, "fraction": args.fraction, "seed": args.seed}
+            _in_subprocess(_setup, config)
+            results = context.Queue()
+            _in_subprocess(_run_one, config, results)
+            result = results.get()
+            # resume and incremental runs only rewrite part of the data but read all of it
+            result.update({
+                "mode": mode,
+                "processes": config["processes"],
+                "batch_bytes": batch_bytes,
+                "docs_per_second": meta["docs"] / result["seconds"],
+                "compressed_mb_per_second": meta["compressed_bytes"] / 1024 ** 2 / result["seconds"],
+                "uncompressed_mb_per_second": meta["uncompressed_bytes"] / 1024 ** 2 / result["seconds"],
+            })
+            report["runs"].append(result)
+    print(f"{meta['docs']} documents, {meta['compressed_bytes'] / 1024 ** 2:.1f} MB compressed, "
+          f"{meta['uncompressed_bytes'] / 1024 ** 2:.1f} MB uncompressed")
+    print(f"{'mode':<12}{'procs':>6}{'batch':>8}{'docs/s':>10}{'MB/s gz':>9}{'MB/s raw':>10}{'RSS MB':>8}{'wrk MB':>8}"
+          f"{'decomp s':>10}{'decode s':>10}{'insert s':>10}")
+    for result in report["runs"]:
+        stage_seconds = result["stage_seconds"]
+        print(f"{result['mode']:<12}{result['processes']:>6}{result['batch_bytes'] // 1024:>7}K"
+              f"{result['docs_per_second']:>10.0f}{result['compressed_mb_per_second']:>9.1f}{result['uncompressed_mb_per_second']:>10.1f}"
+              f"{result['peak_rss_mb']:>8.0f}{result['peak_worker_rss_mb']:>8.0f}"
+              f"{stage_seconds['decompress']:>10.2f}{stage_seconds['decode']:>10.2f}{stage_seconds['insert']:>10.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", required=True, help="root of the synthetic S3 layout")
+    parser.add_argument("--seed", type=int, default=0)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="generate synthetic gzip shards and their manifest")
+    generate_parser.add_argument("--collection", default="summary")
+    generate_parser.add_argument("--sub-path", default="")
+    generate_parser.add_argument("--docs", type=int, default=50000)
+    generate_parser.add_argument("--shards", type=int, default=16)
+    generate_parser.add_argument("--folders", type=int, default=2)
+    generate_parser.add_argument("--folder-prefix", default="last_updated=2024-12-28_")
+    generate_parser.add_argument("--array-size", type=int, default=2000,
+                                 help="number of values of the band-structure-like arrays of every document, 0 for none")
+    generate_parser.add_argument("--compresslevel", type=int, default=6)
+
+    run_parser = subparsers.add_parser("run", help="ingest the synthetic shards with Matproj_db_migrator")
+    run_parser.add_argument("--mongo-uri", default=None)
+    run_parser.add_argument("--db", default="matproj_bench_ingest", help="dropped before every run")
+    run_parser.add_argument("--modes", default="serial,parallel")
+    run_parser.add_argument("--processes", type=int, default=os.cpu_count())
+    run_parser.add_argument("--batch-bytes", default="16M", help="comma separated batch sizes, e.g. 1M,16M,64M")
+    run_parser.add_argument("--fraction", type=float, default=0.1,
+                            help="fraction of shards left unfinished (resume) or of documents changed (incremental)")
+    run_parser.add_argument("--json", default=None, help="write the report to this file")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(args)
+    else:
+        run(args)
+
+if __name__ == "__main__":
+    main()
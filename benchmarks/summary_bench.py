@@ -0,0 +1,261 @@
+"""
+Load test and benchmark of the summary endpoints against a local mongod.
+
+Generate a synthetic summary collection (and its indexes):
+    python -m benchmarks.summary_bench generate --docs 150000 --db matproj_bench
+
+Replay a mix of index query shapes and detail_dash lookups, either against a running
+server (started with SUMMARY_MONGO_DB = "matproj_bench") or in-process:
+    python -m benchmarks.summary_bench run --db matproj_bench --base-url http://localhost:8000/summary/ --concurrency 16 --requests 5000
+    python -m benchmarks.summary_bench run --db matproj_bench --in-process --json baseline.json
+
+Every run reports throughput and p50/p99 latency per query shape, --json keeps them
+to compare a change against a baseline.
+"""
+import argparse, json, math, os, random, sys, threading, time
+import urllib.parse, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# elements weighted roughly by how often they appear in Materials Project
+ELEMENT_WEIGHTS = {
+    "O": 40, "Li": 12, "Fe": 10, "Mn": 9, "Co": 8, "Ni": 8, "Cu": 7, "Si": 7, "P": 7, "S": 7,
+    "F": 6, "Na": 6, "Mg": 6, "Al": 6, "Ca": 5, "K": 5, "Ti": 5, "V": 5, "Cr": 5, "Zn": 5,
+    "N": 5, "C": 5, "H": 5, "Cl": 4, "Se": 4, "Te": 3, "Ba": 4, "Sr": 4, "Y": 3, "Zr": 3,
+    "Nb": 3, "Mo": 3, "Sn": 3, "Sb": 3, "Bi": 3, "La": 3, "Ce": 2, "Nd": 2, "Eu": 2, "B": 3,
+    "Ge": 2, "Ga": 2, "In": 2, "Pb": 2, "Ag": 2, "Au": 1, "Pt": 1, "Pd": 1, "W": 2, "Ta": 1,
+}
+NELEMENTS_WEIGHTS = {1: 2, 2: 20, 3: 45, 4: 25, 5: 8}
+CRYSTAL_SYSTEMS = ["Triclinic", "Monoclinic", "Orthorhombic", "Tetragonal", "Trigonal", "Hexagonal", "Cubic"]
+
+def _weighted_elements(rng, nelements):
+    elements = set()
+    population, weights = list(ELEMENT_WEIGHTS), list(ELEMENT_WEIGHTS.values())
+    while len(elements) < nelements:
+        elements.add(rng.choices(population, weights)[0])
+    return sorted(elements)
+
+def synthetic_summary_doc(rng, num):
+    """ a summary document with the derived fields of an ingestion (formula_reduced) """
+    from summary.utils import get_formula_anonymous
+    from summary.formula import add_formula_field
+    nelements = rng.choices(list(NELEMENTS_WEIGHTS), list(NELEMENTS_WEIGHTS.values()))[0]
+    elements = _weighted_elements(rng, nelements)
+    composition = {element: rng.randint(1, 6) for element in elements}
+    divisor = math.gcd(*composition.values())
+    composition_reduced = {element: count // divisor for element, count in composition.items()}
+    nsites = sum(composition.values()) * rng.choice([1, 1, 2, 4])
+    a, b, c = (rng.uniform(3, 12) for _ in range(3))
+    sites = []
+    for element, count in composition.items():
+        for _ in range(count * nsites // sum(composition.values())):
+            abc = [rng.random(), rng.random(), rng.random()]
+            sites.append({
+                "species": [{"element": element, "occu": 1}],
+                "abc": abc,
+                "xyz": [abc[0] * a, abc[1] * b, abc[2] * c],
+                "label": element,
+                "properties": {"magmom": rng.uniform(-5, 5)},
+            })
+    band_gap = max(0.0, rng.gauss(1.5, 1.5))
+    energy_above_hull = abs(rng.gauss(0, 0.15))
+    return add_formula_field({
+        "material_id": f"mp-{num}",
+        "elements": elements,
+        "nelements": nelements,
+        "chemsys": "-".join(elements),
+        "formula_pretty": "".join(element + (str(count) if count > 1 else "") for element, count in composition_reduced.items()),
+        "formula_anonymous": get_formula_anonymous(composition_reduced),
+        "composition_reduced": {element: float(count) for element, count in composition_reduced.items()},
+        "nsites": len(sites),
+        "band_gap": band_gap,
+        "energy_above_hull": energy_above_hull,
+        "is_stable": energy_above_hull < 0.01,
+        "formation_energy_per_atom": rng.uniform(-4, 0.5),
+        "density": rng.uniform(1, 12),
+        "volume": a * b * c,
+        "symmetry": {"crystal_system": rng.choice(CRYSTAL_SYSTEMS), "number": rng.randint(1, 230)},
+        "structure": {
+            "lattice": {"matrix": [[a, 0, 0], [0, b, 0], [0, 0, c]], "a": a, "b": b, "c": c,
+                        "alpha": 90.0, "beta": 90.0, "gamma": 90.0, "volume": a * b * c},
+            "sites": sites,
+        },
+    })
+
+def generate(args):
+    from s3_migrator import Matproj_db_migrator
+    rng = random.Random(args.seed)
+    migrator = Matproj_db_migrator(args.mongo_uri, args.db)
+    collection = migrator.db_s3[args.collection]
+    collection.drop()
+    start_time = time.perf_counter()
+    for first in range(0, args.docs, args.batch):
+        collection.insert_many([synthetic_summary_doc(rng, num) for num in range(first, min(first + args.batch, args.docs))],
+                               ordered=False)
+        print(f"Generated {min(first + args.batch, args.docs)}/{args.docs} documents\r", end="")
+    print("")
+    print(f"{args.docs} documents generated in {time.perf_counter() - start_time:.1f}s")
+    migrator.build_indexes(args.collection)
+    migrator.ingestion_completed(args.collection)
+
+def build_workload(args):
+    """ (shape, path) requests built from documents sampled from the collection """
+    client = pymongo.MongoClient(args.mongo_uri)
+    samples = list(client[args.db][args.collection].aggregate([
+        {"$sample": {"size": args.pool_size}},
+        {"$project": {"_id": 0, "material_id": 1, "chemsys": 1, "elements": 1, "composition_reduced": 1}},
+    ]))
+    total_docs = client[args.db][args.collection].estimated_document_count()
+    rng = random.Random(args.seed)
+    fields = "_fields=material_id,formula_pretty,band_gap,energy_above_hull&_limit=15"
+
+    def search(**params):
+        return "?" + urllib.parse.urlencode(params) + "&" + fields
+
+    def wildcard_chemsys(doc):
+        elements = list(doc["elements"])
+        elements[rng.randrange(len(elements))] = "*"
+        return search(chemsys="-".join(elements))
+
+    def wildcard_formula(doc):
+        wildcard = rng.choice(doc["elements"])
+        formula = ""
+        for element, count in doc["composition_reduced"].items():
+            formula += ("*" if element == wildcard else element) + (str(int(count)) if count > 1 else "")
+        return search(formula=formula)
+
+    def elements_include_exclude(doc):
+        excluded = rng.choice([element for element in ELEMENT_WEIGHTS if element not in doc["elements"]])
+        return search(elements=",".join(doc["elements"][:2]), exclude_elements=excluded)
+
+    def material_ids(doc):
+        return search(material_ids=",".join(sample["material_id"] for sample in rng.sample(samples, min(10, len(samples)))))
+
+    def deep_skip(doc):
+        return search(_skip=rng.randrange(max(total_docs - 15, 1))).replace("&_limit=15", "&_limit=15&_sort_fields=material_id")
+
+    shapes = {
+        "exact_chemsys": lambda doc: search(chemsys=doc["chemsys"]),
+        "wildcard_chemsys": wildcard_chemsys,
+        "wildcard_formula": wildcard_formula,
+        "elements": elements_include_exclude,
+        "material_ids": material_ids,
+        "deep_skip": deep_skip,
+        "detail_dash": lambda doc: f"{doc['material_id']}/",
+    }
+    mix = {shape: 1 for shape in shapes}
+    if args.mix:
+        mix = {shape: float(weight) for shape, weight in (item.split("=") for item in args.mix.split(","))}
+    requests = []
+    for _ in range(args.requests):
+        shape = rng.choices(list(mix), list(mix.values()))[0]
+        requests.append((shape, shapes[shape](rng.choice(samples))))
+    return requests
+
+def _http_fetcher(base_url):
+    def fetch(path):
+        with urllib.request.urlopen(base_url + path) as response:
+            response.read()
+            return response.status
+    return fetch
+
+def _in_process_fetcher(args):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'local_mpr.settings')
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.SUMMARY_MONGO_URI = args.mongo_uri
+    settings.SUMMARY_MONGO_DB = args.db
+    settings.ALLOWED_HOSTS = ["*"]
+    from django.test import Client
+    local = threading.local()
+    def fetch(path):
+        if not hasattr(local, "client"):
+            local.client = Client()
+        response = local.client.get("/summary/" + path)
+        if hasattr(response, "streaming_content"):
+            b"".join(response.streaming_content)
+        return response.status_code
+    return fetch
+
+def _percentile(values, quantile):
+    values = sorted(values)
+    return values[min(int(quantile * len(values)), len(values) - 1)] if values else 0.0
+
+def run(args):
+    requests = build_workload(args)
+    fetch = _in_process_fetcher(args) if args.in_process else _http_fetcher(args.base_url)
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def timed(request):
+        shape, path = request
+        start_time = time.perf_counter()
+        # a non-2xx response, or any exception of the fetcher (HTTPError, a view raising in-process), is an error
+        try:
+            ok = 200 <= fetch(path) < 300
+        except Exception:
+            ok = False
+        seconds = time.perf_counter() - start_time
+        with lock:
+            latencies.setdefault(shape, []).append(seconds)
+            if not ok:
+                errors[shape] = errors.get(shape, 0) + 1
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(timed, requests))
+    elapsed = time.perf_counter() - start_time
+
+    report = {"requests": len(requests), "concurrency": args.concurrency, "seconds": elapsed,
+              "throughput": len(requests) / elapsed, "shapes": {}}
+    all_latencies = [seconds for values in latencies.values() for seconds in values]
+    for shape, values in sorted(latencies.items()) + [("all", all_latencies)]:
+        report["shapes"][shape] = {
+            "count": len(values),
+            "errors": errors.get(shape, 0) if shape != "all" else sum(errors.values()),
+            "p50_ms": _percentile(values, 0.5) * 1000,
+            "p99_ms": _percentile(values, 0.99) * 1000,
+        }
+    print(f"{len(requests)} requests in {elapsed:.1f}s, {report['throughput']:.1f} req/s at concurrency {args.concurrency}")
+    print(f"{'shape':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for shape, stats in report["shapes"].items():
+        print(f"{shape:<20}{stats['count']:>8}{stats['errors']:>8}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--db", default="matproj_bench")
+    parser.add_argument("--collection", default="summary")
+    parser.add_argument("--seed", type=int, default=0)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="generate a synthetic summary collection")
+    generate_parser.add_argument("--docs", type=int, default=150000)
+    generate_parser.add_argument("--batch", type=int, default=1000)
+
+    run_parser = subparsers.add_parser("run", help="replay a mix of summary requests")
+    run_parser.add_argument("--base-url", default="http://localhost:8000/summary/")
+    run_parser.add_argument("--in-process", action="store_true", help="call the views through Django's test client")
+    run_parser.add_argument("--requests", type=int, default=2000)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--pool-size", type=int, default=500, help="number of sampled documents the queries are built from")
+    run_parser.add_argument("--mix", default=None, help="weights per shape, e.g. exact_chemsys=3,wildcard_chemsys=1,detail_dash=2")
+    run_parser.add_argument("--json", default=None, help="write the report to this file")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(args)
+    else:
+        run(args)
+
+if __name__ == "__main__":
+    main()
@@ -139,4 +139,112 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
-]
\ No newline at end of file
+]
+
+# Summary API
+# "elements" serves wildcard chemsys/formula searches from the elements and nelements
+# indexes, "regex" falls back to the permutations of anchored chemsys regexes
+SUMMARY_WILDCARD_STRATEGY = "elements"
+
+# the ingestion generation (bumped by s3_migrator) is re-read every few seconds,
+# a new generation invalidates the cached counts and results
+SUMMARY_GENERATION_POLL_SECONDS = 5
+
+# total counts are cached per normalized query, _count=estimate caps the count at this many documents
+SUMMARY_COUNT_CACHE_SIZE = 10000
+SUMMARY_COUNT_CACHE_TTL = 3600
+SUMMARY_COUNT_ESTIMATE_LIMIT = 10000
+
+# results of summary searches are cached in-process, and in the Django cache
+# SUMMARY_RESULT_CACHE_ALIAS (e.g. a redis cache shared by all workers) if set
+SUMMARY_RESULT_CACHE_SIZE = 1024
+SUMMARY_RESULT_CACHE_TTL = 600
+SUMMARY_RESULT_CACHE_ALIAS = None
+
+# documents read per round trip by the streaming NDJSON export
+SUMMARY_EXPORT_BATCH_SIZE = 1000
+
+# maximum number of material ids of a summary/batch/ request
+SUMMARY_BATCH_MAX_IDS = 1000
+
+# mongodb of the summary API (None for localhost) and the database it serves. The async views (summary/async/, under
+# the ASGI entry point) share a pool of SUMMARY_MONGO_MAX_POOL_SIZE connections per process
+# and abort queries that run longer than SUMMARY_MONGO_QUERY_TIMEOUT_MS
+SUMMARY_MONGO_URI = None
+SUMMARY_MONGO_DB = "matproj_s3"
+SUMMARY_MONGO_MAX_POOL_SIZE = 100
+SUMMARY_MONGO_MIN_POOL_SIZE = 0
+SUMMARY_MONGO_QUERY_TIMEOUT_MS = 10000
+
+# every summary response carries a Server-Timing header, SUMMARY_METRICS_SAMPLE_RATE of the
+# requests are also recorded into the latency histograms served at summary/metrics/
+SUMMARY_METRICS_SAMPLE_RATE = 1.0
+SUMMARY_METRICS_RESERVOIR_SIZE = 1024
+SUMMARY_METRICS_MAX_SHAPES = 200
+
+# set to True to log query parameters and compiled queries of every search
+SUMMARY_DEBUG_QUERY_LOG = False
+
+# searches whose mongo stage takes longer than SUMMARY_SLOW_QUERY_MS (None to disable) are
+# logged to summary.slow_queries with their query shape and plan summary, and the latest
+# ones are served at summary/slow_queries/. "executionStats" also reports documents
+# examined but runs the slow query a second time
+SUMMARY_SLOW_QUERY_MS = 500
+SUMMARY_SLOW_QUERY_VERBOSITY = "queryPlanner"
+SUMMARY_SLOW_QUERY_LOG_SIZE = 100
+
+# serializer of the summary responses: "auto" (orjson if installed, else json), "orjson", "json"
+# or the dotted path of a callable returning bytes. Responses of at least SUMMARY_COMPRESS_MIN_BYTES
+# are compressed with zstd (if zstandard is installed) or gzip, as accepted by the client.
+# detail responses are cacheable for SUMMARY_DETAIL_MAX_AGE seconds and revalidated with an
+# ETag that changes with every ingestion
+SUMMARY_SERIALIZER = "auto"
+SUMMARY_COMPRESS_MIN_BYTES = 1024
+SUMMARY_GZIP_LEVEL = 6
+SUMMARY_ZSTD_LEVEL = 3
+SUMMARY_DETAIL_MAX_AGE = 60
+
+# evaluate the searches on the scalar fields of summary (elements, nelements, chemsys, formula_anonymous,
+# material_id and the numeric properties) on in-memory NumPy columns instead of mongodb. The columns are
+# loaded in the background at the first search and after every ingestion, about 10 MB per 100k materials
+SUMMARY_COLUMNAR_ENGINE = False
+
+# formula searches match "reduced" (the canonical reduced formula stored at ingestion, exact, and
+# formula_anonymous + chemsys for the documents ingested before formula_reduced existed, see
+# Matproj_db_migrator.add_derived_fields) or "anonymous" (formula_anonymous + chemsys only)
+SUMMARY_FORMULA_SEARCH = "reduced"
+
+# database of the band structure and DOS bundles served by summary/bundles/<col>/<id>/
+SUMMARY_BUNDLE_MONGO_DB = "matproj"
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'summary.queries': {
+            'handlers': ['console'],
+            'level': 'DEBUG' if SUMMARY_DEBUG_QUERY_LOG else 'WARNING',
+            'propagate': False,
+        },
+        'summary.slow_queries': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'summary.columnar': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'summary.detail': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
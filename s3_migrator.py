@@ -1,15 +1,283 @@
+import bson
 import pymongo
 import gzip
+import hashlib
 import json
 import os
+import queue
+import threading
+import time
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
 from pymongo.collection import Collection
 from typing import Union, TextIO, BinaryIO
 from arg_enums import ExportTypes, Bundle_col
+from summary.generation import SHARD_TAG_FIELD, CONTENT_HASH_FIELD, bump_generation
+from summary.filters import filter_index_specs
+from summary.formula import FORMULA_FIELD, add_formula_field
+from summary.detail import DETAIL_COLLECTION, DETAIL_VERSION, SUMMARY_PROJECTION, input_hash, compute_detail_docs
+from summary.bundles import BUNDLE_KEYS, chunks_name, encode_document, split_chunks
+from summary.partition import companion_name, create_companion, write_split, read_split, split_document, split_projection, join_split
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 client = pymongo.MongoClient()
 db = client.matproj
 
+# indexes built after a bulk load, derived from the query shapes of summary.views.index:
+# chemsys equality, formula (formula_anonymous + chemsys), elements $all/$nin,
+# material_id $in, exact formula (the canonical reduced formula of summary.formula),
+# and a (field, material_id) index per indexed field of the filter registry
+# (summary.filters) for its range filters and sorts
+INDEX_SPECS = {
+    "summary": [
+        [("chemsys", pymongo.ASCENDING)],
+        [("formula_anonymous", pymongo.ASCENDING), ("chemsys", pymongo.ASCENDING)],
+        [(FORMULA_FIELD, pymongo.ASCENDING), ("material_id", pymongo.ASCENDING)],
+        [("elements", pymongo.ASCENDING), ("nelements", pymongo.ASCENDING)],
+        [("material_id", pymongo.ASCENDING)],
+        *filter_index_specs(pymongo.ASCENDING),
+    ],
+    "materials": [
+        [("material_id", pymongo.ASCENDING)],
+    ],
+    "robocrys": [
+        [("material_id", pymongo.ASCENDING)],
+    ],
+}
+# heavy sub-documents that can be moved to a companion collection at ingestion (summary.partition),
+# and the block compressor of the companion collection
+SPLIT_FIELDS = {
+    "summary": ("structure",),
+}
+BLOCK_COMPRESSORS = {
+    "summary": "zstd",
+}
+# the key of a document of the collections partitioned by sub_path, where a material_id is
+# found once per partition (e.g. once per thermo_type)
+PARTITION_KEYS = {
+    "thermo": "thermo_id",
+    "xas": "spectrum_id",
+}
+# fields computed from the documents of a collection at ingestion
+DERIVED_FIELDS = {
+    "summary": add_formula_field,
+}
+DEFAULT_BATCH_BYTES = 16 * 2**20
+PROGRESS_INTERVAL = 0.5
+_END_OF_STREAM = object()
+# ingestion_completed leaves the split record as it is
+_SPLIT_UNCHANGED = object()
+
+def _prefetch(iterable, depth : int = 2):
+    """
+        Runs an iterator in a background thread and yields its items,
+        keeping up to depth items ready in advance.
+        When the consumer stops early, the thread stops and closes the iterator
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    def put(entry) -> bool:
+        # False once the consumer is gone
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((None, error))
+            return
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+        put((_END_OF_STREAM, None))
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _END_OF_STREAM:
+                return
+            yield item
+    finally:
+        stop.set()
+
+class Double_buffered_writer :
+    """
+        Sends batches to mongodb from a background thread, so that batch N is written
+        while batch N+1 is being decoded. At most one write is in flight at a time
+    """
+
+    def __init__(self, stage_seconds : dict) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.stage_seconds = stage_seconds
+        return
+
+    def submit(self, write, *args, **kwargs) -> None:
+        self.wait()
+        self.pending = self.executor.submit(self._timed_write, write, *args, **kwargs)
+        return
+
+    def wait(self) -> None:
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+        return
+
+    def _timed_write(self, write, *args, **kwargs):
+        start_time = time.perf_counter()
+        result = write(*args, **kwargs)
+        self.stage_seconds["insert"] += time.perf_counter() - start_time
+        return result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+        return
+
+class Write_throttle :
+    """
+        Token bucket shared by the concurrent jobs of a migration, so that together they
+        don't send mongod more than rate bytes of json per second. A batch larger than
+        the bucket is let through and the next ones wait until the debt is paid back
+    """
+
+    def __init__(self, rate : float, burst : float = None) -> None:
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited_seconds = 0.0
+        return
+
+    def acquire(self, amount : float) -> float:
+        # blocks until amount bytes may be written, returns the seconds waited
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited_seconds += wait_seconds
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+def content_hash(json_data : dict, ignore_fields : tuple = ()) -> str:
+    """
+        Returns the md5 of the canonical json of a document, without the bookkeeping
+        fields and the ignore_fields (e.g. build timestamps that change on every release)
+    """
+    hashed_data = {key: value for key, value in json_data.items()
+                   if key not in ignore_fields and key not in ("_id", SHARD_TAG_FIELD, CONTENT_HASH_FIELD)}
+    canonical = json.dumps(hashed_data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.md5(canonical.encode()).hexdigest()
+
+def file_fingerprint(path_to_file : str, previous : dict = None) -> dict:
+    """
+        Returns size, mtime and md5 of a file. The md5 of the previous fingerprint
+        is reused when size and mtime did not change, so reruns don't rehash every shard
+    """
+    stat = os.stat(path_to_file)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        fingerprint["md5"] = previous["md5"]
+        return fingerprint
+    md5 = hashlib.md5()
+    with open(path_to_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            md5.update(chunk)
+    fingerprint["md5"] = md5.hexdigest()
+    return fingerprint
+
+def read_s3_manifest(collection_path : str) -> dict:
+    """
+        Reads the manifest folders of a collection in the S3 layout
+
+    Returns:
+        dict: "<folder>/<file>" of every listed shard -> {"size": int, "md5": str}
+              (size and md5 are only set when the manifest has them)
+    """
+    manifest = {}
+    for folder in os.listdir(collection_path):
+        if not folder.startswith('manifest') or not os.path.isdir(f"{collection_path}/{folder}"):
+            continue
+        for manifest_file in os.listdir(f"{collection_path}/{folder}"):
+            path_to_file = f"{collection_path}/{folder}/{manifest_file}"
+            f = gzip.open(path_to_file, 'rt') if manifest_file.endswith('gz') else open(path_to_file, 'r')
+            with f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if not isinstance(entry, dict):
+                        continue
+                    key = entry.get("key") or entry.get("path") or entry.get("file")
+                    if not key:
+                        continue
+                    shard = {}
+                    if "size" in entry:
+                        shard["size"] = int(entry["size"])
+                    # single part S3 ETags are the md5 of the object, multipart ones contain a '-'
+                    md5 = entry.get("md5") or entry.get("etag") or entry.get("ETag")
+                    if md5 and '-' not in md5:
+                        shard["md5"] = md5.strip('"')
+                    manifest["/".join(key.split("/")[-2:])] = shard
+    return manifest
+
+class Ingest_checkpoint_store :
+    """
+        Records which shards were completely added to a collection, with their
+        fingerprint and number of documents, so an interrupted migration can be resumed
+    """
+
+    def __init__(self, collection : Collection) -> None:
+        self.collection = collection
+        return
+
+    def get(self, shard_key : str) -> Union[dict, None]:
+        return self.collection.find_one({"_id": shard_key})
+
+    def mark_started(self, shard_key : str, collection_name : str, fingerprint : dict) -> None:
+        self.collection.replace_one({"_id": shard_key},
+                                    {"collection": collection_name, "status": "started", "fingerprint": fingerprint},
+                                    upsert=True)
+        return
+
+    def mark_done(self, shard_key : str, num_docs : int) -> None:
+        self.collection.update_one({"_id": shard_key}, {"$set": {"status": "done", "num_docs": num_docs}})
+        return
+
+    def has_collection(self, collection_name : str) -> bool:
+        return self.collection.find_one({"collection": collection_name}, {"_id": 1}) is not None
+
+    def clear(self, collection_name : str) -> None:
+        self.collection.delete_many({"collection": collection_name})
+        return
+
 class Matproj_db_migrator :
     """
         This class migrates the downloaded database data from files on disk 
@@ -18,67 +286,650 @@ class Matproj_db_migrator :
     client : None
     db : None
 
-    def __init__(self) -> None:
+    def __init__(self, mongo_uri:str = None, db_s3_name:str = 'matproj_s3', print_fn = print, write_throttle = None) -> None:
         """
-            Initialize the migrator with db
+            Initialize the migrator with db.
+            Messages go through print_fn, and the documents read are metered by write_throttle
+            (a Write_throttle shared by concurrent migrations), if given
         """
-        self.client = pymongo.MongoClient()
+        self.mongo_uri = mongo_uri
+        self.client = pymongo.MongoClient(mongo_uri)
         self.db = self.client.matproj
-        self.db_s3 = self.client.matproj_s3
+        self.db_s3 = self.client[db_s3_name]
+        self.print = print_fn
+        self.write_throttle = write_throttle
+        # seconds spent in each stage of the ingestion pipeline
+        self.stage_seconds = {"decompress": 0.0, "decode": 0.0, "insert": 0.0}
+        # documents and json bytes decoded, bytes of the input files consumed
+        self.progress = {"docs": 0, "bytes": 0, "input_bytes": 0}
         return
 
-    def add_s3_collections_to_db(self, collection_name:str = 'summary', collection_base_path:str = 'collections', sub_path:str = ''):
+    def ingestion_completed(self, collection_name:str, split = _SPLIT_UNCHANGED) -> int:
+        """
+            Bumps the ingestion generation, which invalidates the caches of the summary API.
+            With split (the record of prepare_split, None if nothing is split), the split record of
+            the collection is written right before the bump, so the views switch to it with the data.
+            The companion collection of a collection that isn't split anymore is dropped
+        """
+        if split is None:
+            write_split(self.db_s3, collection_name, None)
+        elif split is not _SPLIT_UNCHANGED:
+            write_split(self.db_s3, collection_name, split["fields"], split["key"])
+        generation = bump_generation(self.db_s3)
+        if split is None and companion_name(collection_name) in self.db_s3.list_collection_names():
+            self.db_s3.drop_collection(companion_name(collection_name))
+        self.print(f"Ingestion of {collection_name} completed, generation {generation}")
+        return generation
+
+    def prepare_split(self,
+            collection_name:str,
+            split_fields:tuple = None,
+            key:str = 'material_id',
+            block_compressor:str = None,
+            rewrite:bool = False
+    ) -> dict:
+        """
+            Returns the split record the writes of an ingestion take, None if nothing is split.
+            Without split_fields (None) the collection keeps its split, split_fields=() un-splits it:
+            the fields of its companion collection are moved back into the collection first.
+            Other split_fields are written to the companion collection (created with block_compressor,
+            e.g. BLOCK_COMPRESSORS). A new split over documents already stored needs rewrite (every
+            document is written again, as in update_s3_collection), else ValueError is raised.
+            The record itself is written by ingestion_completed
+        """
+        previous_split = read_split(self.db_s3, collection_name)
+        if split_fields is None:
+            return previous_split
+        if not split_fields:
+            if previous_split is not None:
+                self.unsplit_collection(collection_name, previous_split)
+            return None
+        split = {"companion": companion_name(collection_name), "fields": list(split_fields), "key": key}
+        if previous_split is not None and previous_split["fields"] == split["fields"] and previous_split["key"] == key:
+            return previous_split
+        if not rewrite and self.db_s3[collection_name].find_one({}, {"_id": 1}) is not None:
+            raise ValueError(f"{collection_name} already has documents, their split can only be changed by "
+                             f"update_s3_collection or after un-splitting it with split_fields=()")
+        create_companion(self.db_s3, collection_name, key, block_compressor)
+        self.print(f"{', '.join(split_fields)} of {collection_name} are written to {split['companion']}")
+        return split
+
+    def unsplit_collection(self, collection_name:str, split:dict, add_by_docs_num:int = 1000) -> int:
+        """
+            Moves the fields of the companion collection of a split collection back into its
+            documents. The split record and the companion are only removed by ingestion_completed,
+            the views keep joining the companion until then. Returns the number of documents updated
+        """
         collection = self.db_s3[collection_name]
-        num_docs_added = 0
-        for folder in os.listdir(f"{collection_base_path}/{collection_name}/{sub_path}"):
+        key = split["key"]
+        operations = []
+        num_updated = 0
+        for heavy in self.db_s3[split["companion"]].find({}, {"_id": 0, SHARD_TAG_FIELD: 0}):
+            operations.append(UpdateOne({key: heavy.pop(key)}, {"$set": heavy}))
+            if len(operations) >= add_by_docs_num:
+                collection.bulk_write(operations, ordered=False)
+                num_updated += len(operations)
+                operations = []
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+            num_updated += len(operations)
+        self.print(f"{', '.join(split['fields'])} of {num_updated} documents moved back into {collection_name}")
+        return num_updated
+
+    def list_s3_shards(self, collection_name:str = 'summary', collection_base_path:str = 'collections', sub_path:str = '') -> list:
+        """
+            Returns the paths of all the .gz shards of a collection in the S3 layout,
+            skipping the manifest folders
+        """
+        shards = []
+        collection_path = f"{collection_base_path}/{collection_name}/{sub_path}"
+        for folder in sorted(os.listdir(collection_path)):
             if not folder.startswith('manifest'):
-                for gz_file in os.listdir(f"{collection_base_path}/{collection_name}/{sub_path}/{folder}"):
+                for gz_file in sorted(os.listdir(f"{collection_path}/{folder}")):
                     if gz_file.endswith('gz'):
-                        path_to_file = f"{collection_base_path}/{collection_name}/{sub_path}/{folder}/{gz_file}"
-                        num_docs_added = self.add_data_to_db(path_to_file, ExportTypes.Gzip, collection, False, 1000, num_docs_added)
-        print("")
-        print(f"{num_docs_added} documents added to {collection_name}")
-        return
+                        shards.append(f"{collection_path}/{folder}/{gz_file}")
+        return shards
+
+    def reconcile_s3_shards(self,
+            collection_name : str,
+            collection_base_path : str,
+            sub_path : str,
+            shards : list,
+            checkpoints : Ingest_checkpoint_store
+    ) -> list:
+        """
+            Compares the shards on disk with the manifest and the checkpoints.
+            Returns (path, shard_key, fingerprint) for every shard that is missing or changed
+            and removes the documents that a previous, interrupted run added from those shards
+        """
+        collection_path = f"{collection_base_path}/{collection_name}/{sub_path}"
+        manifest = read_s3_manifest(collection_path)
+        split = read_split(self.db_s3, collection_name)
+        on_disk = set()
+        pending = []
+        num_skipped = 0
+        for path_to_file in shards:
+            relative_path = "/".join(path_to_file.split("/")[-2:])
+            on_disk.add(relative_path)
+            shard_key = f"{collection_name}/{sub_path}/{relative_path}".replace("//", "/")
+            checkpoint = checkpoints.get(shard_key)
+            fingerprint = file_fingerprint(path_to_file, checkpoint["fingerprint"] if checkpoint else None)
+            expected = manifest.get(relative_path)
+            if expected is not None and any(fingerprint[key] != value for key, value in expected.items()):
+                self.print(f"Skipping {path_to_file} : it does not match the manifest (incomplete download?)")
+                continue
+            if checkpoint and checkpoint["status"] == "done" and checkpoint["fingerprint"]["md5"] == fingerprint["md5"]:
+                num_skipped += 1
+                continue
+            if checkpoint:
+                self.db_s3[collection_name].create_index(SHARD_TAG_FIELD, sparse=True)
+                self.db_s3[collection_name].delete_many({SHARD_TAG_FIELD: shard_key})
+                if split is not None:
+                    self.db_s3[split["companion"]].create_index(SHARD_TAG_FIELD, sparse=True)
+                    self.db_s3[split["companion"]].delete_many({SHARD_TAG_FIELD: shard_key})
+            pending.append((path_to_file, shard_key, fingerprint))
+        for relative_path in manifest.keys() - on_disk:
+            self.print(f"Missing shard listed in the manifest : {collection_path}/{relative_path}")
+        self.print(f"{num_skipped} shards of {collection_name} already added, {len(pending)} to add")
+        return pending
+
+    def add_s3_collections_to_db(self,
+            collection_name:str = 'summary',
+            collection_base_path:str = 'collections',
+            sub_path:str = '',
+            processes:int = 1,
+            resume:bool = False,
+            batch_bytes:int = DEFAULT_BATCH_BYTES,
+            split_fields:tuple = None,
+            block_compressor:str = None
+    ):
+        """
+            Adds all the shards of a collection into matproj_s3.
+            With processes > 1 the shards are spread over a process pool.
+            With resume, finished shards are checkpointed and only missing or changed
+            shards are added on a rerun. A collection that already has documents but no checkpoint
+            (a load without resume) raises ValueError, its documents can't be told apart by shard.
+            With split_fields (e.g. SPLIT_FIELDS), those fields are written to the companion
+            collection of the collection. Without them, a split collection stays split, see prepare_split
+        """
+        split = self.prepare_split(collection_name, split_fields, block_compressor=block_compressor)
+        checkpoints = None
+        if resume:
+            checkpoints = Ingest_checkpoint_store(self.db_s3['ingest_checkpoints'])
+            if not checkpoints.has_collection(collection_name) and self.db_s3[collection_name].find_one({}, {"_id": 1}) is not None:
+                raise ValueError(f"{collection_name} was loaded without resume, its documents have no shard tag: "
+                                 f"drop it, or add it without resume")
+            shards = self.reconcile_s3_shards(collection_name, collection_base_path, sub_path,
+                                              self.list_s3_shards(collection_name, collection_base_path, sub_path),
+                                              checkpoints)
+        else:
+            shards = [(path_to_file, None, None) for path_to_file in self.list_s3_shards(collection_name, collection_base_path, sub_path)]
+        if processes > 1:
+            return self.add_s3_collections_to_db_parallel(collection_name, shards, processes, checkpoints, batch_bytes, split)
+        collection = self.db_s3[collection_name]
+        num_docs_added = 0
+        for path_to_file, shard_key, fingerprint in shards:
+            if checkpoints:
+                checkpoints.mark_started(shard_key, collection_name, fingerprint)
+            num_docs_shard = self.add_data_to_db(path_to_file, ExportTypes.Gzip, collection, False, None, num_docs_added,
+                                                 shard_tag=shard_key, batch_bytes=batch_bytes, split=split) - num_docs_added
+            if checkpoints:
+                checkpoints.mark_done(shard_key, num_docs_shard)
+            num_docs_added += num_docs_shard
+        self.print("")
+        self.print(f"{num_docs_added} documents added to {collection_name}")
+        self.ingestion_completed(collection_name, split)
+        return num_docs_added
+
+    def add_s3_collections_to_db_parallel(self,
+            collection_name:str,
+            shards:list,
+            processes:int = os.cpu_count(),
+            checkpoints:Ingest_checkpoint_store = None,
+            batch_bytes:int = DEFAULT_BATCH_BYTES,
+            split:dict = None
+    ):
+        """
+            Adds the given (path, shard_key, fingerprint) shards of a collection into matproj_s3
+            using a pool of processes. Every worker owns its own MongoClient and inserts with
+            unordered bulk writes. The stage timings of the workers are added to stage_seconds
+        """
+        num_docs_added = 0
+        start_time = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_shard_worker,
+                                 initargs=(self.mongo_uri, self.db_s3.name)) as executor:
+            futures = {}
+            for path_to_file, shard_key, fingerprint in shards:
+                if checkpoints:
+                    checkpoints.mark_started(shard_key, collection_name, fingerprint)
+                futures[executor.submit(_add_shard_to_db, path_to_file, collection_name, shard_key, batch_bytes, split)] = shard_key
+            for num_shards_done, future in enumerate(as_completed(futures), start=1):
+                num_docs_shard, stage_seconds, progress = future.result()
+                for stage, seconds in stage_seconds.items():
+                    self.stage_seconds[stage] += seconds
+                for counter, value in progress.items():
+                    self.progress[counter] += value
+                if checkpoints:
+                    checkpoints.mark_done(futures[future], num_docs_shard)
+                num_docs_added += num_docs_shard
+                elapsed = time.perf_counter() - start_time
+                self.print(f"Shards : {num_shards_done}/{len(shards)}, Documents : {num_docs_added}, {num_docs_added / elapsed:.0f} docs/s\r", end="")
+        elapsed = time.perf_counter() - start_time
+        self.print("")
+        self.print(f"{num_docs_added} documents added to {collection_name} in {elapsed:.1f}s ({num_docs_added / max(elapsed, 1e-9):.0f} docs/s, {processes} processes)")
+        self.ingestion_completed(collection_name, split)
+        return num_docs_added
+
+    def update_s3_collection(self,
+            collection_name:str = 'summary',
+            collection_base_path:str = 'collections',
+            sub_path:str = '',
+            key:str = None,
+            remove_deprecated:bool = False,
+            ignore_fields:tuple = (),
+            add_by_docs_num:int = 1000,
+            batch_bytes:int = DEFAULT_BATCH_BYTES,
+            split_fields:tuple = None,
+            block_compressor:str = None
+    ) -> dict:
+        """
+            Incrementally updates a collection of matproj_s3 from a new release.
+            Every document is keyed on `key` and carries the content hash of its data, only
+            new or changed documents are upserted and the collection stays live during the update.
+            The key is material_id by default, or for a sub_path of a partitioned collection like
+            thermo, the key of PARTITION_KEYS (ValueError for another partitioned collection
+            without an explicit key, as material_id would replace the documents of other partitions).
+            With remove_deprecated, documents flagged as deprecated or not part of the
+            release anymore are removed. The whole collection is compared, so it is refused
+            for a single sub_path.
+            split_fields are written to the companion collection, as in add_s3_collections_to_db.
+            When they change, every document is rewritten whatever its content hash
+        """
+        if key is None:
+            if sub_path and collection_name not in PARTITION_KEYS:
+                raise ValueError(f"{collection_name}/{sub_path} is a partition of {collection_name}, "
+                                 f"give the key of its documents (material_id is not unique across partitions)")
+            key = PARTITION_KEYS.get(collection_name, 'material_id')
+        if remove_deprecated and sub_path:
+            raise ValueError(f"remove_deprecated compares the whole of {collection_name}, it can't update the partition {sub_path} only")
+        collection = self.db_s3[collection_name]
+        collection.create_index(key)
+        derive_fields = DERIVED_FIELDS.get(collection_name)
+        previous_split = read_split(self.db_s3, collection_name)
+        split = self.prepare_split(collection_name, split_fields, key, block_compressor, rewrite=True)
+        resplit = (previous_split or {}).get("fields") != (split or {}).get("fields")
+        companion = self.db_s3[companion_name(collection_name)]
+        heavy_operations = []
+        stored_hashes = {doc[key]: doc.get(CONTENT_HASH_FIELD)
+                         for doc in collection.find({}, {"_id": 0, key: 1, CONTENT_HASH_FIELD: 1})
+                         if key in doc}
+        stats = {"unchanged": 0, "upserted": 0, "removed": 0}
+        release_keys = set()
+        # deprecated documents are removed in the loop, not again with the ones missing from the release
+        deprecated_keys = set()
+        operations = []
+        start_time = time.perf_counter()
+        with Double_buffered_writer(self.stage_seconds) as writer:
+            for path_to_file in self.list_s3_shards(collection_name, collection_base_path, sub_path):
+                for json_list in self.read_doc_batches(path_to_file, ExportTypes.Gzip, batch_bytes):
+                    for json_data in json_list:
+                        json_data.pop('_id', None)
+                        doc_key = json_data[key]
+                        if remove_deprecated and json_data.get('deprecated'):
+                            if doc_key in stored_hashes and doc_key not in deprecated_keys:
+                                deprecated_keys.add(doc_key)
+                                operations.append(DeleteMany({key: doc_key}))
+                                if split is not None:
+                                    heavy_operations.append(DeleteMany({key: doc_key}))
+                                stats["removed"] += 1
+                            continue
+                        release_keys.add(doc_key)
+                        if derive_fields is not None:
+                            derive_fields(json_data)
+                        # hashed before the split, a change of a split field is a change of the document
+                        json_data[CONTENT_HASH_FIELD] = content_hash(json_data, ignore_fields)
+                        if not resplit and stored_hashes.get(doc_key) == json_data[CONTENT_HASH_FIELD]:
+                            stats["unchanged"] += 1
+                            continue
+                        if split is not None:
+                            heavy = split_document(json_data, split["fields"], key)
+                            heavy_operations.append(ReplaceOne({key: doc_key}, heavy, upsert=True) if heavy else DeleteMany({key: doc_key}))
+                        operations.append(ReplaceOne({key: doc_key}, json_data, upsert=True))
+                        stats["upserted"] += 1
+                    if len(operations) >= add_by_docs_num:
+                        writer.submit(_bulk_write_split, collection, operations, companion, heavy_operations)
+                        operations = []
+                        heavy_operations = []
+                self.print(f"Unchanged : {stats['unchanged']}, Upserted : {stats['upserted']}, Removed : {stats['removed']}\r", end="")
+            if remove_deprecated:
+                removed_keys = [doc_key for doc_key in stored_hashes.keys() - release_keys - deprecated_keys]
+                for i in range(0, len(removed_keys), add_by_docs_num):
+                    operations.append(DeleteMany({key: {"$in": removed_keys[i:i + add_by_docs_num]}}))
+                    if split is not None:
+                        heavy_operations.append(DeleteMany({key: {"$in": removed_keys[i:i + add_by_docs_num]}}))
+                stats["removed"] += len(removed_keys)
+            if len(operations) > 0:
+                writer.submit(_bulk_write_split, collection, operations, companion, heavy_operations)
+        self.print("")
+        self.print(f"{collection_name} updated in {time.perf_counter() - start_time:.1f}s : {stats}")
+        self.ingestion_completed(collection_name, split)
+        return stats
+
+    def build_indexes(self, collection_name:str = 'summary', index_specs:list = None) -> list:
+        """
+            Builds the indexes of a collection of matproj_s3 from INDEX_SPECS (or index_specs).
+            Meant to run after a bulk load, so the indexes are not maintained during the inserts.
+            Returns name, build time and size of every index
+        """
+        collection = self.db_s3[collection_name]
+        if index_specs is None:
+            index_specs = INDEX_SPECS.get(collection_name, [])
+        build_seconds = {}
+        for keys in index_specs:
+            start_time = time.perf_counter()
+            index_name = collection.create_index(keys, background=True)
+            build_seconds[index_name] = time.perf_counter() - start_time
+        storage_stats = next(collection.aggregate([{"$collStats": {"storageStats": {}}}]))["storageStats"]
+        report = []
+        for index_name, seconds in build_seconds.items():
+            report.append({"name": index_name,
+                           "build_seconds": seconds,
+                           "size_bytes": storage_stats["indexSizes"].get(index_name, 0)})
+            self.print(f"{collection_name}.{index_name} : {seconds:.1f}s, {storage_stats['indexSizes'].get(index_name, 0) / 2**20:.1f} MB")
+        return report
+
+    def add_derived_fields(self, collection_name:str = 'summary', batch_size:int = 1000) -> int:
+        """
+            Computes the DERIVED_FIELDS of the documents already in a collection (e.g. the
+            reduced formula of a summary ingested before it existed), without a new ingestion.
+            Returns the number of documents updated
+        """
+        derive_fields = DERIVED_FIELDS.get(collection_name)
+        if derive_fields is None:
+            return 0
+        collection = self.db_s3[collection_name]
+        num_updated = 0
+        operations = []
+        with Double_buffered_writer(self.stage_seconds) as writer:
+            for doc in collection.find({}, batch_size=batch_size):
+                derived = {field: value for field, value in derive_fields(dict(doc)).items() if field not in doc or doc[field] != value}
+                if derived:
+                    operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": derived}))
+                if len(operations) >= batch_size:
+                    writer.submit(collection.bulk_write, operations, ordered=False)
+                    num_updated += len(operations)
+                    operations = []
+            if operations:
+                writer.submit(collection.bulk_write, operations, ordered=False)
+                num_updated += len(operations)
+        self.print(f"Derived fields of {num_updated} documents of {collection_name} updated")
+        self.ingestion_completed(collection_name)
+        return num_updated
+
+    def precompute_details(self, processes:int = os.cpu_count(), chunk_size:int = 50, recompute:bool = False) -> dict:
+        """
+            Computes the detail payloads (symmetry, Wyckoff sites, crystal toolkit scene) of every
+            material of summary into the summary_detail side collection, across a pool of processes.
+            Materials whose summary document and description didn't change keep their stored
+            payload unless recompute, payloads of materials removed from summary are deleted
+        """
+        summary = self.db_s3['summary']
+        split = read_split(self.db_s3, 'summary')
+        summary_projection, heavy_projection, added_key = split_projection(SUMMARY_PROJECTION, split)
+        details = self.db_s3[DETAIL_COLLECTION]
+        details.create_index("material_id", unique=True)
+        stored_hashes = {doc["material_id"]: doc.get("input_hash")
+                         for doc in details.find({"version": DETAIL_VERSION}, {"_id": 0, "material_id": 1, "input_hash": 1})}
+        stats = {"unchanged": 0, "computed": 0, "failed": 0, "removed": 0}
+        summary_ids = set()
+        start_time = time.perf_counter()
+
+        def write(future):
+            operations = []
+            for doc in future.result():
+                if "error" in doc:
+                    stats["failed"] += 1
+                    self.print(f"\nDetail of {doc['material_id']} failed : {doc['error']}")
+                    continue
+                operations.append(ReplaceOne({"material_id": doc["material_id"]}, doc, upsert=True))
+            if operations:
+                details.bulk_write(operations, ordered=False)
+            stats["computed"] += len(operations)
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = set()
+            cursor = summary.find({}, summary_projection, batch_size=chunk_size)
+            while True:
+                summary_docs = [doc for _, doc in zip(range(chunk_size), cursor)]
+                if not summary_docs:
+                    break
+                if heavy_projection is not None:
+                    join_split(self.db_s3[split["companion"]], split, summary_docs, heavy_projection, added_key)
+                material_ids = [doc["material_id"] for doc in summary_docs]
+                summary_ids.update(material_ids)
+                descriptions = {doc.pop("material_id"): doc for doc in self.db_s3['robocrys'].find(
+                    {"material_id": {"$in": material_ids}}, {"_id": 0, "material_id": 1, "description": 1})}
+                inputs = []
+                for summary_doc in summary_docs:
+                    description = descriptions.get(summary_doc["material_id"])
+                    if not recompute and stored_hashes.get(summary_doc["material_id"]) == input_hash(summary_doc, description):
+                        stats["unchanged"] += 1
+                        continue
+                    inputs.append((summary_doc, description))
+                if inputs:
+                    pending.add(executor.submit(compute_detail_docs, inputs))
+                # keeps a bounded number of chunks in flight, so memory doesn't grow with the collection
+                while len(pending) >= 2 * processes:
+                    future = next(as_completed(pending))
+                    pending.remove(future)
+                    write(future)
+                elapsed = time.perf_counter() - start_time
+                self.print(f"Materials : {len(summary_ids)}, computed : {stats['computed']}, unchanged : {stats['unchanged']}, "
+                      f"{len(summary_ids) / max(elapsed, 1e-9):.0f} materials/s\r", end="")
+            for future in as_completed(pending):
+                write(future)
+        removed_ids = list(set(stored_hashes) - summary_ids)
+        for first in range(0, len(removed_ids), 10000):
+            stats["removed"] += details.delete_many({"material_id": {"$in": removed_ids[first:first + 10000]}}).deleted_count
+        self.print("")
+        self.print(f"{DETAIL_COLLECTION} precomputed in {time.perf_counter() - start_time:.1f}s : {stats}")
+        self.ingestion_completed(DETAIL_COLLECTION)
+        return stats
+
+    def read_doc_batches(self,
+            path_to_file : str,
+            dataType : ExportTypes,
+            batch_bytes : int = DEFAULT_BATCH_BYTES,
+            max_batch_docs : int = None
+    ):
+        """
+            Streams the documents of a file as lists of about batch_bytes of json.
+            Decompression and line splitting run in a background thread, while
+            the batches are decoded in the calling thread.
+            Every batch is counted in progress, and waits for write_throttle if there is one
+        """
+        match dataType:
+            case ExportTypes.Json:
+                f = open(path_to_file, 'rb')
+                raw_file = f
+            case ExportTypes.Gzip:
+                f = gzip.open(path_to_file, 'rb')
+                raw_file = f.fileobj
+            case _:
+                raise ValueError(f"Unsupported file type of data : {dataType}")
+        input_position = 0
+        for lines, num_bytes, position in _prefetch(self._read_line_batches(f, batch_bytes, max_batch_docs, raw_file)):
+            self.progress["input_bytes"] += position - input_position
+            input_position = position
+            if not lines:
+                continue
+            if self.write_throttle is not None:
+                self.write_throttle.acquire(num_bytes)
+            start_time = time.perf_counter()
+            json_list = [json_loads(line) for line in lines]
+            self.stage_seconds["decode"] += time.perf_counter() - start_time
+            self.progress["docs"] += len(json_list)
+            self.progress["bytes"] += num_bytes
+            yield json_list
+
+    def _read_line_batches(self, f, batch_bytes : int, max_batch_docs : int = None, raw_file = None):
+        # yields (lines, bytes of the lines, position in the raw file), the last position is the size of the file
+        with f:
+            lines = []
+            num_bytes = 0
+            start_time = time.perf_counter()
+            for line in f:
+                if not line.strip():
+                    continue
+                lines.append(line)
+                num_bytes += len(line)
+                if num_bytes >= batch_bytes or len(lines) == max_batch_docs:
+                    self.stage_seconds["decompress"] += time.perf_counter() - start_time
+                    yield lines, num_bytes, raw_file.tell()
+                    lines = []
+                    num_bytes = 0
+                    start_time = time.perf_counter()
+            self.stage_seconds["decompress"] += time.perf_counter() - start_time
+            yield lines, num_bytes, raw_file.tell()
 
     def add_data_to_db(self,
             path_to_file : str,
             dataType : ExportTypes,
             collection : Collection,
             from_scratch : bool = False,
-            add_by_docs_num : int = 1000,
-            skip_docs_num : int = 0
+            add_by_docs_num : int = None,
+            skip_docs_num : int = 0,
+            ordered : bool = True,
+            show_progress : bool = True,
+            shard_tag : str = None,
+            batch_bytes : int = DEFAULT_BATCH_BYTES,
+            split : dict = None
     ) -> None:
         """
-            This function reads data from file and add those into db
+            This function reads data from file and add those into db.
+            Reading, decoding and inserting are overlapped: batches of about batch_bytes
+            (and at most add_by_docs_num documents, if given) are decoded while the
+            previous batch is being inserted.
+            Documents are stamped with shard_tag, if given, so they can be removed
+            when their shard has to be added again.
+            The fields of split (see prepare_split) are inserted into the companion collection
         """
+        if dataType not in (ExportTypes.Json, ExportTypes.Gzip):
+            self.print("Unsupported file type of data")
+            return
+        companion = collection.database[split["companion"]] if split is not None else None
+        derive_fields = DERIVED_FIELDS.get(collection.name)
         if from_scratch:
             collection.drop()
-        f = None
-        match dataType:
-            case ExportTypes.Json:
-                f = open(path_to_file, 'r')
-            case ExportTypes.Gzip:
-                f = gzip.open(path_to_file, 'rb')
-            case _:
-                print("Unsupported file type of data")
-                return
-        json_list = []
+            if companion is not None:
+                # emptied rather than dropped, the companion keeps its block compressor
+                companion.delete_many({})
         num_docs = skip_docs_num
-        for line in f:
-            num_docs += 1
-            print(f"Number of Imported Documents : {num_docs}\r", end="")
-            json_data = json.loads(line)
-            # del json_data['_id']
-            json_list.append(json_data)
-            if len(json_list) == add_by_docs_num:
-                collection.insert_many(json_list)
-                json_list = []
-        if len(json_list) > 0:
-            collection.insert_many(json_list)
-        f.close()
+        last_progress = 0.0
+        with Double_buffered_writer(self.stage_seconds) as writer:
+            for json_list in self.read_doc_batches(path_to_file, dataType, batch_bytes, add_by_docs_num):
+                if shard_tag is not None:
+                    for json_data in json_list:
+                        json_data[SHARD_TAG_FIELD] = shard_tag
+                if derive_fields is not None:
+                    for json_data in json_list:
+                        derive_fields(json_data)
+                if companion is not None:
+                    heavy_list = []
+                    for json_data in json_list:
+                        heavy = split_document(json_data, split["fields"], split["key"])
+                        if heavy is not None:
+                            if shard_tag is not None:
+                                heavy[SHARD_TAG_FIELD] = shard_tag
+                            heavy_list.append(heavy)
+                    writer.submit(_insert_split, collection, json_list, companion, heavy_list, ordered)
+                else:
+                    writer.submit(collection.insert_many, json_list, ordered=ordered)
+                num_docs += len(json_list)
+                if show_progress and time.perf_counter() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.perf_counter()
+                    self.print(f"Number of Imported Documents : {num_docs}\r", end="")
+        if show_progress:
+            self.print(f"Number of Imported Documents : {num_docs}\r", end="")
         return num_docs
 
-def migrate_s3_collections():
+    def add_bundles_to_db(self,
+            path_to_file : str,
+            collection : Collection,
+            from_scratch : bool = False,
+            shard_tag : str = None,
+            compression : str = "zlib",
+            float_dtype : str = "float64",
+            batch_bytes : int = DEFAULT_BATCH_BYTES
+    ) -> int:
+        """
+            Adds a bundle file with the numeric arrays of its documents stored as typed, compressed
+            blobs (summary.bundles). Arrays too large for a document go to the <collection>_chunks
+            collection. Documents and chunks are stamped with shard_tag, if given.
+            Returns the number of documents added
+        """
+        chunks = collection.database[chunks_name(collection.name)]
+        if from_scratch:
+            collection.drop()
+            chunks.drop()
+        for key in BUNDLE_KEYS:
+            collection.create_index(key, sparse=True)
+        chunks.create_index([("bundle_id", pymongo.ASCENDING), ("path", pymongo.ASCENDING), ("n", pymongo.ASCENDING)])
+        num_docs = 0
+        json_bytes = self.progress["bytes"]
+        stored_bytes = 0
+        with Double_buffered_writer(self.stage_seconds) as writer:
+            # a bundle document can be tens of MB of json, a few of them make a batch
+            for json_list in self.read_doc_batches(path_to_file, ExportTypes.Gzip, batch_bytes):
+                docs = []
+                chunk_docs = []
+                for json_data in json_list:
+                    doc = encode_document(json_data, float_dtype, compression)
+                    doc_chunks = split_chunks(doc)
+                    if shard_tag is not None:
+                        doc[SHARD_TAG_FIELD] = shard_tag
+                        for chunk in doc_chunks:
+                            chunk[SHARD_TAG_FIELD] = shard_tag
+                    docs.append(doc)
+                    chunk_docs.extend(doc_chunks)
+                    stored_bytes += len(bson.encode(doc)) + sum(len(chunk["data"]) for chunk in doc_chunks)
+                writer.submit(_insert_split, collection, docs, chunks, chunk_docs, False)
+                num_docs += len(docs)
+        json_bytes = self.progress["bytes"] - json_bytes
+        self.print(f"{num_docs} bundles added to {collection.name} : {json_bytes / 2**20:.1f} MB of json stored in "
+                   f"{stored_bytes / 2**20:.1f} MB ({json_bytes / max(stored_bytes, 1):.1f}x)")
+        return num_docs
+
+_shard_migrator = None
+
+def _init_shard_worker(mongo_uri : str = None, db_s3_name : str = 'matproj_s3'):
+    # MongoClient is not fork-safe, so every worker process opens its own connection pool
+    global _shard_migrator
+    _shard_migrator = Matproj_db_migrator(mongo_uri, db_s3_name)
+
+def _insert_split(collection : Collection, json_list : list, companion : Collection, heavy_list : list, ordered : bool = True) -> None:
+    # a batch of documents, then their companion documents (split fields or bundle chunks)
+    collection.insert_many(json_list, ordered=ordered)
+    if heavy_list:
+        companion.insert_many(heavy_list, ordered=ordered)
+
+def _bulk_write_split(collection : Collection, operations : list, companion : Collection, heavy_operations : list) -> None:
+    collection.bulk_write(operations, ordered=False)
+    if heavy_operations:
+        companion.bulk_write(heavy_operations, ordered=False)
+
+def _add_shard_to_db(path_to_file : str, collection_name : str, shard_key : str = None, batch_bytes : int = DEFAULT_BATCH_BYTES, split : dict = None) -> tuple:
+    # returns the number of documents added, the seconds spent in each stage and the progress counters for this shard
+    collection = _shard_migrator.db_s3[collection_name]
+    stage_seconds = dict(_shard_migrator.stage_seconds)
+    progress = dict(_shard_migrator.progress)
+    num_docs = _shard_migrator.add_data_to_db(path_to_file, ExportTypes.Gzip, collection, False, None, 0,
+                                              ordered=False, show_progress=False, shard_tag=shard_key, batch_bytes=batch_bytes, split=split)
+    return (num_docs,
+            {stage: seconds - stage_seconds[stage] for stage, seconds in _shard_migrator.stage_seconds.items()},
+            {counter: value - progress[counter] for counter, value in _shard_migrator.progress.items()})
+
+def migrate_s3_collections(processes : int = 1, resume : bool = False, incremental : bool = False):
     collections_list = [
         # {"collection_name": "absorption",            "collection_path": "collections"},
         # {"collection_name": "alloys",                "collection_path": "collections"},
@@ -98,7 +949,7 @@ def migrate_s3_collections():
         # {"collection_name": "provenance",            "collection_path": "collections"},
         # {"collection_name": "robocrys",              "collection_path": "mp_collections_2024_12_28"},
         # {"collection_name": "similarity",            "collection_path": "collections"},
-        # {"collection_name": "summary",               "collection_path": "mp_collections_2024_12_28"},
+        # {"collection_name": "summary",               "collection_path": "mp_collections_2024_12_28", "split_fields": SPLIT_FIELDS["summary"]},
         # {"collection_name": "synth-descriptions",    "collection_path": "collections"},
         # {"collection_name": "thermo",                "collection_path": "collections", "sub_path": "thermo_type=GGA_GGA+U"},
         # {"collection_name": "thermo",                "collection_path": "collections", "sub_path": "thermo_type=GGA_GGA+U_R2SCAN"},
@@ -108,10 +959,30 @@ def migrate_s3_collections():
         # {"collection_name": "xas",                   "collection_path": "collections", "sub_path": "spectrum_type=XANES"},
     ]
     migrator = Matproj_db_migrator()
+    if not incremental and not resume:
+        # a full load doesn't maintain the indexes while inserting, they are built afterwards
+        for collection_name in {collection['collection_name'] for collection in collections_list}:
+            migrator.db_s3[collection_name].drop_indexes()
     for collection in collections_list:
+        if incremental:
+            migrator.update_s3_collection(collection_name=collection['collection_name'],
+                                          collection_base_path=collection['collection_path'],
+                                          sub_path=collection['sub_path'] if 'sub_path' in collection else '',
+                                          key=collection.get('key'),
+                                          split_fields=collection.get('split_fields'),
+                                          block_compressor=BLOCK_COMPRESSORS.get(collection['collection_name']))
+            continue
         migrator.add_s3_collections_to_db(collection_name=collection['collection_name'],
                                           collection_base_path=collection['collection_path'],
-                                          sub_path=collection['sub_path'] if 'sub_path' in collection else '')
+                                          sub_path=collection['sub_path'] if 'sub_path' in collection else '',
+                                          processes=processes,
+                                          resume=resume,
+                                          split_fields=collection.get('split_fields'),
+                                          block_compressor=BLOCK_COMPRESSORS.get(collection['collection_name']))
+    for collection_name in {collection['collection_name'] for collection in collections_list}:
+        migrator.build_indexes(collection_name)
+    if any(collection['collection_name'] in ('summary', 'robocrys') for collection in collections_list):
+        migrator.precompute_details(processes)
     return
 
 def migrate_props(path2props_dir : str) -> None :
@@ -135,23 +1006,259 @@ def migrate_props(path2props_dir : str) -> None :
         print("Added data : " + prop)
     return
 
-def migrate_bundles(path2dir : str, col: Bundle_col = Bundle_col.Bandstructure, bundles_list : list = range(91)) -> None :
-    migrator = Matproj_db_migrator()
+def bundle_file_name(col : Bundle_col, i : int) -> str :
+    return col.value + "_bundle_0" + str(i) + ".gz" if i < 10 else col.value + "_bundle_" + str(i) + ".gz"
+
+def migrate_bundles(path2dir : str, col: Bundle_col = Bundle_col.Bandstructure, bundles_list : list = range(91), resume : bool = False,
+                    migrator : Matproj_db_migrator = None, binary : bool = False, compression : str = "zlib", float_dtype : str = "float64") -> None :
+    """
+        With binary, the numeric arrays of the bundles are stored as compressed typed blobs
+        (see Matproj_db_migrator.add_bundles_to_db and summary.bundles) instead of JSON
+    """
+    migrator = migrator or Matproj_db_migrator()
     collection = migrator.db[col.value]
+
+    def add_bundle(path2file, from_scratch, shard_tag=None):
+        if binary:
+            return migrator.add_bundles_to_db(path2file, collection, from_scratch, shard_tag, compression, float_dtype)
+        return migrator.add_data_to_db(path2file, ExportTypes.Gzip, collection, from_scratch, shard_tag=shard_tag)
+
+    checkpoints = Ingest_checkpoint_store(migrator.db['ingest_checkpoints']) if resume else None
     for i in bundles_list:
-        print('Reading ' + col.value + '_bundle_' + str(i))
-        file_name = col.value + "_bundle_0" + str(i) + ".gz" if i < 10 else col.value + "_bundle_" + str(i) + ".gz" 
+        migrator.print('Reading ' + col.value + '_bundle_' + str(i))
+        file_name = bundle_file_name(col, i)
         path2file = path2dir + file_name
-        if i == 0 :
-            print("Initializing the collection : " + col.value)
-            migrator.add_data_to_db(path2file,ExportTypes.Gzip,collection,True)
+        if resume :
+            # never drop the collection when resuming, only redo the bundles that are not done
+            shard_key = col.value + "/" + file_name
+            checkpoint = checkpoints.get(shard_key)
+            fingerprint = file_fingerprint(path2file, checkpoint["fingerprint"] if checkpoint else None)
+            if checkpoint and checkpoint["status"] == "done" and checkpoint["fingerprint"]["md5"] == fingerprint["md5"]:
+                migrator.print("Already added " + file_name)
+                continue
+            if checkpoint:
+                collection.create_index(SHARD_TAG_FIELD, sparse=True)
+                collection.delete_many({SHARD_TAG_FIELD: shard_key})
+                migrator.db[chunks_name(col.value)].delete_many({SHARD_TAG_FIELD: shard_key})
+            checkpoints.mark_started(shard_key, col.value, fingerprint)
+            num_docs = add_bundle(path2file, False, shard_key)
+            checkpoints.mark_done(shard_key, num_docs)
+        elif i == 0 :
+            migrator.print("Initializing the collection : " + col.value)
+            add_bundle(path2file, True)
         else :
-            migrator.add_data_to_db(path2file,ExportTypes.Gzip,collection,False)
-        print("Added " + col.value + "_bundel_" + str(i) + " into " + col.value)
+            add_bundle(path2file, False)
+        migrator.print("Added " + col.value + "_bundel_" + str(i) + " into " + col.value)
     return 
 
+def _format_seconds(seconds : float) -> str :
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class Migration_job :
+    """
+        One job of a migration spec, run in a thread of Migration_orchestrator with its own migrator.
+        Job specs:
+            {"type": "s3", "collection_name": "thermo", "collection_path": "collections", "sub_path": "thermo_type=R2SCAN",
+             "mode": "full" | "resume" | "incremental", "key": "material_id", "remove_deprecated": false, "split_fields": ["structure"]}
+            {"type": "props", "path": "db_rar/", "prop": "summary"}
+            {"type": "bundles", "path": "db_rar/bs_bundle/", "col": "bs", "bundles": [0, 1], "resume": false,
+             "binary": true, "compression": "zlib" | "zstd" | "none", "float_dtype": "float64"}
+    """
+    TYPES = ("s3", "props", "bundles")
+    MODES = ("full", "resume", "incremental")
+
+    def __init__(self, spec : dict, mongo_uri : str = None, db_s3_name : str = 'matproj_s3',
+                 write_throttle : Write_throttle = None, print_fn = print) -> None:
+        self.spec = spec
+        self.type = spec.get("type", "s3")
+        if self.type not in self.TYPES:
+            raise ValueError(f"Unknown job type {self.type!r}, expected one of {', '.join(self.TYPES)}")
+        if self.type == "s3":
+            if spec.get("mode", "full") not in self.MODES:
+                raise ValueError(f"Unknown mode {spec['mode']!r} of {spec['collection_name']}, expected one of {', '.join(self.MODES)}")
+            self.name = spec["collection_name"] + (f"/{spec['sub_path']}" if spec.get("sub_path") else "")
+        elif self.type == "props":
+            self.name = f"props/{spec['prop']}"
+        else:
+            self.name = f"bundles/{Bundle_col(spec['col']).value}"
+        self.print_fn = print_fn
+        self.migrator = Matproj_db_migrator(mongo_uri, db_s3_name, print_fn=self.log, write_throttle=write_throttle)
+        self.status = "pending"
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.input_bytes = sum(os.path.getsize(path_to_file) for path_to_file in self.input_files() if os.path.exists(path_to_file))
+        return
+
+    def log(self, *args, **kwargs) -> None:
+        # the progress lines of the migrator ("...\r") are replaced by the reports of the orchestrator
+        message = " ".join(str(arg) for arg in args)
+        if not message.endswith("\r") and message.strip():
+            self.print_fn(f"[{self.name}] {message.strip()}")
+        return
+
+    def input_files(self) -> list:
+        match self.type:
+            case "s3":
+                return self.migrator.list_s3_shards(self.spec["collection_name"], self.spec.get("collection_path", "collections"),
+                                                    self.spec.get("sub_path", ""))
+            case "props":
+                return [self.spec["path"] + self.spec["prop"] + ".json"]
+            case "bundles":
+                return [self.spec["path"] + bundle_file_name(Bundle_col(self.spec["col"]), i)
+                        for i in self.spec.get("bundles", range(91))]
+
+    def run(self) -> None:
+        self.status = "running"
+        self.start_time = time.perf_counter()
+        try:
+            self._run()
+            self.status = "done"
+        except Exception as error:
+            self.status = "failed"
+            self.error = f"{type(error).__name__}: {error}"
+            self.log(f"failed : {self.error}")
+        finally:
+            self.end_time = time.perf_counter()
+        return
+
+    def _run(self) -> None:
+        spec = self.spec
+        match self.type:
+            case "s3":
+                collection_name = spec["collection_name"]
+                if spec.get("mode", "full") == "incremental":
+                    self.migrator.update_s3_collection(collection_name=collection_name,
+                                                       collection_base_path=spec.get("collection_path", "collections"),
+                                                       sub_path=spec.get("sub_path", ""),
+                                                       key=spec.get("key"),
+                                                       remove_deprecated=spec.get("remove_deprecated", False),
+                                                       split_fields=spec.get("split_fields"),
+                                                       block_compressor=BLOCK_COMPRESSORS.get(collection_name))
+                else:
+                    self.migrator.add_s3_collections_to_db(collection_name=collection_name,
+                                                           collection_base_path=spec.get("collection_path", "collections"),
+                                                           sub_path=spec.get("sub_path", ""),
+                                                           resume=spec.get("mode") == "resume",
+                                                           split_fields=spec.get("split_fields"),
+                                                           block_compressor=BLOCK_COMPRESSORS.get(collection_name))
+            case "props":
+                self.migrator.add_data_to_db(self.input_files()[0], ExportTypes.Json, self.migrator.db[spec["prop"]], True,
+                                             show_progress=False)
+            case "bundles":
+                migrate_bundles(spec["path"], Bundle_col(spec["col"]), spec.get("bundles", range(91)), spec.get("resume", False),
+                                migrator=self.migrator, binary=spec.get("binary", False),
+                                compression=spec.get("compression", "zlib"), float_dtype=spec.get("float_dtype", "float64"))
+        return
+
+    def elapsed(self) -> float:
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def eta(self) -> float:
+        # from the share of the input files consumed so far
+        done = self.migrator.progress["input_bytes"]
+        if self.status != "running" or not done or not self.input_bytes:
+            return None
+        return self.elapsed() * max(self.input_bytes - done, 0) / done
+
+    def report(self) -> str:
+        progress = self.migrator.progress
+        percent = 100 * progress["input_bytes"] / self.input_bytes if self.input_bytes else 0.0
+        return (f"{self.name:<40} {self.status:<8} {progress['docs']:>12,} docs {progress['bytes'] / 2**20:>10.1f} MB "
+                f"{min(percent, 100):>5.1f}%  elapsed {_format_seconds(self.elapsed()):>7}  ETA {_format_seconds(self.eta()):>7}")
+
+    def summary(self) -> dict:
+        elapsed = self.elapsed() or 0.0
+        return {"job": self.name, "status": self.status, "docs": self.migrator.progress["docs"],
+                "mb": self.migrator.progress["bytes"] / 2**20, "input_mb": self.input_bytes / 2**20,
+                "seconds": elapsed, "docs_per_s": self.migrator.progress["docs"] / elapsed if elapsed else 0.0,
+                "error": self.error}
+
+class Migration_orchestrator :
+    """
+        Runs the jobs of a declarative migration spec concurrently:
+            {"mongo_uri": null, "db_s3_name": "matproj_s3",
+             "concurrency": 4,             # jobs running at the same time
+             "max_write_mb_per_s": 50,     # shared by all the jobs, no cap if missing
+             "build_indexes": true, "precompute_details": true,
+             "jobs": [<Migration_job specs>]}
+        Once the jobs are done, the indexes of the s3 collections whose jobs all succeeded are built
+        and the detail payloads are precomputed if summary or robocrys was migrated,
+        as in migrate_s3_collections
+    """
+
+    def __init__(self, spec : dict, print_fn = print) -> None:
+        if not spec.get("jobs"):
+            raise ValueError("The migration spec has no jobs")
+        self.print_fn = print_fn
+        self.concurrency = int(spec.get("concurrency", 4))
+        if self.concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        max_write_mb_per_s = spec.get("max_write_mb_per_s")
+        self.write_throttle = Write_throttle(max_write_mb_per_s * 2**20) if max_write_mb_per_s else None
+        self.do_build_indexes = spec.get("build_indexes", True)
+        self.do_precompute_details = spec.get("precompute_details", True)
+        self.migrator = Matproj_db_migrator(spec.get("mongo_uri"), spec.get("db_s3_name", "matproj_s3"), print_fn=self.log)
+        self.jobs = [Migration_job(job_spec, spec.get("mongo_uri"), spec.get("db_s3_name", "matproj_s3"), self.write_throttle, print_fn)
+                     for job_spec in spec["jobs"]]
+        return
+
+    def log(self, *args, **kwargs) -> None:
+        # the migrator of the index builds and detail payloads calls it like print, print_fn
+        # (e.g. the write of a management command's stdout) only takes the message
+        message = " ".join(str(arg) for arg in args)
+        if not message.endswith("\r") and message.strip():
+            self.print_fn(message.strip())
+        return
+
+    def s3_collections(self, mode : str = None) -> dict:
+        # collection name -> its s3 jobs (of a mode)
+        collections = {}
+        for job in self.jobs:
+            if job.type == "s3" and (mode is None or job.spec.get("mode", "full") == mode):
+                collections.setdefault(job.spec["collection_name"], []).append(job)
+        return collections
+
+    def run(self, progress_interval : float = 10.0) -> list:
+        start_time = time.perf_counter()
+        # a full load doesn't maintain the indexes while inserting, they are built afterwards
+        for collection_name in self.s3_collections("full"):
+            self.migrator.db_s3[collection_name].drop_indexes()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {executor.submit(job.run) for job in self.jobs}
+            while pending:
+                done, pending = wait(pending, timeout=progress_interval)
+                self.report(time.perf_counter() - start_time)
+        if self.do_build_indexes:
+            for collection_name, jobs in self.s3_collections().items():
+                if all(job.status == "done" for job in jobs):
+                    self.migrator.build_indexes(collection_name)
+        migrated = {job.spec["collection_name"] for job in self.jobs if job.type == "s3" and job.status == "done"}
+        if self.do_precompute_details and migrated & {"summary", "robocrys"}:
+            self.migrator.precompute_details()
+        return [job.summary() for job in self.jobs]
+
+    def report(self, elapsed : float) -> None:
+        num_done = sum(job.status in ("done", "failed") for job in self.jobs)
+        throttled = f", throttled {self.write_throttle.waited_seconds:.0f}s" if self.write_throttle is not None else ""
+        self.print_fn(f"--- {num_done}/{len(self.jobs)} jobs finished, {_format_seconds(elapsed)}{throttled}")
+        for job in self.jobs:
+            if job.status == "running":
+                self.print_fn(job.report())
+        return
+
 def main() : 
-    # migrate several props data
+    # migrate several props data, serially and without checkpoints. processes=os.cpu_count() spreads the
+    # shards over a process pool, resume=True skips the shards a previous checkpointed run added
     migrate_s3_collections()
     # path2props_dir = 'db_rar/'
     # migrate_props(path2props_dir)
@@ -160,7 +1267,7 @@ def main() :
     path2bs_dir = 'db_rar/bs_bundle/'
     path2dos_dir = 'db_rar/dos_bundle/'
     path2pdos_dir = 'db_rar/pdos_bundle/'
-    #migrate_bundles(path2dir = path2bs_dir, col = Bundle_col.Bandstructure, bundles_list=[0,1])
+    #migrate_bundles(path2dir = path2bs_dir, col = Bundle_col.Bandstructure, bundles_list=[0,1], binary=True)
     #migrate_bundles(path2dir = path2dos_dir, col = Bundle_col.DOS, bundles_list=[0,1])
     # migrate_bundles(path2dir = path2pdos_dir, col = Bundle_col.PDOS, bundles_list=[0,1])
 
@@ -0,0 +1,8 @@
+"""
+The summary API of matproj_s3.
+
+The views (views, async_views) and their helpers (cache, metrics, explain, responses)
+depend on django. The other modules (generation, filters, formula, partition, detail,
+bundles, facets, columnar, utils) only need pymongo and numpy: s3_migrator and the
+worker processes of its batch jobs import them without a django settings module.
+"""
@@ -0,0 +1,206 @@
+"""
+Async versions of the summary views for the ASGI entry point (local_mpr/asgi.py).
+They share query building and caches with the sync views in views.py, but talk to
+mongodb through pymongo's AsyncMongoClient, so a worker is never blocked on a round trip.
+"""
+import asyncio, contextlib
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseBadRequest
+from bson import json_util
+from pymongo import AsyncMongoClient
+from pymongo.errors import ExecutionTimeout, PyMongoError
+from .cache import QueryResultCache, acurrent_generation
+from .metrics import StageTimer, query_shape, record
+from .explain import explain_command, plan_summary, slow_query_log, SLOW_QUERY_VERBOSITY
+from .responses import dumps, encoded_response, detail_etag, if_none_match, not_modified, cache_control
+from .views import _build_query, _build_options, _page_options, _skip_pipeline, _keyset_plan, _keyset_page, _search_pipeline
+from .views import _columnar_page, _columnar_docs
+from .filters import FilterError
+from .partition import aread_split, split_projection, ajoin_split
+from .views import _normalized_query, _split_sort_error, count_cache, result_cache, split_cache, COUNT_ESTIMATE_LIMIT
+
+QUERY_TIMEOUT_MS = getattr(settings, "SUMMARY_MONGO_QUERY_TIMEOUT_MS", 10000)
+
+# an AsyncMongoClient is bound to the event loop it is used in. Under ASGI there is a single
+# loop, and a single client for the process. Under WSGI every request runs in its own loop,
+# so it gets its own client, closed at the end of the request
+_asgi_client = None
+
+def _async_client() -> AsyncMongoClient:
+    return AsyncMongoClient(getattr(settings, "SUMMARY_MONGO_URI", None),
+                            maxPoolSize=getattr(settings, "SUMMARY_MONGO_MAX_POOL_SIZE", 100),
+                            minPoolSize=getattr(settings, "SUMMARY_MONGO_MIN_POOL_SIZE", 0))
+
+@contextlib.asynccontextmanager
+async def _async_db(request):
+    global _asgi_client
+    db_name = getattr(settings, "SUMMARY_MONGO_DB", "matproj_s3")
+    if isinstance(request, ASGIRequest):
+        if _asgi_client is None:
+            _asgi_client = _async_client()
+        yield _asgi_client[db_name]
+        return
+    client = _async_client()
+    try:
+        yield client[db_name]
+    finally:
+        await client.close()
+
+async def _atotal_doc(adb, query_json:dict = {}, count_mode:str = "exact") -> dict:
+    """ views._total_doc on the async client """
+    if count_mode == "none":
+        return {"total_doc": None}
+    collection = adb['summary']
+    cache_key = (await acurrent_generation(adb), _normalized_query(query_json))
+    total_doc = count_cache.get(cache_key)
+    if total_doc is not None:
+        return {"total_doc": total_doc}
+    if count_mode == "estimate":
+        if not query_json:
+            return {"total_doc": await collection.estimated_document_count(maxTimeMS=QUERY_TIMEOUT_MS), "total_doc_estimated": True}
+        total_doc = await collection.count_documents(query_json, limit=COUNT_ESTIMATE_LIMIT, maxTimeMS=QUERY_TIMEOUT_MS)
+        if total_doc == COUNT_ESTIMATE_LIMIT:
+            return {"total_doc": total_doc, "total_doc_estimated": True}
+    else:
+        total_doc = await collection.count_documents(query_json, maxTimeMS=QUERY_TIMEOUT_MS)
+    count_cache.set(cache_key, total_doc)
+    return {"total_doc": total_doc}
+
+async def _asummary_split(adb) -> dict:
+    """ views._summary_split on the async client """
+    key = ("summary", await acurrent_generation(adb))
+    split = split_cache.get(key)
+    if split is None:
+        split = await aread_split(adb, "summary") or {}
+        split_cache.set(key, split)
+    return split or None
+
+async def _aaggregate(adb, pipeline:list) -> list:
+    cursor = await adb['summary'].aggregate(pipeline, allowDiskUse=True, maxTimeMS=QUERY_TIMEOUT_MS)
+    return await cursor.to_list()
+
+async def _alog_if_slow(adb, route:str, query_json:dict, pipeline:list, seconds:float):
+    """ views._log_if_slow on the async client """
+    if not slow_query_log.is_slow(seconds):
+        return
+    try:
+        plan = plan_summary(await adb.command({"explain": explain_command("summary", pipeline), "verbosity": SLOW_QUERY_VERBOSITY}))
+    except PyMongoError as error:
+        plan = {"error": str(error)}
+    slow_query_log.add(route, query_shape(query_json), seconds, plan)
+
+async def index(request):
+    async with _async_db(request) as adb:
+        return await _index(request, adb)
+
+async def _index(request, adb):
+    timer = StageTimer()
+    with timer.stage("parse"):
+        required_fields_json, sort_fields_list = _build_options(request.GET)
+        try:
+            limit_docs, skip_docs, cursor, count_mode = _page_options(request.GET)
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+    with timer.stage("compile"):
+        try:
+            query_json = _build_query(request.GET)
+        except FilterError as error:
+            return HttpResponseBadRequest(str(error))
+    split = await _asummary_split(adb)
+    sort_error = _split_sort_error(sort_fields_list, split)
+    if sort_error:
+        return HttpResponseBadRequest(sort_error)
+    main_fields_json, heavy_fields_json, added_key = split_projection(required_fields_json, split)
+    if request.GET.get('_explain') in ('1', 'true'):
+        try:
+            pipeline = _search_pipeline(query_json, cursor, skip_docs, limit_docs, main_fields_json, sort_fields_list)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid _cursor")
+        explain = await adb.command({"explain": explain_command("summary", pipeline), "verbosity": "executionStats"})
+        return HttpResponse(json_util.dumps({"query": query_json, "pipeline": pipeline,
+                                             "plan": plan_summary(explain), "explain": explain}),
+                            content_type="application/json")
+    generation = await acurrent_generation(adb)
+    cache_key = QueryResultCache.make_key(generation, query_json, required_fields_json, sort_fields_list,
+                                          cursor, skip_docs, limit_docs, count_mode)
+    with timer.stage("cache"):
+        response = await result_cache.aget(cache_key)
+    if response is None:
+        # the columnar engine of views.py, the documents of the page are read on the async client
+        with timer.stage("columnar"):
+            try:
+                page = _columnar_page(generation, query_json, cursor, skip_docs, limit_docs, sort_fields_list, count_mode)
+            except ValueError:
+                return HttpResponseBadRequest("Invalid _cursor")
+        if page is not None:
+            material_ids, meta = page
+            try:
+                with timer.stage("mongo"):
+                    found_docs = await adb['summary'].find({"material_id": {"$in": material_ids}}, dict(main_fields_json, material_id=1),
+                                                           max_time_ms=QUERY_TIMEOUT_MS).to_list()
+                    data = _columnar_docs(found_docs, material_ids, main_fields_json)
+                if heavy_fields_json is not None:
+                    with timer.stage("join"):
+                        await ajoin_split(adb[split["companion"]], split, data, heavy_fields_json, added_key)
+            except ExecutionTimeout:
+                return HttpResponse("Query timed out", status=504)
+            response = {"data": data, "meta": meta}
+            await result_cache.aset(cache_key, response)
+    if response is None:
+        try:
+            with timer.stage("mongo"):
+                # the page and the count are queried concurrently
+                if cursor is not None:
+                    try:
+                        pipeline, sort_list, added_fields = _keyset_plan(query_json, cursor, limit_docs, main_fields_json, sort_fields_list)
+                    except ValueError:
+                        return HttpResponseBadRequest("Invalid _cursor")
+                    data, meta = await asyncio.gather(_aaggregate(adb, pipeline), _atotal_doc(adb, query_json, count_mode))
+                    data, next_cursor = _keyset_page(data, limit_docs, sort_list, added_fields)
+                    meta = dict(meta, next_cursor=next_cursor)
+                else:
+                    pipeline = _skip_pipeline(query_json, skip_docs, limit_docs, main_fields_json, sort_fields_list)
+                    data, meta = await asyncio.gather(_aaggregate(adb, pipeline), _atotal_doc(adb, query_json, count_mode))
+            if heavy_fields_json is not None:
+                with timer.stage("join"):
+                    await ajoin_split(adb[split["companion"]], split, data, heavy_fields_json, added_key)
+        except ExecutionTimeout:
+            return HttpResponse("Query timed out", status=504)
+        response = {"data": data, "meta": meta}
+        await result_cache.aset(cache_key, response)
+        await _alog_if_slow(adb, "async_index", query_json, pipeline, timer.seconds("mongo"))
+    with timer.stage("serialize"):
+        http_response = encoded_response(request, dumps(response))
+    record("async_index", query_shape(query_json), timer)
+    http_response["Server-Timing"] = timer.server_timing()
+    return http_response
+
+async def detail_dash(request, materialID_str):
+    async with _async_db(request) as adb:
+        return await _detail_dash(request, adb, materialID_str)
+
+async def _detail_dash(request, adb, materialID_str):
+    timer = StageTimer()
+    etag = detail_etag(await acurrent_generation(adb), "detail_dash", materialID_str)
+    matched_tag = if_none_match(request, etag)
+    if matched_tag:
+        return not_modified(matched_tag)
+    collection = adb['summary']
+    split = await _asummary_split(adb)
+    projection, heavy_projection, added_key = split_projection({"_id": 0, "structure": 1}, split)
+    try:
+        with timer.stage("mongo"):
+            result = await collection.find_one({"material_id": materialID_str}, projection, max_time_ms=QUERY_TIMEOUT_MS)
+            if result is not None and heavy_projection is not None:
+                await ajoin_split(adb[split["companion"]], split, [result], heavy_projection, added_key)
+    except ExecutionTimeout:
+        return HttpResponse("Query timed out", status=504)
+    with timer.stage("serialize"):
+        if result is None:
+            http_response = encoded_response(request, dumps(result))
+        else:
+            http_response = cache_control(encoded_response(request, dumps(result), etag=etag))
+    record("async_detail_dash", "material_id", timer)
+    http_response["Server-Timing"] = timer.server_timing()
+    return http_response
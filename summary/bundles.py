@@ -0,0 +1,203 @@
+"""
+Binary storage of the band structure and DOS bundles (bs, dos, pdos, pdos_new).
+
+As plain JSON a bundle is stored as nested BSON arrays of doubles, about 15 bytes and a
+decode per number, and the large ones don't fit in a 16 MB document. encode_document()
+replaces every numeric (nested) list of at least MIN_ARRAY_SIZE numbers with a typed
+blob: a fixed dtype, byte-shuffled (the bytes of the same significance are stored next
+to each other, which is what makes floats compress) and compressed with zlib or zstd.
+Arrays whose blob is larger than CHUNK_BYTES, or that would make the document larger
+than INLINE_LIMIT, are moved to the <collection>_chunks collection in CHUNK_BYTES pieces.
+decode_document() turns a stored bundle back into NumPy arrays, and also takes the
+documents of the plain JSON layout.
+"""
+import io, json, zlib
+import numpy
+from bson import Binary, ObjectId
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARRAY_FIELD = "__array__"
+CHUNKS_SUFFIX = "_chunks"
+# fields the bundles are looked up by
+BUNDLE_KEYS = ("material_id", "task_id")
+MIN_ARRAY_SIZE = 64
+CHUNK_BYTES = 4 * 2**20
+INLINE_LIMIT = 12 * 2**20
+COMPRESSIONS = ("zlib", "zstd", "none")
+
+def chunks_name(collection_name:str) -> str:
+    return f"{collection_name}{CHUNKS_SUFFIX}"
+
+def _compress(data:bytes, compression:str, level:int = None) -> bytes:
+    if compression == "zlib":
+        return zlib.compress(data, 6 if level is None else level)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    return data
+
+def _decompress(data:bytes, compression:str) -> bytes:
+    if compression == "zlib":
+        return zlib.decompress(data)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compressed bundles need the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+def as_array(value, min_size:int = MIN_ARRAY_SIZE) -> numpy.ndarray:
+    """ a numeric, rectangular (nested) list of at least min_size numbers as an array, else None """
+    if not isinstance(value, list) or not value:
+        return None
+    try:
+        array = numpy.asarray(value)
+    except ValueError:
+        # ragged lists
+        return None
+    if array.dtype.kind not in "iuf" or array.size < min_size:
+        return None
+    return array
+
+def _storage_dtype(array:numpy.ndarray, float_dtype:str) -> numpy.dtype:
+    if array.dtype.kind == "f":
+        return numpy.dtype(float_dtype)
+    # integers take the smallest of int32/int64 that holds them
+    if array.min() >= numpy.iinfo(numpy.int32).min and array.max() <= numpy.iinfo(numpy.int32).max:
+        return numpy.dtype("int32")
+    return numpy.dtype("int64")
+
+def encode_array(array:numpy.ndarray, float_dtype:str = "float64", compression:str = "zlib", level:int = None) -> dict:
+    """
+        The stored form of an array: {"__array__": 1, "dtype", "shape", "compression", "nbytes", "data"}.
+        dtype is little-endian, so the blobs read the same on every platform
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression!r}, expected one of {', '.join(COMPRESSIONS)}")
+    dtype = _storage_dtype(array, float_dtype).newbyteorder("<")
+    values = numpy.ascontiguousarray(array, dtype=dtype)
+    # byte shuffle: byte 0 of every value, then byte 1, ...
+    shuffled = values.view(numpy.uint8).reshape(-1, dtype.itemsize).T.tobytes()
+    return {
+        ARRAY_FIELD: 1,
+        "dtype": dtype.str,
+        "shape": list(values.shape),
+        "compression": compression,
+        "nbytes": values.nbytes,
+        "data": Binary(_compress(shuffled, compression, level)),
+    }
+
+def decode_array(stored:dict, data:bytes = None) -> numpy.ndarray:
+    """ the array of encode_array, data is the joined chunks of a chunked array """
+    dtype = numpy.dtype(stored["dtype"])
+    shuffled = numpy.frombuffer(_decompress(stored["data"] if data is None else data, stored["compression"]), dtype=numpy.uint8)
+    values = shuffled.reshape(dtype.itemsize, -1).T.copy().view(dtype)
+    return values.reshape(stored["shape"])
+
+def is_array(value) -> bool:
+    return isinstance(value, dict) and ARRAY_FIELD in value
+
+def encode_document(doc, float_dtype:str = "float64", compression:str = "zlib", level:int = None, min_size:int = MIN_ARRAY_SIZE):
+    """ a copy of a bundle document with its numeric lists encoded """
+    if isinstance(doc, dict):
+        return {key: encode_document(value, float_dtype, compression, level, min_size) for key, value in doc.items()}
+    if isinstance(doc, list):
+        array = as_array(doc, min_size)
+        if array is not None:
+            return encode_array(array, float_dtype, compression, level)
+        return [encode_document(value, float_dtype, compression, level, min_size) for value in doc]
+    return doc
+
+def _stored_arrays(doc, path:tuple = ()):
+    # (path, stored array) of the encoded arrays of a document, paths are tuples of keys/indexes
+    if is_array(doc):
+        yield path, doc
+    elif isinstance(doc, dict):
+        for key, value in doc.items():
+            yield from _stored_arrays(value, path + (key,))
+    elif isinstance(doc, list):
+        for index, value in enumerate(doc):
+            yield from _stored_arrays(value, path + (index,))
+
+def _path_name(path:tuple) -> str:
+    return ".".join(str(key) for key in path)
+
+def split_chunks(doc:dict, chunk_bytes:int = CHUNK_BYTES, inline_limit:int = INLINE_LIMIT) -> list:
+    """
+        Moves the oversized blobs of an encoded document out of it, in place: the stored array keeps
+        "chunks" (their number) instead of "data". Returns the chunk documents, which refer to the
+        document by its _id (added if missing)
+    """
+    doc.setdefault("_id", ObjectId())
+    arrays = sorted(_stored_arrays(doc), key=lambda item: len(item[1]["data"]), reverse=True)
+    inline_bytes = sum(len(stored["data"]) for _, stored in arrays)
+    chunk_docs = []
+    for path, stored in arrays:
+        data = stored["data"]
+        if len(data) <= chunk_bytes and inline_bytes <= inline_limit:
+            break
+        for n, first in enumerate(range(0, len(data), chunk_bytes)):
+            chunk_docs.append({"bundle_id": doc["_id"], "path": _path_name(path), "n": n, "data": Binary(data[first:first + chunk_bytes])})
+        stored["chunks"] = -(-len(data) // chunk_bytes)
+        del stored["data"]
+        inline_bytes -= len(data)
+    return chunk_docs
+
+def decode_document(doc, chunks:dict = None, path:tuple = ()):
+    """
+        A stored bundle with its arrays decoded to NumPy arrays. chunks maps the path of the chunked
+        arrays to their joined data. Numeric lists of the plain JSON layout are returned as arrays too
+    """
+    if is_array(doc):
+        data = None
+        if "data" not in doc:
+            if chunks is None or _path_name(path) not in chunks:
+                raise ValueError(f"Missing chunks of {_path_name(path)}")
+            data = chunks[_path_name(path)]
+        return decode_array(doc, data)
+    if isinstance(doc, dict):
+        return {key: decode_document(value, chunks, path + (key,)) for key, value in doc.items()}
+    if isinstance(doc, list):
+        array = as_array(doc)
+        if array is not None:
+            return array
+        return [decode_document(value, chunks, path + (index,)) for index, value in enumerate(doc)]
+    return doc
+
+def chunked_paths(doc) -> list:
+    """ the paths of the arrays of a stored document that are in the chunks collection """
+    return [_path_name(path) for path, stored in _stored_arrays(doc) if "data" not in stored]
+
+def read_chunks(chunks_collection, bundle_id, paths:list = None) -> dict:
+    """ the joined chunks of the arrays of a bundle, by path """
+    query = {"bundle_id": bundle_id}
+    if paths is not None:
+        query["path"] = {"$in": paths}
+    pieces = {}
+    for chunk in chunks_collection.find(query, {"_id": 0, "path": 1, "n": 1, "data": 1}).sort([("path", 1), ("n", 1)]):
+        pieces.setdefault(chunk["path"], []).append(bytes(chunk["data"]))
+    return {path: b"".join(data) for path, data in pieces.items()}
+
+def to_npz(decoded:dict) -> bytes:
+    """
+        A decoded bundle as an .npz file: one entry per array, named by its path, and the
+        rest of the document as JSON in the __meta__ entry
+    """
+    arrays = {}
+    def strip(value, path):
+        if isinstance(value, numpy.ndarray):
+            arrays[_path_name(path)] = value
+            return {ARRAY_FIELD: _path_name(path)}
+        if isinstance(value, dict):
+            return {key: strip(item, path + (key,)) for key, item in value.items()}
+        if isinstance(value, list):
+            return [strip(item, path + (index,)) for index, item in enumerate(value)]
+        return value
+    meta = strip(decoded, ())
+    buffer = io.BytesIO()
+    numpy.savez(buffer, __meta__=numpy.array(json.dumps(meta, default=str)), **arrays)
+    return buffer.getvalue()
@@ -0,0 +1,146 @@
+import threading, time, hashlib
+from collections import OrderedDict
+from bson import json_util
+from django.conf import settings
+from django.core.cache import caches
+from .generation import read_generation, aread_generation
+
+GENERATION_POLL_SECONDS = getattr(settings, "SUMMARY_GENERATION_POLL_SECONDS", 5)
+
+class LRUCache:
+    """
+    A bounded, thread safe LRU cache whose entries expire after ttl_seconds.
+    Keeps hit/miss/eviction counters for the stats endpoints.
+    """
+
+    def __init__(self, max_entries:int = 1024, ttl_seconds:float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+class QueryResultCache:
+    """
+    Caches query results in a bounded in-process LRU tier, in front of an optional
+    shared tier (a cache of Django's cache framework, e.g. redis or memcached).
+    Keys contain the ingestion generation, so a reload invalidates every entry.
+    """
+
+    def __init__(self, local:LRUCache, shared_alias:str = None, shared_ttl_seconds:float = 3600):
+        self.local = local
+        self.shared = caches[shared_alias] if shared_alias else None
+        self.shared_ttl_seconds = shared_ttl_seconds
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    @staticmethod
+    def make_key(generation:int, *parts) -> str:
+        canonical = json_util.dumps(parts, sort_keys=True)
+        return f"summary:result:{generation}:{hashlib.sha1(canonical.encode()).hexdigest()}"
+
+    def get(self, key:str):
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+        value = self.shared.get(key)
+        if value is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        self.local.set(key, value)
+        return value
+
+    def set(self, key:str, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, self.shared_ttl_seconds)
+
+    async def aget(self, key:str):
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+        value = await self.shared.aget(key)
+        if value is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        self.local.set(key, value)
+        return value
+
+    async def aset(self, key:str, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            await self.shared.aset(key, value, self.shared_ttl_seconds)
+
+    def stats(self) -> dict:
+        stats = {"local": self.local.stats()}
+        if self.shared is not None:
+            stats["shared"] = {"hits": self.shared_hits, "misses": self.shared_misses}
+        return stats
+
+_generation = {"value": None, "checked": 0.0}
+_generation_lock = threading.Lock()
+_generation_caches = []
+
+def register_generation_cache(cache:LRUCache) -> LRUCache:
+    """ the registered caches are cleared whenever the ingestion generation changes """
+    _generation_caches.append(cache)
+    return cache
+
+def _set_generation(value:int) -> int:
+    with _generation_lock:
+        if _generation["value"] is not None and value != _generation["value"]:
+            for cache in _generation_caches:
+                cache.clear()
+        _generation["value"] = value
+        _generation["checked"] = time.monotonic()
+    return value
+
+def current_generation(db) -> int:
+    """ the ingestion generation, read from mongodb at most every GENERATION_POLL_SECONDS """
+    if _generation["value"] is not None and time.monotonic() - _generation["checked"] < GENERATION_POLL_SECONDS:
+        return _generation["value"]
+    return _set_generation(read_generation(db))
+
+async def acurrent_generation(db) -> int:
+    """ current_generation for the databases of pymongo's AsyncMongoClient """
+    if _generation["value"] is not None and time.monotonic() - _generation["checked"] < GENERATION_POLL_SECONDS:
+        return _generation["value"]
+    return _set_generation(await aread_generation(db))
@@ -0,0 +1,404 @@
+"""
+In-memory columnar search engine for the scalar filters of the summary search.
+
+The fields the searches filter and sort on are loaded for the whole summary collection
+into NumPy columns: elements as a 128 bit mask per material (two uint64 words),
+strings as codes into their sorted unique values, numbers as float64 with NaN for
+missing values. The queries built by views._build_query are evaluated as vectorized
+mask operations: a wildcard chemsys (elements $all + nelements) is an AND of the
+element bits and a comparison of the nelements column. A document without nelements
+has NaN there and, as in mongodb, matches no wildcard chemsys. Sort and pagination are
+resolved on the columns, mongodb is only asked for the projected fields of the final page.
+
+Queries on other fields or operators raise Unsupported, and the caller falls back to
+mongodb. A snapshot belongs to one ingestion generation, a new generation is loaded
+in a background thread while the searches go to mongodb.
+"""
+import logging, math, threading, time
+import numpy
+from .filters import filter_fields
+from .formula import FORMULA_FIELD
+from .utils import get_dotted
+
+logger = logging.getLogger("summary.columnar")
+
+CATEGORICAL_FIELDS = ("material_id", "chemsys", "formula_anonymous", FORMULA_FIELD)
+# the fields of the filter registry, all numbers or booleans
+NUMERIC_FIELDS = filter_fields()
+MASK_WORDS = 2
+
+class Unsupported(Exception):
+    """ the query, sort or value can't be evaluated on the columns """
+
+class Columns:
+    """ a snapshot of the columns of one generation, only the sort orders are added after loading """
+
+    def __init__(self, generation:int, docs:list, categorical_fields:tuple, numeric_fields:tuple):
+        self.generation = generation
+        self.size = len(docs)
+        self.element_bits = {}
+        words = [[0] * self.size for _ in range(MASK_WORDS)]
+        for row, doc in enumerate(docs):
+            bits = 0
+            for element in doc.get("elements") or ():
+                bit = self.element_bits.setdefault(element, len(self.element_bits))
+                if bit >= 64 * MASK_WORDS:
+                    raise ValueError(f"More than {64 * MASK_WORDS} distinct elements")
+                bits |= 1 << bit
+            for word in range(MASK_WORDS):
+                words[word][row] = (bits >> (64 * word)) & 0xFFFFFFFFFFFFFFFF
+        self.masks = numpy.array(words, dtype=numpy.uint64).reshape(MASK_WORDS, self.size)
+        # values are codes into the sorted unique values, so codes compare like the strings
+        self.categories = {}
+        self.codes = {}
+        for field in categorical_fields:
+            values = [get_dotted(doc, field) for doc in docs]
+            present = numpy.array([value is not None for value in values], dtype=bool)
+            uniques, inverse = numpy.unique(numpy.array([value if value is not None else "" for value in values], dtype=str),
+                                            return_inverse=True)
+            codes = inverse.astype(numpy.int32)
+            codes[~present] = -1
+            self.categories[field] = uniques
+            self.codes[field] = codes
+        self._orders = {}
+        self.numbers = {}
+        self.bool_fields = set()
+        self.int_fields = set()
+        for field in numeric_fields:
+            values = [get_dotted(doc, field) for doc in docs]
+            kinds = {type(value) for value in values if value is not None}
+            if kinds == {bool}:
+                self.bool_fields.add(field)
+            elif kinds and kinds <= {int}:
+                self.int_fields.add(field)
+            elif not kinds <= {int, float}:
+                raise ValueError(f"{field} is not numeric: {kinds}")
+            self.numbers[field] = numpy.array([numpy.nan if value is None else float(value) for value in values])
+
+    def element_mask(self, elements:list):
+        """ the mask words of elements, None if one of them is in no document """
+        words = [0] * MASK_WORDS
+        for element in elements:
+            if element not in self.element_bits:
+                return None
+            bit = self.element_bits[element]
+            words[bit // 64] |= 1 << (bit % 64)
+        return [numpy.uint64(word) for word in words]
+
+    # values of the columns
+
+    def value(self, field:str, row:int):
+        """ the value of a document as mongodb returns it, for the next cursor """
+        if field in self.codes:
+            code = self.codes[field][row]
+            return None if code < 0 else str(self.categories[field][code])
+        if field in self.numbers:
+            value = self.numbers[field][row]
+            if math.isnan(value):
+                return None
+            if field in self.bool_fields:
+                return bool(value)
+            if field in self.int_fields:
+                return int(value)
+            return float(value)
+        raise Unsupported(field)
+
+    def _code(self, field:str, value):
+        # the code of a value (-1 for None), or the position it would have between two codes
+        if value is None:
+            return -1, True
+        if type(value) is not str:
+            raise Unsupported(f"{field} = {value!r}")
+        categories = self.categories[field]
+        position = int(numpy.searchsorted(categories, value))
+        return position, position < len(categories) and categories[position] == value
+
+    def _number(self, field:str, value):
+        if value is None:
+            return numpy.nan
+        if type(value) not in (int, float, bool):
+            raise Unsupported(f"{field} = {value!r}")
+        return float(value)
+
+    # masks of the query operators
+
+    def _compare(self, field:str, operator:str, value):
+        if field in self.codes:
+            codes = self.codes[field]
+            if operator == "$in":
+                found_codes = [code for code, found in (self._code(field, item) for item in value) if found]
+                if len(found_codes) <= 16:
+                    mask = numpy.zeros(self.size, dtype=bool)
+                    for code in found_codes:
+                        mask |= codes == code
+                    return mask
+                # a lookup table over the codes, its last entry is for the missing values (-1)
+                table = numpy.zeros(len(self.categories[field]) + 1, dtype=bool)
+                table[found_codes] = True
+                return table[codes]
+            if operator == "$nin":
+                return ~self._compare(field, "$in", value)
+            code, found = self._code(field, value)
+            if value is None and operator in ("$eq", "$ne"):
+                return (codes == -1) if operator == "$eq" else (codes != -1)
+            if value is None:
+                raise Unsupported(f"{operator} null")
+            present = codes >= 0
+            match operator:
+                case "$eq":
+                    return codes == code if found else numpy.zeros(self.size, dtype=bool)
+                case "$ne":
+                    return codes != code if found else numpy.ones(self.size, dtype=bool)
+                case "$gt":
+                    return present & ((codes > code) if found else (codes >= code))
+                case "$gte":
+                    return present & (codes >= code)
+                case "$lt":
+                    return present & (codes < code)
+                case "$lte":
+                    return present & ((codes <= code) if found else (codes < code))
+            raise Unsupported(operator)
+        if field in self.numbers:
+            numbers = self.numbers[field]
+            if operator in ("$in", "$nin"):
+                values = [self._number(field, item) for item in value]
+                mask = numpy.isin(numbers, [item for item in values if not math.isnan(item)])
+                if any(math.isnan(item) for item in values):
+                    mask |= numpy.isnan(numbers)
+                return mask if operator == "$in" else ~mask
+            number = self._number(field, value)
+            if math.isnan(number):
+                if operator in ("$eq", "$ne"):
+                    return numpy.isnan(numbers) if operator == "$eq" else ~numpy.isnan(numbers)
+                raise Unsupported(f"{operator} null")
+            # bools and numbers are different types for mongodb
+            if (field in self.bool_fields) != (type(value) is bool):
+                return numpy.zeros(self.size, dtype=bool) if operator != "$ne" else numpy.ones(self.size, dtype=bool)
+            match operator:
+                case "$eq":
+                    return numbers == number
+                case "$ne":
+                    return numbers != number
+                case "$gt":
+                    return numbers > number
+                case "$gte":
+                    return numbers >= number
+                case "$lt":
+                    return numbers < number
+                case "$lte":
+                    return numbers <= number
+            raise Unsupported(operator)
+        raise Unsupported(field)
+
+    def _elements(self, condition):
+        if type(condition) is str:
+            condition = {"$all": [condition]}
+        if type(condition) is not dict:
+            raise Unsupported(f"elements = {condition!r}")
+        mask = numpy.ones(self.size, dtype=bool)
+        for operator, elements in condition.items():
+            if type(elements) is not list:
+                raise Unsupported(f"elements {operator} {elements!r}")
+            match operator:
+                case "$all":
+                    words = self.element_mask(elements)
+                    if words is None or not elements:
+                        return numpy.zeros(self.size, dtype=bool)
+                    for word in range(MASK_WORDS):
+                        if words[word]:
+                            mask &= (self.masks[word] & words[word]) == words[word]
+                case "$nin":
+                    words = self.element_mask([element for element in elements if element in self.element_bits])
+                    for word in range(MASK_WORDS):
+                        if words[word]:
+                            mask &= (self.masks[word] & words[word]) == 0
+                case "$in":
+                    words = self.element_mask([element for element in elements if element in self.element_bits])
+                    any_mask = numpy.zeros(self.size, dtype=bool)
+                    for word in range(MASK_WORDS):
+                        if words[word]:
+                            any_mask |= (self.masks[word] & words[word]) != 0
+                    mask &= any_mask
+                case _:
+                    raise Unsupported(f"elements {operator}")
+        return mask
+
+    def mask(self, query_json:dict):
+        """ the rows matching a query, raises Unsupported for what the columns can't evaluate """
+        mask = numpy.ones(self.size, dtype=bool)
+        for key, condition in query_json.items():
+            if key == "$and":
+                for sub_query in condition:
+                    mask &= self.mask(sub_query)
+            elif key == "$or":
+                any_mask = numpy.zeros(self.size, dtype=bool)
+                for sub_query in condition:
+                    any_mask |= self.mask(sub_query)
+                mask &= any_mask
+            elif key == "elements":
+                mask &= self._elements(condition)
+            elif type(condition) is dict and condition and all(operator.startswith("$") for operator in condition):
+                for operator, value in condition.items():
+                    mask &= self._compare(key, operator, value)
+            elif type(condition) in (dict, list):
+                raise Unsupported(f"{key} = {condition!r}")
+            else:
+                mask &= self._compare(key, "$eq", condition)
+        return mask
+
+    # sort and keyset pagination
+
+    def _sort_key(self, field:str, direction:int, rows):
+        # (missing flag, value) keys in the order of the sort, missing values sort first
+        if field in self.codes:
+            values = self.codes[field][rows].astype(numpy.float64)
+            missing = values < 0
+        elif field in self.numbers:
+            values = self.numbers[field][rows]
+            missing = numpy.isnan(values)
+            values = numpy.where(missing, 0.0, values)
+        else:
+            raise Unsupported(f"sort on {field}")
+        if direction == 1:
+            return ~missing, values
+        return missing, -values
+
+    def sort(self, rows, sort_list:list):
+        if not sort_list:
+            return rows
+        keys = []
+        for field, direction in reversed(sort_list):
+            present_key, value_key = self._sort_key(field, direction, rows)
+            keys.extend([value_key, present_key])
+        return rows[numpy.lexsort(keys)]
+
+    def _after(self, sort_list:list, last_values:list):
+        # the rows after last_values in the sort order, as views._keyset_query
+        after = numpy.zeros(self.size, dtype=bool)
+        equal = numpy.ones(self.size, dtype=bool)
+        for (field, direction), value in zip(sort_list, last_values):
+            if field in self.codes:
+                column = self.codes[field]
+                missing = column < 0
+                code, found = self._code(field, value)
+                if value is None:
+                    greater, less, same = ~missing, numpy.zeros(self.size, dtype=bool), missing
+                else:
+                    greater = (column > code) if found else (column >= code)
+                    less = missing | (column < code)
+                    same = (column == code) if found else numpy.zeros(self.size, dtype=bool)
+            elif field in self.numbers:
+                column = self.numbers[field]
+                missing = numpy.isnan(column)
+                number = self._number(field, value)
+                if value is None:
+                    greater, less, same = ~missing, numpy.zeros(self.size, dtype=bool), missing
+                else:
+                    greater, less, same = column > number, (column < number) | missing, column == number
+            else:
+                raise Unsupported(f"sort on {field}")
+            after |= equal & (greater if direction == 1 else less)
+            equal &= same
+        return after
+
+    def select(self, query_json:dict, sort_list:list, skip:int = 0, limit:int = 15, last_values:list = None):
+        """
+            The rows of a page and the number of documents matching the query.
+            With last_values (keyset pagination) the page starts after them and skip is ignored
+        """
+        mask = self.mask(query_json)
+        total = int(numpy.count_nonzero(mask))
+        if last_values is not None:
+            if len(last_values) != len(sort_list):
+                raise Unsupported("cursor of another sort")
+            mask = mask & self._after(sort_list, last_values)
+            skip = 0
+        if not sort_list:
+            return numpy.flatnonzero(mask)[skip:skip + limit], total
+        # the matching rows in the order of the first sort key, the other keys only need
+        # to order the rows up to the end of the page and the ones tied with its last row
+        order = self.order(*sort_list[0])
+        end = skip + limit
+        rows = self._ordered_prefix(mask, order, end)
+        if len(sort_list) > 1 and end < len(rows):
+            present_key, value_key = self._sort_key(sort_list[0][0], sort_list[0][1], rows[end - 1:])
+            tied = (present_key == present_key[0]) & (value_key == value_key[0])
+            if tied.all():
+                # the ties may go on after the prefix
+                rows = order[mask[order]]
+                present_key, value_key = self._sort_key(sort_list[0][0], sort_list[0][1], rows[end - 1:])
+                tied = (present_key == present_key[0]) & (value_key == value_key[0])
+            num_tied = len(tied) if tied.all() else int(numpy.argmin(tied))
+            rows = rows[:end - 1 + num_tied]
+        if len(sort_list) > 1:
+            rows = self.sort(rows, sort_list)
+        return rows[skip:end], total
+
+    def _ordered_prefix(self, mask, order, count:int):
+        """ at least the first count matching rows in order (all of them if fewer), read from the order in growing chunks """
+        parts = []
+        num_rows = 0
+        start = 0
+        chunk = max(1024, 4 * count)
+        while start < self.size and num_rows < count:
+            part = order[start:start + chunk]
+            part = part[mask[part]]
+            parts.append(part)
+            num_rows += len(part)
+            start += chunk
+            chunk *= 2
+        return numpy.concatenate(parts) if parts else order[:0]
+
+    def order(self, field:str, direction:int):
+        """ every row in the order of a sort on field, computed at the first sort on it """
+        if (field, direction) not in self._orders:
+            self._orders[(field, direction)] = self.sort(numpy.arange(self.size), [(field, direction)])
+        return self._orders[(field, direction)]
+
+class ColumnarEngine:
+    """
+        Keeps the Columns of the current generation of a collection, loading a new one in
+        a background thread when the generation changes
+    """
+
+    def __init__(self, collection, categorical_fields:tuple = CATEGORICAL_FIELDS, numeric_fields:tuple = NUMERIC_FIELDS):
+        self.collection = collection
+        self.categorical_fields = tuple(categorical_fields)
+        self.numeric_fields = tuple(numeric_fields)
+        self.columns = None
+        self.failed_generation = None
+        self._loading = None
+        self._lock = threading.Lock()
+
+    def load(self, generation:int) -> Columns:
+        start_time = time.perf_counter()
+        projection = {"_id": 0, "elements": 1}
+        projection.update({field: 1 for field in self.categorical_fields + self.numeric_fields})
+        docs = list(self.collection.find({}, projection, batch_size=10000))
+        columns = Columns(generation, docs, self.categorical_fields, self.numeric_fields)
+        self.columns = columns
+        logger.info("columns of %d documents of generation %d loaded in %.1fs", columns.size, generation,
+                    time.perf_counter() - start_time)
+        return columns
+
+    def _load_in_background(self, generation:int):
+        try:
+            self.load(generation)
+        except Exception:
+            # e.g. a field that isn't numeric: this generation is served by mongodb
+            logger.exception("columns of generation %d could not be loaded", generation)
+            self.failed_generation = generation
+        finally:
+            with self._lock:
+                self._loading = None
+
+    def ready(self, generation:int) -> Columns:
+        """ the Columns of the generation, None (and a load is started) if they are not loaded yet """
+        columns = self.columns
+        if columns is not None and columns.generation == generation:
+            return columns
+        with self._lock:
+            if self._loading is None and self.failed_generation != generation:
+                self._loading = threading.Thread(target=self._load_in_background, args=(generation,), daemon=True)
+                self._loading.start()
+        return None
@@ -0,0 +1,170 @@
+"""
+Precomputed payloads of the material detail view.
+
+Symmetry data, Wyckoff sites and the crystal toolkit scene of a structure take from
+hundreds of ms to seconds to compute, so they are computed once per material (by
+Matproj_db_migrator.precompute_details after an ingestion, or on demand for a miss)
+and stored in the DETAIL_COLLECTION side collection, keyed on material_id.
+
+pymatgen and crystal toolkit are only imported when a payload is computed.
+"""
+import hashlib
+from bson import json_util
+from .utils import float_to_fraction, replace_nd_array
+from .partition import read_split, split_projection, join_split
+
+DETAIL_COLLECTION = "summary_detail"
+# bump when the payload changes, the stored payloads of older versions are recomputed
+DETAIL_VERSION = 1
+# fields of the summary document the payload is computed from
+SUMMARY_PROJECTION = {
+    "_id": 0,
+    "material_id": 1,
+    "formula_pretty": 1,
+    "energy_above_hull": 1,
+    "symmetry.symbol": 1,
+    "band_gap": 1,
+    "formation_energy_per_atom": 1,
+    "ordering": 1,
+    "total_magnetization": 1,
+    "theoretical": 1,
+    "structure": 1,
+}
+MAGNETIC_ORDERING = {
+    'NM': 'Non-magnetic',
+    'FM': 'Ferro-magnetic',
+    'FiM': 'Ferrimagnetic',
+    'AFM': 'Antiferromagnetic',
+}
+
+def input_hash(summary_doc:dict, description:dict = None) -> str:
+    """
+        md5 of everything a payload is computed from, so the batch job only recomputes
+        the materials that changed since the stored payload
+    """
+    canonical = json_util.dumps([DETAIL_VERSION, summary_doc, description], sort_keys=True)
+    return hashlib.md5(canonical.encode()).hexdigest()
+
+def _summary_data(summary_doc:dict) -> dict:
+    return {
+        'Energy Above Hull': f"{summary_doc['energy_above_hull']:.3f} eV/atom",
+        'Space Group': f"{summary_doc['symmetry']['symbol']}",
+        'Band Gap': f"{summary_doc['band_gap']:.2f} eV",
+        'Predicted Formation Energy': f"{summary_doc['formation_energy_per_atom']:.3f} eV/atom",
+        'Magnetic Ordering': MAGNETIC_ORDERING.get(summary_doc.get('ordering'), summary_doc.get('ordering')),
+        'Total Magnetization': f"{summary_doc['total_magnetization']:.2f} µB/f.u.",
+        'Experimentally Observed': 'No' if summary_doc['theoretical'] else 'Yes',
+    }
+
+def _lattice_data(lattice:dict) -> dict:
+    return {
+        'a': f"{lattice['a']:.2f} Å",
+        'b': f"{lattice['b']:.2f} Å",
+        'c': f"{lattice['c']:.2f} Å",
+        'α': f"{lattice['alpha']:.2f} º",
+        'β': f"{lattice['beta']:.2f} º",
+        'ɣ': f"{lattice['gamma']:.2f} º",
+    }
+
+def _scene_data(pymat_structure) -> tuple:
+    import crystal_toolkit.components as ctc
+    structure_component = ctc.StructureMoleculeComponent(pymat_structure, id="my_structure")
+    scene_data = structure_component.initial_data['scene']
+    legend_data = structure_component.initial_data['legend_data']
+    # stored in mongodb, so no numpy arrays
+    replace_nd_array(scene_data)
+    return scene_data, legend_data
+
+def _symmetry_data(pymat_structure) -> tuple:
+    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+    sg_analyzer = SpacegroupAnalyzer(pymat_structure)
+    sym_dataset = sg_analyzer.get_symmetry_dataset()
+    # spglib >= 2.5 returns a dataclass instead of a dict
+    get = sym_dataset.get if isinstance(sym_dataset, dict) else lambda key: getattr(sym_dataset, key)
+    sym_data = {
+        "Crystal System": sg_analyzer.get_crystal_system().capitalize(),
+        "Lattice System": sg_analyzer.get_lattice_type().capitalize(),
+        "Hall Number": get('hall'),
+        "International Number": int(get('number')),
+        "Symbol": get('international'),
+        "Point Group": get('pointgroup'),
+    }
+    sym_struct = sg_analyzer.get_symmetrized_structure()
+    wyckoff_data = sorted(
+                          zip(sym_struct.wyckoff_symbols, sym_struct.equivalent_sites),
+                          key=lambda x: "".join(filter(str.isalpha, x[0])),
+                         )
+    wyckoff_sites = []
+    for site_symbol, sym_sites in wyckoff_data:
+        wyckoff_site = sym_sites[0]
+        wyckoff_sites.append({
+                "Wyckoff": site_symbol,
+                "Element": f"{wyckoff_site.specie}",
+                "x": float_to_fraction(wyckoff_site.a),
+                "y": float_to_fraction(wyckoff_site.b),
+                "z": float_to_fraction(wyckoff_site.c),
+            })
+    return sym_data, wyckoff_sites
+
+def compute_detail(summary_doc:dict, description:dict = None) -> dict:
+    """
+        The detail payload of a material from its summary document (SUMMARY_PROJECTION)
+        and its robocrys description
+    """
+    from pymatgen.core import Structure
+    pymat_structure = Structure.from_dict(summary_doc['structure'])
+    scene_data, legend_data = _scene_data(pymat_structure)
+    sym_data, wyckoff_sites = _symmetry_data(pymat_structure)
+    return {
+        "summary_data": _summary_data(summary_doc),
+        "lattice_data": _lattice_data(summary_doc['structure']['lattice']),
+        "scene_data": scene_data,
+        "legend_data": legend_data,
+        "description": description,
+        "sym_data": sym_data,
+        "wyckoff_sites": wyckoff_sites,
+    }
+
+def detail_doc(summary_doc:dict, description:dict = None) -> dict:
+    """ the document of DETAIL_COLLECTION for a material """
+    return {
+        "material_id": summary_doc["material_id"],
+        "version": DETAIL_VERSION,
+        "input_hash": input_hash(summary_doc, description),
+        "data": compute_detail(summary_doc, description),
+    }
+
+def compute_detail_docs(inputs:list) -> list:
+    """
+        detail_doc of every (summary_doc, description) pair, the unit of work of the batch job.
+        A material that fails is returned as {"material_id", "error"} instead of failing the batch
+    """
+    docs = []
+    for summary_doc, description in inputs:
+        try:
+            docs.append(detail_doc(summary_doc, description))
+        except Exception as error:
+            docs.append({"material_id": summary_doc.get("material_id"), "error": f"{type(error).__name__}: {error}"})
+    return docs
+
+def find_detail(db, material_id:str) -> dict:
+    """ the stored payload of a material, None if it is missing or of an older version """
+    doc = db[DETAIL_COLLECTION].find_one({"material_id": material_id, "version": DETAIL_VERSION}, {"_id": 0, "data": 1})
+    return doc["data"] if doc else None
+
+def compute_and_store_detail(db, material_id:str) -> dict:
+    """
+        Computes the payload of a material that has none stored and writes it back.
+        Returns None if the material doesn't exist
+    """
+    split = read_split(db, 'summary')
+    summary_projection, heavy_projection, added_key = split_projection(SUMMARY_PROJECTION, split)
+    summary_doc = db['summary'].find_one({"material_id": material_id}, summary_projection)
+    if summary_doc is None:
+        return None
+    if heavy_projection is not None:
+        join_split(db[split["companion"]], split, [summary_doc], heavy_projection, added_key)
+    description = db['robocrys'].find_one({"material_id": material_id}, {"_id": 0, "description": 1})
+    doc = detail_doc(summary_doc, description)
+    db[DETAIL_COLLECTION].replace_one({"material_id": material_id}, doc, upsert=True)
+    return doc["data"]
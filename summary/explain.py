@@ -0,0 +1,96 @@
+"""
+Explain output of the summary searches and the slow query log.
+"""
+import logging, threading, time
+from collections import deque
+from django.conf import settings
+
+SLOW_QUERY_MS = getattr(settings, "SUMMARY_SLOW_QUERY_MS", 500)
+SLOW_QUERY_VERBOSITY = getattr(settings, "SUMMARY_SLOW_QUERY_VERBOSITY", "queryPlanner")
+SLOW_QUERY_LOG_SIZE = getattr(settings, "SUMMARY_SLOW_QUERY_LOG_SIZE", 100)
+
+slow_query_logger = logging.getLogger("summary.slow_queries")
+
+def explain_command(collection_name:str, pipeline:list) -> dict:
+    return {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}}
+
+def _find_query_planner(explain):
+    # the plan is at the top level when the whole pipeline runs in the query layer,
+    # else in the $cursor stage of the pipeline
+    if type(explain) is dict:
+        if "queryPlanner" in explain:
+            return explain
+        for value in explain.values():
+            found = _find_query_planner(value)
+            if found is not None:
+                return found
+    elif type(explain) is list:
+        for value in explain:
+            found = _find_query_planner(value)
+            if found is not None:
+                return found
+    return None
+
+def _plan_stages(plan:dict, stages:list, indexes:list):
+    stage = plan.get("stage", "?")
+    if "indexName" in plan:
+        indexes.append({"name": plan["indexName"], "keys": plan.get("keyPattern")})
+        stage += f" {plan['indexName']}"
+    stages.append(stage)
+    if "inputStage" in plan:
+        _plan_stages(plan["inputStage"], stages, indexes)
+    for input_stage in plan.get("inputStages", []):
+        _plan_stages(input_stage, stages, indexes)
+
+def plan_summary(explain:dict) -> dict:
+    """
+    Summarizes the explain output of an aggregation
+
+    Returns:
+        dict: the stages of the winning plan, the indexes it uses, and the numbers of
+              keys and documents examined vs returned when the explain has execution stats
+    """
+    planner = _find_query_planner(explain)
+    if planner is None:
+        return {"winning_plan": [], "indexes": [], "collection_scan": None}
+    winning_plan = planner["queryPlanner"].get("winningPlan", {})
+    # slot based execution nests the classic plan in queryPlan
+    winning_plan = winning_plan.get("queryPlan", winning_plan)
+    stages, indexes = [], []
+    _plan_stages(winning_plan, stages, indexes)
+    summary = {
+        "winning_plan": stages,
+        "indexes": indexes,
+        "collection_scan": "COLLSCAN" in stages,
+    }
+    execution_stats = planner.get("executionStats")
+    if execution_stats:
+        summary.update({
+            "keys_examined": execution_stats.get("totalKeysExamined"),
+            "docs_examined": execution_stats.get("totalDocsExamined"),
+            "docs_returned": execution_stats.get("nReturned"),
+            "execution_ms": execution_stats.get("executionTimeMillis"),
+        })
+    return summary
+
+class SlowQueryLog:
+    """ logs the searches slower than SLOW_QUERY_MS and keeps the latest ones in memory """
+
+    def __init__(self, max_entries:int = SLOW_QUERY_LOG_SIZE):
+        self.entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    def is_slow(self, seconds:float) -> bool:
+        return SLOW_QUERY_MS is not None and seconds * 1000 >= SLOW_QUERY_MS
+
+    def add(self, route:str, shape:str, seconds:float, plan:dict):
+        entry = {"time": time.time(), "route": route, "shape": shape, "ms": round(seconds * 1000, 2), "plan": plan}
+        with self._lock:
+            self.entries.append(entry)
+        slow_query_logger.warning("slow query on %s (%.0f ms): %s plan=%s", route, seconds * 1000, shape, plan)
+
+    def latest(self) -> list:
+        with self._lock:
+            return list(self.entries)
+
+slow_query_log = SlowQueryLog()
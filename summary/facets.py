@@ -0,0 +1,104 @@
+"""
+Registry of the facets of the summary search: the distributions a client shows next to
+the results (counts by number of elements, by element, by crystal system, histograms
+of band gap and energy above hull).
+
+facet_pipeline() computes the requested facets of a search in one aggregation: a single
+$match with the query of views._build_query, a $project of the fields the facets read,
+and a $facet with one sub-pipeline per facet. "terms" facets count the values of a field,
+"unwind" facets the values of an array field, "histogram" facets the values of a number
+field in buckets of a fixed width. A histogram keeps its first max_bins buckets, the
+facets that had more are listed in the "truncated" meta of the response.
+"""
+import math
+from typing import NamedTuple
+from .filters import FilterError
+
+class Facet(NamedTuple):
+    name: str
+    field: str
+    kind: str
+    bin_width: float = None
+    max_bins: int = 200
+
+FACETS = (
+    Facet("nelements", "nelements", "terms"),
+    Facet("elements", "elements", "unwind"),
+    Facet("crystal_system", "symmetry.crystal_system", "terms"),
+    Facet("band_gap", "band_gap", "histogram", 0.5),
+    Facet("energy_above_hull", "energy_above_hull", "histogram", 0.05),
+    Facet("is_stable", "is_stable", "terms"),
+    Facet("is_metal", "is_metal", "terms"),
+)
+FACETS_BY_NAME = {facet.name: facet for facet in FACETS}
+DEFAULT_FACETS = ("nelements", "elements", "crystal_system", "band_gap")
+
+def parse_facets(query_params) -> dict:
+    """
+        The requested facets ({name: bin width}) of the facets and <name>_bin parameters,
+        raises FilterError for unknown facets or invalid widths
+    """
+    names = [name.strip() for name in query_params.get("facets", ",".join(DEFAULT_FACETS)).split(",") if name.strip()]
+    facets = {}
+    for name in names:
+        if name not in FACETS_BY_NAME:
+            raise FilterError(f"Unknown facet {name!r}, expected some of {', '.join(FACETS_BY_NAME)}")
+        facet = FACETS_BY_NAME[name]
+        bin_width = None
+        if facet.kind == "histogram":
+            try:
+                bin_width = float(query_params.get(f"{name}_bin", facet.bin_width))
+            except ValueError:
+                raise FilterError(f"{name}_bin must be a number, got {query_params[f'{name}_bin']!r}")
+            if not math.isfinite(bin_width) or bin_width <= 0:
+                raise FilterError(f"{name}_bin must be positive, got {bin_width}")
+        facets[name] = bin_width
+    if not facets:
+        raise FilterError("No facets requested")
+    return facets
+
+def _facet_stages(facet:Facet, bin_width:float) -> list:
+    field = "$" + facet.field
+    match facet.kind:
+        case "terms":
+            return [{"$group": {"_id": field, "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1, "_id": 1}}]
+        case "unwind":
+            return [{"$unwind": field},
+                    {"$group": {"_id": field, "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1, "_id": 1}}]
+        case "histogram":
+            return [{"$match": {facet.field: {"$type": "number"}}},
+                    {"$group": {"_id": {"$floor": {"$divide": [field, bin_width]}}, "count": {"$sum": 1}}},
+                    {"$sort": {"_id": 1}},
+                    # one bucket more than kept, to tell a truncated histogram
+                    {"$limit": facet.max_bins + 1}]
+
+def facet_pipeline(query_json:dict, facets:dict) -> list:
+    """ the aggregation of the requested facets ({name: bin width}) of a search, plus its total """
+    stages = {"total": [{"$count": "count"}]}
+    projection = {"_id": 0}
+    for name, bin_width in facets.items():
+        facet = FACETS_BY_NAME[name]
+        stages[name] = _facet_stages(facet, bin_width)
+        projection[facet.field] = 1
+    return [{"$match": query_json}, {"$project": projection}, {"$facet": stages}]
+
+def facet_results(result:dict, facets:dict) -> dict:
+    """ the response of the output document of facet_pipeline """
+    data = {}
+    truncated = []
+    for name, bin_width in facets.items():
+        facet = FACETS_BY_NAME[name]
+        if facet.kind == "histogram":
+            buckets = result[name]
+            if len(buckets) > facet.max_bins:
+                buckets = buckets[:facet.max_bins]
+                truncated.append(name)
+            data[name] = [{"min": round(bucket["_id"] * bin_width, 10), "max": round((bucket["_id"] + 1) * bin_width, 10),
+                           "count": bucket["count"]}
+                          for bucket in buckets]
+        else:
+            data[name] = [{"value": bucket["_id"], "count": bucket["count"]} for bucket in result[name]]
+    total = result["total"][0]["count"] if result["total"] else 0
+    return {"data": data, "meta": {"total_doc": total, "truncated": truncated}}
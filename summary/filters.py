@@ -0,0 +1,96 @@
+"""
+Registry of the property filters of the summary search.
+
+Every FilterField adds <name>_min, <name>_max and <name>_eq parameters (as listed in its
+operators) to the search. The parameters of a request are compiled into a mongodb query
+by a plan that is cached per parameter shape, i.e. the set of filter parameters present,
+so only the values are parsed per request. The same registry drives the indexes
+s3_migrator builds (a filter on an indexed field plus a sort on material_id is served by
+a single (field, material_id) index) and the columns of the columnar engine.
+"""
+import functools, math
+from typing import NamedTuple
+
+class FilterError(ValueError):
+    """ a filter parameter with an invalid value """
+
+class FilterField(NamedTuple):
+    name: str
+    field: str
+    type: type
+    operators: tuple = ("min", "max", "eq")
+    indexed: bool = True
+    minimum: float = None
+
+FILTER_FIELDS = (
+    FilterField("nelements", "nelements", int, minimum=0),
+    FilterField("nsites", "nsites", int, minimum=0),
+    FilterField("band_gap", "band_gap", float, ("min", "max"), minimum=0),
+    FilterField("energy_above_hull", "energy_above_hull", float, ("min", "max"), minimum=0),
+    FilterField("formation_energy_per_atom", "formation_energy_per_atom", float, ("min", "max")),
+    FilterField("energy_per_atom", "energy_per_atom", float, ("min", "max"), indexed=False),
+    FilterField("density", "density", float, ("min", "max"), minimum=0),
+    FilterField("volume", "volume", float, ("min", "max"), minimum=0),
+    FilterField("total_magnetization", "total_magnetization", float, ("min", "max"), indexed=False),
+    FilterField("is_stable", "is_stable", bool, ("eq",)),
+    FilterField("is_metal", "is_metal", bool, ("eq",), indexed=False),
+    FilterField("is_gap_direct", "is_gap_direct", bool, ("eq",), indexed=False),
+    FilterField("theoretical", "theoretical", bool, ("eq",), indexed=False),
+)
+
+MONGO_OPERATORS = {"min": "$gte", "max": "$lte", "eq": "$eq"}
+
+# parameter -> (filter field, operator)
+FILTER_PARAMS = {f"{filter_field.name}_{operator}": (filter_field, operator)
+                 for filter_field in FILTER_FIELDS for operator in filter_field.operators}
+
+def _parse(filter_field:FilterField, param:str, value:str):
+    value = value.strip()
+    try:
+        if filter_field.type is bool:
+            if value.lower() not in ("true", "1", "false", "0"):
+                raise ValueError(value)
+            return value.lower() in ("true", "1")
+        parsed = filter_field.type(value)
+    except ValueError:
+        raise FilterError(f"{param} must be {'a boolean' if filter_field.type is bool else 'an integer' if filter_field.type is int else 'a number'}, got {value!r}")
+    if filter_field.type is float and not math.isfinite(parsed):
+        raise FilterError(f"{param} must be finite, got {value!r}")
+    if filter_field.minimum is not None and parsed < filter_field.minimum:
+        raise FilterError(f"{param} must be at least {filter_field.minimum}, got {value!r}")
+    return parsed
+
+@functools.lru_cache(maxsize=1024)
+def compile_plan(params:tuple) -> tuple:
+    """
+        The plan of a parameter shape: (field, [(param, filter field, mongodb operator), ...]) per filtered field
+    """
+    plan = {}
+    for param in params:
+        filter_field, operator = FILTER_PARAMS[param]
+        plan.setdefault(filter_field.field, []).append((param, filter_field, MONGO_OPERATORS[operator]))
+    return tuple((field, tuple(steps)) for field, steps in plan.items())
+
+def compile_filters(query_params) -> dict:
+    """
+        The mongodb query of the filter parameters of a request, raises FilterError for invalid values
+
+    Example usage:
+        compile_filters({"band_gap_min": "1", "band_gap_max": "3", "is_stable_eq": "true"})
+        >> {"band_gap": {"$gte": 1.0, "$lte": 3.0}, "is_stable": {"$eq": True}}
+    """
+    query_json = {}
+    for field, steps in compile_plan(tuple(sorted(param for param in query_params if param in FILTER_PARAMS))):
+        condition = {operator: _parse(filter_field, param, query_params[param]) for param, filter_field, operator in steps}
+        if "$gte" in condition and "$lte" in condition and condition["$gte"] > condition["$lte"]:
+            raise FilterError(f"{field} minimum is larger than its maximum")
+        query_json[field] = condition
+    return query_json
+
+def filter_index_specs(ascending:int = 1) -> list:
+    """ the (field, material_id) indexes of the indexed filter fields """
+    return [[(filter_field.field, ascending), ("material_id", ascending)] for filter_field in FILTER_FIELDS if filter_field.indexed]
+
+def filter_fields() -> tuple:
+    """ the document fields of the registry """
+    return tuple(dict.fromkeys(filter_field.field for filter_field in FILTER_FIELDS))
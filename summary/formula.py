@@ -0,0 +1,167 @@
+"""
+Chemical formula parsing and the canonical reduced formula of exact formula searches.
+
+parse_formula() reads nested groups ("Ca3(PO4)2", "[Co(NH3)6]Cl3"), hydrates separated
+by a middle dot with an optional multiplier ("CuSO4·5H2O") and decimal or fractional
+amounts ("Li0.5CoO2", "Fe1/3O"). reduced_formula() scales the amounts to the smallest
+integers and writes the elements in alphabetical order, so every way of writing a
+composition has a single canonical string: "Fe4O6", "O3Fe2" and "Fe2O3" are all "Fe2O3".
+
+s3_migrator stores it in FORMULA_FIELD of every summary document (indexed), and
+views._build_query turns a formula search into an equality on that field.
+"""
+import functools, math, re
+from fractions import Fraction
+from .filters import FilterError
+
+FORMULA_FIELD = "formula_reduced"
+
+ELEMENTS = frozenset("""
+H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr
+Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb
+Lu Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr Rf
+Db Sg Bh Hs Mt Ds Rg Cn Nh Fl Mc Lv Ts Og D T
+""".split())
+
+HYDRATE_SEPARATORS = "·•∙⋅"
+_OPEN = {"(": ")", "[": "]", "{": "}"}
+_TOKENS = re.compile(r"""
+    (?P<element>[A-Z][a-z]?)
+  | (?P<number>\d+/\d+|\d+(?:\.\d+)?|\.\d+)
+  | (?P<open>[(\[{])
+  | (?P<close>[)\]}])
+  | (?P<separator>[""" + HYDRATE_SEPARATORS + r"""])
+""", re.VERBOSE)
+
+class FormulaError(FilterError):
+    """ a formula that can't be parsed """
+
+def _tokenize(formula:str) -> list:
+    tokens = []
+    position = 0
+    formula = "".join(formula.split())
+    while position < len(formula):
+        match = _TOKENS.match(formula, position)
+        if match is None:
+            raise FormulaError(f"Invalid formula {formula!r}: unexpected {formula[position]!r} at {position}")
+        tokens.append((match.lastgroup, match.group()))
+        position = match.end()
+    return tokens
+
+def _amount(text:str) -> Fraction:
+    try:
+        amount = Fraction(text)
+    except (ValueError, ZeroDivisionError):
+        raise FormulaError(f"Invalid amount {text!r}")
+    if amount <= 0:
+        raise FormulaError(f"Invalid amount {text!r}, amounts must be positive")
+    return amount
+
+class _Parser:
+    def __init__(self, formula:str):
+        self.formula = formula
+        self.tokens = _tokenize(formula)
+        self.position = 0
+
+    def peek(self) -> str:
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self) -> str:
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def count(self) -> Fraction:
+        return _amount(self.take()) if self.peek() == "number" else Fraction(1)
+
+    def groups(self) -> dict:
+        # element or bracketed groups, each with an optional count, until a closing bracket or a separator
+        components = {}
+        while self.peek() in ("element", "open"):
+            if self.peek() == "element":
+                element = self.take()
+                if element not in ELEMENTS:
+                    raise FormulaError(f"Invalid formula {self.formula!r}: unknown element {element}")
+                group = {element: Fraction(1)}
+            else:
+                close = _OPEN[self.take()]
+                group = self.groups()
+                if self.peek() != "close" or self.take() != close:
+                    raise FormulaError(f"Invalid formula {self.formula!r}: missing {close!r}")
+            count = self.count()
+            for element, amount in group.items():
+                components[element] = components.get(element, 0) + amount * count
+        if not components:
+            raise FormulaError(f"Invalid formula {self.formula!r}: expected an element")
+        return components
+
+    def parse(self) -> dict:
+        components = {}
+        while True:
+            # the multiplier of a hydrate part, e.g. the 5 of ·5H2O
+            multiplier = self.count()
+            for element, amount in self.groups().items():
+                components[element] = components.get(element, 0) + amount * multiplier
+            if self.peek() != "separator":
+                break
+            self.take()
+        if self.position != len(self.tokens):
+            raise FormulaError(f"Invalid formula {self.formula!r}: unexpected {self.tokens[self.position][1]!r}")
+        return components
+
+def parse_formula(formula:str) -> dict:
+    """
+        The amount of every element of a formula, as Fractions
+
+    Example usage:
+        parse_formula("CuSO4·5H2O")
+        >> {'Cu': Fraction(1, 1), 'S': Fraction(1, 1), 'O': Fraction(9, 1), 'H': Fraction(10, 1)}
+    """
+    return _Parser(formula).parse()
+
+def reduced_formula(components:dict) -> str:
+    """
+        The canonical reduced formula of a composition ({element: amount}): the smallest
+        integer amounts, elements in alphabetical order
+
+    Example usage:
+        reduced_formula({"O": 6, "Fe": 4})
+        >> 'Fe2O3'
+    """
+    # float amounts (e.g. 0.3333333 of a disordered site) are read as the nearest simple fraction,
+    # integers and fractions (of parse_formula) are exact
+    amounts = {element: Fraction(amount) if isinstance(amount, (int, Fraction)) else Fraction(amount).limit_denominator(1000)
+               for element, amount in components.items() if amount}
+    if not amounts:
+        raise FormulaError("Empty composition")
+    scale = math.lcm(*(amount.denominator for amount in amounts.values()))
+    integers = {element: int(amount * scale) for element, amount in amounts.items()}
+    divisor = math.gcd(*integers.values())
+    return "".join(element + (str(amount // divisor) if amount != divisor else "")
+                   for element, amount in sorted(integers.items()))
+
+@functools.lru_cache(maxsize=4096)
+def canonical_formula(formula:str) -> str:
+    """ reduced_formula of a formula string, memoized for the searches """
+    return reduced_formula(parse_formula(formula))
+
+def formula_of_document(doc:dict) -> str:
+    """
+        The canonical reduced formula of a summary document, from its composition if it
+        has one, else from formula_pretty. None if it has neither
+    """
+    composition = doc.get("composition_reduced") or doc.get("composition")
+    if isinstance(composition, dict) and composition:
+        return reduced_formula(composition)
+    if doc.get("formula_pretty"):
+        return canonical_formula(doc["formula_pretty"])
+    return None
+
+def add_formula_field(doc:dict) -> dict:
+    """ sets FORMULA_FIELD of a summary document, in place. A document whose formula can't be parsed is left as is """
+    try:
+        formula = formula_of_document(doc)
+    except (FormulaError, TypeError, ValueError):
+        return doc
+    if formula is not None:
+        doc[FORMULA_FIELD] = formula
+    return doc
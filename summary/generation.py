@@ -0,0 +1,32 @@
+"""
+The ingestion generation is a counter in matproj_s3 that s3_migrator bumps
+whenever an ingestion run completes. Everything the summary API caches is
+tied to a generation, so a reload invalidates all of it at once.
+"""
+from pymongo import ReturnDocument
+
+META_COLLECTION = "ingestion_meta"
+GENERATION_ID = "generation"
+# bookkeeping fields s3_migrator adds to the documents it ingests: the shard a document was
+# read from (to resume an interrupted run) and the hash of its content (for incremental updates)
+SHARD_TAG_FIELD = "_source_shard"
+CONTENT_HASH_FIELD = "_content_hash"
+INGESTION_FIELDS = (SHARD_TAG_FIELD, CONTENT_HASH_FIELD)
+
+def read_generation(db) -> int:
+    doc = db[META_COLLECTION].find_one({"_id": GENERATION_ID})
+    return doc["value"] if doc else 0
+
+async def aread_generation(db) -> int:
+    """ read_generation for the databases of pymongo's AsyncMongoClient """
+    doc = await db[META_COLLECTION].find_one({"_id": GENERATION_ID})
+    return doc["value"] if doc else 0
+
+def bump_generation(db) -> int:
+    doc = db[META_COLLECTION].find_one_and_update(
+        {"_id": GENERATION_ID},
+        {"$inc": {"value": 1}, "$currentDate": {"updated": True}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return doc["value"]
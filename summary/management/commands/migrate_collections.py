@@ -0,0 +1,55 @@
+"""
+Runs a declarative migration spec (see s3_migrator.Migration_orchestrator) with the jobs
+running concurrently, a shared write-throughput cap, progress/ETA reports and a final
+summary table.
+
+    python manage.py migrate_collections spec.json --concurrency 6 --max-write-mb 80
+"""
+import json
+from django.core.management.base import BaseCommand, CommandError
+from s3_migrator import Migration_orchestrator
+
+class Command(BaseCommand):
+    help = "Migrates the collections of a JSON job spec concurrently into mongodb"
+
+    def add_arguments(self, parser):
+        parser.add_argument("spec", help="path of the JSON job spec")
+        parser.add_argument("--concurrency", type=int, help="jobs running at the same time (overrides the spec)")
+        parser.add_argument("--max-write-mb", type=float, help="MB/s of json written by all the jobs together (overrides the spec)")
+        parser.add_argument("--progress-interval", type=float, default=10.0, help="seconds between progress reports")
+        parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            with open(options["spec"]) as f:
+                spec = json.load(f)
+        except (OSError, ValueError) as error:
+            raise CommandError(f"Can't read the spec {options['spec']}: {error}")
+        if options["concurrency"] is not None:
+            spec["concurrency"] = options["concurrency"]
+        if options["max_write_mb"] is not None:
+            spec["max_write_mb_per_s"] = options["max_write_mb"]
+        try:
+            orchestrator = Migration_orchestrator(spec, print_fn=self.stdout.write)
+        except (KeyError, ValueError, OSError) as error:
+            raise CommandError(f"Invalid spec: {error!r}")
+        results = orchestrator.run(options["progress_interval"])
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.print_summary(results)
+        failed = [result["job"] for result in results if result["status"] != "done"]
+        if failed:
+            raise CommandError(f"{len(failed)} jobs failed: {', '.join(failed)}")
+
+    def print_summary(self, results):
+        self.stdout.write(f"{'job':<40}{'status':>8}{'docs':>14}{'MB':>11}{'input MB':>11}{'seconds':>10}{'docs/s':>10}")
+        for result in results:
+            self.stdout.write(f"{result['job']:<40}{result['status']:>8}{result['docs']:>14,}{result['mb']:>11.1f}"
+                              f"{result['input_mb']:>11.1f}{result['seconds']:>10.1f}{result['docs_per_s']:>10.0f}")
+        total_docs = sum(result["docs"] for result in results)
+        self.stdout.write(f"{'total':<40}{'':>8}{total_docs:>14,}{sum(result['mb'] for result in results):>11.1f}"
+                          f"{sum(result['input_mb'] for result in results):>11.1f}")
+        for result in results:
+            if result["error"]:
+                self.stdout.write(self.style.ERROR(f"{result['job']}: {result['error']}"))
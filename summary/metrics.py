@@ -0,0 +1,120 @@
+"""
+Per-stage latency instrumentation of the summary API.
+
+Every request times its stages (parameter parsing, query compilation, mongo,
+serialization) with a StageTimer. The timings are always sent in the Server-Timing
+header and, for a sampled fraction of the requests, recorded into latency
+histograms per route and query shape, scraped from summary/metrics/ in the
+Prometheus text format.
+"""
+import random, threading, time
+from collections import deque
+from contextlib import contextmanager
+from bson import json_util
+from django.conf import settings
+
+SAMPLE_RATE = getattr(settings, "SUMMARY_METRICS_SAMPLE_RATE", 1.0)
+RESERVOIR_SIZE = getattr(settings, "SUMMARY_METRICS_RESERVOIR_SIZE", 1024)
+MAX_SHAPES = getattr(settings, "SUMMARY_METRICS_MAX_SHAPES", 200)
+QUANTILES = (0.5, 0.95, 0.99)
+
+def query_shape(query_json) -> str:
+    """
+    The query with every value replaced by "?", so that searches that only differ
+    in their values share a shape
+
+    Example usage:
+        query_shape({"elements": {"$all": ["Fe", "O"]}, "nelements": 3})
+        >> {"elements": {"$all": "?"}, "nelements": "?"}
+    """
+    def strip_values(value):
+        if type(value) is dict:
+            return {key: strip_values(item) for key, item in value.items()}
+        if type(value) is list and any(type(item) is dict for item in value):
+            return [strip_values(item) for item in value]
+        return "?"
+    return json_util.dumps(strip_values(query_json), sort_keys=True)
+
+class StageTimer:
+    """ times the stages of a single request """
+
+    def __init__(self):
+        self.stages = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - start))
+
+    def seconds(self, name:str) -> float:
+        return sum(seconds for stage, seconds in self.stages if stage == name)
+
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        timings = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages]
+        timings.append(f"total;dur={self.total() * 1000:.2f}")
+        return ", ".join(timings)
+
+class LatencyHistogram:
+    """ count and sum of all observations, quantiles over a reservoir of the latest ones """
+
+    def __init__(self, reservoir_size:int = RESERVOIR_SIZE):
+        self.reservoir = deque(maxlen=reservoir_size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds:float):
+        self.reservoir.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+    def quantiles(self) -> dict:
+        values = sorted(self.reservoir)
+        if not values:
+            return {quantile: 0.0 for quantile in QUANTILES}
+        return {quantile: values[min(int(quantile * len(values)), len(values) - 1)] for quantile in QUANTILES}
+
+_histograms = {}
+_shapes = set()
+_lock = threading.Lock()
+
+def record(route:str, shape:str, timer:StageTimer):
+    """ records the stages of a sampled request, for its route and its query shape """
+    if random.random() >= SAMPLE_RATE:
+        return
+    observations = timer.stages + [("total", timer.total())]
+    with _lock:
+        if shape not in _shapes:
+            # bounds the number of series when clients send many different shapes
+            if len(_shapes) >= MAX_SHAPES:
+                shape = "other"
+            else:
+                _shapes.add(shape)
+        for shape_label in ("*", shape):
+            for stage, seconds in observations:
+                key = (route, shape_label, stage)
+                if key not in _histograms:
+                    _histograms[key] = LatencyHistogram()
+                _histograms[key].observe(seconds)
+
+def _label(value:str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def exposition() -> str:
+    """ the histograms in the Prometheus text format """
+    lines = ["# HELP summary_stage_seconds Latency of the stages of summary requests",
+             "# TYPE summary_stage_seconds summary"]
+    with _lock:
+        for (route, shape, stage), histogram in sorted(_histograms.items()):
+            labels = f'route="{_label(route)}",shape="{_label(shape)}",stage="{_label(stage)}"'
+            for quantile, seconds in histogram.quantiles().items():
+                lines.append(f'summary_stage_seconds{{{labels},quantile="{quantile}"}} {seconds:.6f}')
+            lines.append(f"summary_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+            lines.append(f"summary_stage_seconds_count{{{labels}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,117 @@
+"""
+Vertical partitioning of the heavy fields of a collection.
+
+s3_migrator can move large sub-documents (e.g. the structure of summary) out of a
+collection at ingestion, into a companion collection keyed like the collection
+(material_id) and stored with its own block compressor. Scans and index pages of the
+collection then only read the small scalar fields. Which fields were split is recorded
+in ingestion_meta, and the views join them back when a request asks for them.
+"""
+from .generation import META_COLLECTION
+
+COMPANION_SUFFIX = "_heavy"
+SPLIT_META_PREFIX = "split:"
+
+def companion_name(collection_name:str) -> str:
+    return f"{collection_name}{COMPANION_SUFFIX}"
+
+def create_companion(db, collection_name:str, key:str = "material_id", block_compressor:str = None):
+    """ the companion collection of a collection, created with block_compressor (snappy, zlib, zstd) if it doesn't exist """
+    name = companion_name(collection_name)
+    if name not in db.list_collection_names(filter={"name": name}):
+        options = {}
+        if block_compressor:
+            options["storageEngine"] = {"wiredTiger": {"configString": f"block_compressor={block_compressor}"}}
+        db.create_collection(name, **options)
+    companion = db[name]
+    companion.create_index(key)
+    return companion
+
+def write_split(db, collection_name:str, fields:tuple, key:str = "material_id") -> dict:
+    """ records the fields of a collection that live in its companion collection and returns the record, none clears it """
+    if not fields:
+        db[META_COLLECTION].delete_one({"_id": SPLIT_META_PREFIX + collection_name})
+        return None
+    split = {"companion": companion_name(collection_name), "fields": list(fields), "key": key}
+    db[META_COLLECTION].replace_one({"_id": SPLIT_META_PREFIX + collection_name}, split, upsert=True)
+    return split
+
+def read_split(db, collection_name:str) -> dict:
+    """ {"companion", "fields", "key"} of a split collection, None if nothing was split """
+    return db[META_COLLECTION].find_one({"_id": SPLIT_META_PREFIX + collection_name}, {"_id": 0})
+
+async def aread_split(db, collection_name:str) -> dict:
+    """ read_split for the databases of pymongo's AsyncMongoClient """
+    return await db[META_COLLECTION].find_one({"_id": SPLIT_META_PREFIX + collection_name}, {"_id": 0})
+
+def split_document(doc:dict, fields:tuple, key:str = "material_id") -> dict:
+    """ removes the split fields from a document and returns them as its companion document (None if it has none) """
+    heavy = {field: doc.pop(field) for field in fields if field in doc}
+    if not heavy:
+        return None
+    heavy[key] = doc[key]
+    return heavy
+
+def is_split_field(field:str, split:dict) -> bool:
+    """ whether a (dotted) field lives in the companion collection """
+    return any(field == split_field or field.startswith(split_field + ".") for split_field in split["fields"])
+
+def split_projection(projection:dict, split:dict):
+    """
+        Splits a projection between a collection and its companion.
+        Returns the projection of the collection, the projection of the companion (None if
+        it isn't needed) and whether the key was added to the projection of the collection
+    """
+    if not split:
+        return projection, None, False
+    requested = [field for field, value in projection.items() if field != "_id" and value]
+    if not requested:
+        # no inclusion: every field, so every split field
+        return projection, {"_id": 0, split["key"]: 1, **{field: 1 for field in split["fields"]}}, False
+    heavy_fields = [field for field in requested if is_split_field(field, split)]
+    if not heavy_fields:
+        return projection, None, False
+    main_projection = {field: value for field, value in projection.items() if field not in heavy_fields}
+    added_key = split["key"] not in main_projection
+    main_projection[split["key"]] = 1
+    return main_projection, {"_id": 0, split["key"]: 1, **{field: 1 for field in heavy_fields}}, added_key
+
+def _merge(doc:dict, heavy:dict, key:str, added_key:bool) -> None:
+    for field, value in heavy.items():
+        if field != key:
+            doc[field] = value
+    if added_key:
+        doc.pop(key, None)
+
+def join_split(companion, split:dict, docs:list, heavy_projection:dict, added_key:bool = False) -> list:
+    """ adds the companion fields to docs (with a single $in query), in place """
+    if heavy_projection is None:
+        return docs
+    key = split["key"]
+    heavy_docs = {heavy[key]: heavy for heavy in companion.find({key: {"$in": [doc.get(key) for doc in docs]}}, heavy_projection)}
+    for doc in docs:
+        _merge(doc, heavy_docs.get(doc.get(key), {}), key, added_key)
+    return docs
+
+async def ajoin_split(companion, split:dict, docs:list, heavy_projection:dict, added_key:bool = False) -> list:
+    """ join_split for the collections of pymongo's AsyncMongoClient """
+    if heavy_projection is None:
+        return docs
+    key = split["key"]
+    heavy_docs = {}
+    async for heavy in companion.find({key: {"$in": [doc.get(key) for doc in docs]}}, heavy_projection):
+        heavy_docs[heavy[key]] = heavy
+    for doc in docs:
+        _merge(doc, heavy_docs.get(doc.get(key), {}), key, added_key)
+    return docs
+
+def join_split_batches(companion, split:dict, cursor, heavy_projection:dict, added_key:bool = False, batch_size:int = 1000):
+    """ the documents of a cursor with their companion fields, joined batch_size documents at a time """
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield from join_split(companion, split, batch, heavy_projection, added_key)
+            batch = []
+    if batch:
+        yield from join_split(companion, split, batch, heavy_projection, added_key)
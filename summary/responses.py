@@ -0,0 +1,145 @@
+"""
+Serialization, compression and conditional GET support of the summary responses.
+
+dumps() serializes with orjson when it is installed (NumPy arrays and BSON types are
+handled natively), else with the standard json module. SUMMARY_SERIALIZER picks one
+explicitly, or is the dotted path of any callable returning bytes.
+encoded_response() compresses with zstd or gzip, whichever the client accepts.
+Detail responses carry a strong ETag derived from the ingestion generation, so a
+client revalidating an unchanged document gets a 304 without a mongodb round trip.
+"""
+import base64, datetime, gzip, hashlib, json, threading
+import numpy
+from bson import Binary, Decimal128, ObjectId
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SERIALIZER = getattr(settings, "SUMMARY_SERIALIZER", "auto")
+COMPRESS_MIN_BYTES = getattr(settings, "SUMMARY_COMPRESS_MIN_BYTES", 1024)
+GZIP_LEVEL = getattr(settings, "SUMMARY_GZIP_LEVEL", 6)
+ZSTD_LEVEL = getattr(settings, "SUMMARY_ZSTD_LEVEL", 3)
+DETAIL_MAX_AGE = getattr(settings, "SUMMARY_DETAIL_MAX_AGE", 60)
+
+def _default(value):
+    # the types neither serializer handles on its own
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, (Binary, bytes)):
+        return base64.b64encode(value).decode()
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def _orjson_dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj, default=_default).encode()
+
+def _serializer():
+    if SERIALIZER == "auto":
+        return _orjson_dumps if orjson is not None else _json_dumps
+    if SERIALIZER == "orjson":
+        return _orjson_dumps
+    if SERIALIZER == "json":
+        return _json_dumps
+    return import_string(SERIALIZER)
+
+dumps = _serializer()
+
+_zstd = threading.local()
+
+def _zstd_compress(content:bytes) -> bytes:
+    # a ZstdCompressor can't be shared between threads
+    if not hasattr(_zstd, "compressor"):
+        _zstd.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return _zstd.compressor.compress(content)
+
+def accepted_encoding(request) -> str:
+    """ the best content coding of Accept-Encoding this server supports, None for identity """
+    accepted = {}
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        if coding:
+            accepted[coding.lower()] = quality
+    candidates = (["zstd"] if zstandard is not None else []) + ["gzip"]
+    candidates = [coding for coding in candidates if accepted.get(coding, accepted.get("*", 0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda coding: accepted.get(coding, accepted.get("*", 0)))
+
+def encoded_response(request, content:bytes, content_type:str = "application/json", etag:str = None) -> HttpResponse:
+    """
+        A response of the serialized content, compressed when the client accepts it.
+        A strong etag gets the content coding appended, as the bytes sent differ
+    """
+    encoding = accepted_encoding(request) if len(content) >= COMPRESS_MIN_BYTES else None
+    if encoding == "zstd":
+        content = _zstd_compress(content)
+    elif encoding == "gzip":
+        content = gzip.compress(content, GZIP_LEVEL, mtime=0)
+    response = HttpResponse(content, content_type=content_type)
+    if encoding:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ("Accept-Encoding",))
+    if etag:
+        response["ETag"] = f'"{etag}-{encoding}"' if encoding else f'"{etag}"'
+    return response
+
+def detail_etag(generation:int, *parts) -> str:
+    """ the opaque tag of a detail response: it changes with every ingestion generation """
+    key = json.dumps([getattr(settings, "SUMMARY_MONGO_DB", "matproj_s3"), generation, *parts])
+    return f"g{generation}-" + hashlib.sha1(key.encode()).hexdigest()[:20]
+
+def if_none_match(request, etag:str) -> str:
+    """
+        The tag of If-None-Match that matches the etag, whatever content coding it was sent with,
+        None if the client has no current copy. "*" is not honoured: it is checked before the
+        lookup, so it would also answer 304 for a document that doesn't exist
+    """
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return None
+    for tag in header.split(","):
+        tag = tag.strip()
+        opaque_tag = tag[2:] if tag.startswith("W/") else tag
+        opaque_tag = opaque_tag.strip('"')
+        if opaque_tag == etag or opaque_tag.rsplit("-", 1)[0] == etag:
+            return tag
+    return None
+
+def not_modified(matched_tag:str) -> HttpResponseNotModified:
+    response = HttpResponseNotModified()
+    response["ETag"] = matched_tag
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return cache_control(response)
+
+def cache_control(response:HttpResponse) -> HttpResponse:
+    response["Cache-Control"] = f"public, max-age={DETAIL_MAX_AGE}"
+    return response
@@ -1,3 +1,856 @@
-from django.test import TestCase
+import asyncio, gzip, io, json, math, os, random, shutil, tempfile, time, unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from unittest import mock
+import numpy, pymongo
+from django.http import QueryDict
+from django.test import RequestFactory, SimpleTestCase
+import s3_migrator
+from . import cache, explain, metrics, views
+from .bundles import ARRAY_FIELD, chunks_name, encode_document, decode_document, split_chunks, chunked_paths, read_chunks, to_npz
+from .cache import LRUCache, QueryResultCache, register_generation_cache
+from .columnar import ColumnarEngine
+from .responses import dumps, encoded_response, detail_etag, if_none_match
+from .explain import SlowQueryLog, plan_summary
+from .facets import FACETS_BY_NAME, parse_facets, facet_pipeline, facet_results
+from .filters import FilterError, compile_filters, filter_index_specs
+from .generation import bump_generation
+from .metrics import StageTimer, query_shape, record, exposition
+from .partition import write_split, read_split, split_document, split_projection, join_split, join_split_batches
+from .formula import FormulaError, parse_formula, reduced_formula, canonical_formula, add_formula_field, FORMULA_FIELD
+from .utils import chemsys_query_from_wildcard, generate_all_chemsyses_from_wildcard
 
-# Create your tests here.
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+ELEMENTS = ["Li", "Fe", "O", "Mn", "P", "Si", "Zn"]
+CRYSTAL_SYSTEMS = ["Cubic", "Hexagonal", "Monoclinic", "Orthorhombic", "Tetragonal", "Triclinic", "Trigonal"]
+
+def _summary_docs(num_docs:int, seed:int = 1) -> list:
+    # small summary documents with missing and null values in the sort fields
+    rng = random.Random(seed)
+    docs = []
+    for i in range(num_docs):
+        elements = sorted(rng.sample(ELEMENTS, rng.randint(1, 4)))
+        doc = {
+            "material_id": f"mp-{i}",
+            "elements": elements,
+            "nelements": len(elements),
+            "chemsys": "-".join(elements),
+            "formula_anonymous": rng.choice(["A", "AB", "AB2", "A2B3", "ABC3"]),
+            "band_gap": round(rng.uniform(0, 4), 1),
+            "energy_above_hull": round(rng.uniform(0, 0.3), 2),
+            "symmetry": {"crystal_system": rng.choice(CRYSTAL_SYSTEMS)},
+        }
+        if rng.random() < 0.1:
+            doc.pop("band_gap")
+        elif rng.random() < 0.05:
+            doc["band_gap"] = None
+        docs.append(doc)
+    return docs
+
+class KeysetQueryTests(SimpleTestCase):
+
+    def test_ascending(self):
+        self.assertEqual(views._keyset_query([("band_gap", 1), ("material_id", 1)], [1.5, "mp-3"]),
+                         {"$or": [{"band_gap": {"$gt": 1.5}},
+                                  {"band_gap": 1.5, "material_id": {"$gt": "mp-3"}}]})
+
+    def test_descending_includes_missing_values(self):
+        self.assertEqual(views._keyset_query([("band_gap", -1), ("material_id", 1)], [1.5, "mp-3"]),
+                         {"$or": [{"$or": [{"band_gap": {"$lt": 1.5}}, {"band_gap": None}]},
+                                  {"band_gap": 1.5, "material_id": {"$gt": "mp-3"}}]})
+
+    def test_null_values(self):
+        # after null: every value in an ascending sort, nothing but the ties in a descending one
+        self.assertEqual(views._keyset_query([("band_gap", 1), ("material_id", 1)], [None, "mp-3"]),
+                         {"$or": [{"band_gap": {"$ne": None}},
+                                  {"band_gap": None, "material_id": {"$gt": "mp-3"}}]})
+        self.assertEqual(views._keyset_query([("band_gap", -1), ("material_id", 1)], [None, "mp-3"]),
+                         {"$or": [{"band_gap": None, "material_id": {"$gt": "mp-3"}}]})
+
+    def test_nothing_after_last_value(self):
+        self.assertEqual(views._keyset_query([("band_gap", -1)], [None]), {"_id": {"$in": []}})
+
+    def test_decode_cursor(self):
+        sort_list = [("band_gap", 1), ("material_id", 1)]
+        cursor = views._encode_cursor([1.5, "mp-3"])
+        self.assertEqual(views._decode_cursor(cursor, sort_list), [1.5, "mp-3"])
+        with self.assertRaises(ValueError):
+            views._decode_cursor(cursor, [("material_id", 1)])
+        with self.assertRaises(ValueError):
+            views._decode_cursor(views._encode_cursor([]), sort_list)
+        with self.assertRaises(ValueError):
+            views._decode_cursor(views._encode_cursor([{"$gt": ""}, "mp-3"]), sort_list)
+        with self.assertRaises(ValueError):
+            views._decode_cursor("not a cursor", sort_list)
+
+class FormulaTests(SimpleTestCase):
+
+    def test_nested_groups(self):
+        self.assertEqual(parse_formula("Ca3(PO4)2"), {"Ca": 3, "P": 2, "O": 8})
+        self.assertEqual(parse_formula("[Co(NH3)6]Cl3"), {"Co": 1, "N": 6, "H": 18, "Cl": 3})
+        self.assertEqual(parse_formula("K4[Fe(CN)6]"), {"K": 4, "Fe": 1, "C": 6, "N": 6})
+
+    def test_hydrates(self):
+        self.assertEqual(parse_formula("CuSO4·5H2O"), {"Cu": 1, "S": 1, "O": 9, "H": 10})
+        self.assertEqual(parse_formula("CaSO4•2H2O"), parse_formula("CaSO4·2(H2O)"))
+        self.assertEqual(canonical_formula("Na2CO3·10H2O"), "CH20Na2O13")
+
+    def test_fractions(self):
+        self.assertEqual(parse_formula("Li0.5CoO2"), {"Li": Fraction(1, 2), "Co": 1, "O": 2})
+        self.assertEqual(parse_formula("Fe1/3O"), {"Fe": Fraction(1, 3), "O": 1})
+        self.assertEqual(canonical_formula("Li0.5CoO2"), "Co2LiO4")
+        self.assertEqual(canonical_formula("Fe1/3O"), "FeO3")
+        self.assertEqual(reduced_formula({"Fe": 0.3333333, "O": 0.5}), "Fe2O3")
+
+    def test_same_composition_same_formula(self):
+        self.assertEqual({canonical_formula(formula) for formula in ("Fe4O6", "O3Fe2", "Fe2O3", "Fe 2 O 3", "(FeO1.5)2")}, {"Fe2O3"})
+        self.assertEqual(reduced_formula({"O": 6.0, "Fe": 4.0}), "Fe2O3")
+        self.assertEqual(canonical_formula("O2"), "O")
+
+    def test_invalid_formulas(self):
+        for formula in ("", "fe2O3", "Xx2O", "Fe2O3)", "(Fe2O3", "[Fe2O3)", "Fe0O", "Fe1/0O", "Fe1.5/2O", "Fe1/2/3O",
+                        "Fe2O3·", "Fe-O", "2", "()"):
+            with self.subTest(formula), self.assertRaises(FormulaError):
+                parse_formula(formula)
+
+    def test_exact_amounts(self):
+        # only float amounts are approximated
+        self.assertEqual(reduced_formula({"Fe": Fraction(1, 1001), "O": 1}), "FeO1001")
+        self.assertEqual(reduced_formula({"Fe": 1, "O": 1001}), "FeO1001")
+        self.assertEqual(canonical_formula("Fe1/1001O"), "FeO1001")
+
+    @unittest.skipIf(mongomock is None, "needs mongomock")
+    def test_search_without_formula_field(self):
+        collection = mongomock.MongoClient().db.summary
+        collection.insert_many([
+            {"material_id": "mp-1", FORMULA_FIELD: "Fe2O3", "formula_anonymous": "A2B3", "chemsys": "Fe-O"},
+            # ingested before the reduced formula existed
+            {"material_id": "mp-2", "formula_anonymous": "A2B3", "chemsys": "Fe-O"},
+            {"material_id": "mp-3", FORMULA_FIELD: "FeO", "formula_anonymous": "AB", "chemsys": "Fe-O"},
+            {"material_id": "mp-4", "formula_anonymous": "A2B3", "chemsys": "Al-O"},
+        ])
+        query_json = views._build_query(QueryDict("formula=O3Fe2"))
+        self.assertEqual({doc["material_id"] for doc in collection.find(query_json)}, {"mp-1", "mp-2"})
+
+    def test_formula_field(self):
+        self.assertEqual(add_formula_field({"composition_reduced": {"O": 3.0, "Fe": 2.0}})[FORMULA_FIELD], "Fe2O3")
+        self.assertEqual(add_formula_field({"formula_pretty": "O3Fe2"})[FORMULA_FIELD], "Fe2O3")
+        self.assertNotIn(FORMULA_FIELD, add_formula_field({"formula_pretty": "Fe1/0O"}))
+
+class ChemsysWildcardTests(SimpleTestCase):
+
+    def test_query(self):
+        self.assertEqual(chemsys_query_from_wildcard(["Li", "Fe", "*"]), {"elements": {"$all": ["Fe", "Li"]}, "nelements": 3})
+        self.assertEqual(chemsys_query_from_wildcard(["*", "O", "*"]), {"elements": {"$all": ["O"]}, "nelements": 3})
+        self.assertEqual(chemsys_query_from_wildcard(["*", "*"]), {"nelements": 2})
+        self.assertEqual(chemsys_query_from_wildcard(["Fe", "O"]), {"elements": {"$all": ["Fe", "O"]}, "nelements": 2})
+
+    @unittest.skipIf(mongomock is None, "needs mongomock")
+    def test_same_materials_as_the_regexes(self):
+        collection = mongomock.MongoClient().db.summary
+        collection.insert_many(_summary_docs(300))
+        for chemsys in ("Fe-*", "*-O", "Li-*-O", "*-*", "*-Fe-*-O", "Zn"):
+            elements = chemsys.split('-')
+            regexes = generate_all_chemsyses_from_wildcard(elements)
+            # a wildcard of the regexes also matches several elements, of the query exactly one
+            expected = {doc["material_id"] for doc in collection.find({"$or": regexes, "nelements": len(elements)})}
+            found = {doc["material_id"] for doc in collection.find(chemsys_query_from_wildcard(elements))}
+            self.assertEqual(found, expected, chemsys)
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class ColumnarEquivalenceTests(SimpleTestCase):
+    """ the searches of the columnar engine return the pages of the mongodb pipelines """
+
+    QUERIES = ["chemsys=Fe-O", "chemsys=Fe-*", "chemsys=*-*-O", "elements=Fe,O&exclude_elements=Li",
+               "material_ids=mp-1,mp-20,mp-200,mp-5", "formula=*2O3", "formula=FeO2", "nelements_min=2&nelements_max=3",
+               "band_gap_min=1&band_gap_max=2.5", "exclude_elements=O,Zn", "nelements_min=5"]
+    # total orders: material_id is the last key
+    SORTS = ["", "-band_gap", "band_gap", "nelements,-energy_above_hull,material_id", "-material_id",
+             "formula_anonymous,band_gap,material_id"]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        db = mongomock.MongoClient().db
+        db.summary.insert_many(_summary_docs(300))
+        # no nelements: found by its chemsys, not by a wildcard chemsys
+        db.summary.insert_one({"material_id": "mp-300", "elements": ["Fe", "O"], "chemsys": "Fe-O", "band_gap": 1.0})
+        engine = ColumnarEngine(db.summary)
+        cls.patches = [mock.patch.object(views, "db", db), mock.patch.object(views, "columnar_engine", engine)]
+        for patch in cls.patches:
+            patch.start()
+        engine.load(views.current_generation(db))
+        views.count_cache.clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in cls.patches:
+            patch.stop()
+        views.count_cache.clear()
+        super().tearDownClass()
+
+    def search(self, query_string:str, columnar:bool) -> dict:
+        query_params = QueryDict(query_string)
+        project_json, sort_list = views._build_options(query_params)
+        limit, skip, cursor, count_mode = views._page_options(query_params)
+        query_json = views._build_query(query_params)
+        if columnar:
+            response = views._columnar_search(query_json, cursor, skip, limit, project_json, sort_list, count_mode)
+            self.assertIsNotNone(response, query_string)
+            return response
+        if cursor is not None:
+            return views._keyset_pipeline(query_json, cursor, limit, project_json, sort_list, count_mode)
+        return views._pipeline(query_json, skip, limit, project_json, sort_list, count_mode)
+
+    def test_skip_pages(self):
+        for query in self.QUERIES:
+            for sort in self.SORTS:
+                for skip in (0, 7, 45):
+                    query_string = f"{query}&_fields=material_id,band_gap&_limit=10&_skip={skip}" + (f"&_sort_fields={sort}" if sort else "")
+                    with self.subTest(query_string):
+                        columnar, mongo = self.search(query_string, True), self.search(query_string, False)
+                        self.assertEqual(columnar["meta"], mongo["meta"])
+                        if sort:
+                            self.assertEqual(columnar["data"], mongo["data"])
+
+    def test_cursor_walk(self):
+        for query in self.QUERIES:
+            for sort in self.SORTS[1:]:
+                with self.subTest(query=query, sort=sort):
+                    pages = {}
+                    for columnar in (True, False):
+                        material_ids, cursor = [], ""
+                        # 301 documents are at most 13 pages
+                        for _ in range(14):
+                            response = self.search(f"{query}&_sort_fields={sort}&_fields=material_id&_limit=25&_cursor={cursor}", columnar)
+                            material_ids += [doc["material_id"] for doc in response["data"]]
+                            cursor = response["meta"]["next_cursor"]
+                            if not cursor:
+                                break
+                        else:
+                            self.fail("the cursor walk doesn't end")
+                        pages[columnar] = material_ids
+                    self.assertEqual(pages[True], pages[False])
+
+    def test_missing_nelements(self):
+        for query, found in (("chemsys=Fe-O", True), ("chemsys=Fe-*", False), ("elements=Fe,O", True)):
+            query_string = f"{query}&_fields=material_id&_sort_fields=material_id&_limit=400"
+            with self.subTest(query):
+                columnar, mongo = self.search(query_string, True), self.search(query_string, False)
+                self.assertEqual(columnar, mongo)
+                self.assertEqual({"material_id": "mp-300"} in columnar["data"], found)
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class DetailViewTests(SimpleTestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(views, "db", mongomock.MongoClient().db)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def detail(self, error:Exception):
+        with mock.patch.object(views, "compute_and_store_detail", side_effect=error), self.assertLogs("summary.detail"):
+            return views.detail(RequestFactory().get("/summary/mp-1/"), 1)
+
+    def test_failed_computation(self):
+        self.assertEqual(self.detail(ImportError("no pymatgen")).status_code, 503)
+        self.assertEqual(self.detail(ValueError("bad structure")).status_code, 404)
+
+class ResponsesTests(SimpleTestCase):
+
+    def test_if_none_match(self):
+        etag = detail_etag(3, "detail", "mp-1")
+        for header, matched in ((f'"{etag}"', f'"{etag}"'), (f'W/"{etag}-gzip"', f'W/"{etag}-gzip"'),
+                                (f'"other", "{etag}-zstd"', f'"{etag}-zstd"'), ('"other"', None),
+                                (f'"{detail_etag(4, "detail", "mp-1")}"', None), ("*", None)):
+            with self.subTest(header):
+                self.assertEqual(if_none_match(RequestFactory().get("/", headers={"If-None-Match": header}), etag), matched)
+        self.assertIsNone(if_none_match(RequestFactory().get("/"), etag))
+
+    def test_encoded_response(self):
+        content = dumps({"data": [{"material_id": f"mp-{i}"} for i in range(200)]})
+        response = encoded_response(RequestFactory().get("/", headers={"Accept-Encoding": "gzip"}), content, etag="g1-abc")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["ETag"], '"g1-abc-gzip"')
+        self.assertEqual(gzip.decompress(response.content), content)
+        for accept_encoding in ("", "gzip;q=0, zstd;q=0", "br"):
+            with self.subTest(accept_encoding):
+                response = encoded_response(RequestFactory().get("/", headers={"Accept-Encoding": accept_encoding}), content, etag="g1-abc")
+                self.assertFalse(response.has_header("Content-Encoding"))
+                self.assertEqual(response["ETag"], '"g1-abc"')
+                self.assertEqual(response.content, content)
+        # small responses are not worth compressing
+        response = encoded_response(RequestFactory().get("/", headers={"Accept-Encoding": "gzip"}), b"{}")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+def _bulk_write(collection, operations, ordered=True, **kwargs):
+    # mongomock's bulk_write doesn't know the operations of recent pymongo versions
+    for operation in operations:
+        if isinstance(operation, pymongo.ReplaceOne):
+            collection.replace_one(operation._filter, operation._doc, upsert=operation._upsert)
+        elif isinstance(operation, pymongo.UpdateOne):
+            collection.update_one(operation._filter, operation._doc, upsert=operation._upsert)
+        elif isinstance(operation, pymongo.DeleteMany):
+            collection.delete_many(operation._filter)
+        else:
+            collection.insert_one(operation._doc)
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class MigratorTests(SimpleTestCase):
+
+    def setUp(self):
+        for patch in (mock.patch.object(s3_migrator.pymongo, "MongoClient", mongomock.MongoClient),
+                      mock.patch.object(mongomock.Collection, "bulk_write", _bulk_write, create=True)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.migrator = s3_migrator.Matproj_db_migrator(print_fn=lambda *args, **kwargs: None)
+        self.base_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_path)
+
+    def write_shard(self, collection_name:str, docs:list, sub_path:str = "", shard:str = "shard-0"):
+        folder = os.path.join(self.base_path, collection_name, sub_path, "f1")
+        os.makedirs(folder, exist_ok=True)
+        with gzip.open(os.path.join(folder, f"{shard}.jsonl.gz"), "wt") as file:
+            file.writelines(json.dumps(doc) + "\n" for doc in docs)
+
+    def test_read_doc_batches(self):
+        self.write_shard("summary", [{"material_id": f"mp-{i}", "band_gap": i / 10} for i in range(50)])
+        path_to_file = os.path.join(self.base_path, "summary", "f1", "shard-0.jsonl.gz")
+        batches = list(self.migrator.read_doc_batches(path_to_file, s3_migrator.ExportTypes.Gzip, batch_bytes=200))
+        self.assertGreater(len(batches), 1)
+        self.assertEqual([doc["material_id"] for batch in batches for doc in batch], [f"mp-{i}" for i in range(50)])
+        batches = list(self.migrator.read_doc_batches(path_to_file, s3_migrator.ExportTypes.Gzip, max_batch_docs=7))
+        self.assertEqual([len(batch) for batch in batches], [7] * 7 + [1])
+        self.assertEqual(self.migrator.progress["docs"], 100)
+        self.assertEqual(self.migrator.progress["input_bytes"], 2 * os.path.getsize(path_to_file))
+
+    def test_add_data_to_db(self):
+        self.write_shard("summary", [{"material_id": f"mp-{i}", "formula_pretty": "Fe2O3"} for i in range(30)])
+        path_to_file = os.path.join(self.base_path, "summary", "f1", "shard-0.jsonl.gz")
+        collection = self.migrator.db_s3.summary
+        collection.insert_one({"material_id": "old"})
+        num_docs = self.migrator.add_data_to_db(path_to_file, s3_migrator.ExportTypes.Gzip, collection, True, 8,
+                                                show_progress=False, shard_tag="summary/f1/shard-0", batch_bytes=100)
+        self.assertEqual(num_docs, 30)
+        # from scratch, tagged with the shard, with the derived fields
+        self.assertEqual(collection.count_documents({}), 30)
+        self.assertEqual(collection.count_documents({s3_migrator.SHARD_TAG_FIELD: "summary/f1/shard-0", FORMULA_FIELD: "Fe2O3"}), 30)
+
+    def test_prefetch(self):
+        produced = []
+        def numbers():
+            for number in range(1000):
+                produced.append(number)
+                yield number
+        self.assertEqual(list(s3_migrator._prefetch(range(5))), list(range(5)))
+        for number in s3_migrator._prefetch(numbers(), depth=2):
+            if number == 3:
+                break
+        # the producer stops a few items after the consumer
+        time.sleep(0.3)
+        self.assertLess(len(produced), 10)
+        def failing():
+            yield 1
+            raise OSError("truncated file")
+        with self.assertRaises(OSError):
+            list(s3_migrator._prefetch(failing()))
+
+    def test_build_indexes(self):
+        specs = s3_migrator.INDEX_SPECS["summary"]
+        self.assertEqual(len({tuple(spec) for spec in specs}), len(specs))
+        collection = self.migrator.db_s3.summary
+        collection.insert_many(_summary_docs(10))
+        # mongomock has no $collStats
+        storage_stats = {"storageStats": {"indexSizes": {"chemsys_1": 4096}}}
+        with mock.patch.object(mongomock.Collection, "aggregate", return_value=iter([storage_stats])):
+            report = self.migrator.build_indexes("summary")
+        self.assertEqual([index["name"] for index in report], ["_".join(f"{field}_{order}" for field, order in spec) for spec in specs])
+        self.assertEqual(report[0]["size_bytes"], 4096)
+        self.assertLessEqual({index["name"] for index in report}, set(collection.index_information()))
+
+    def test_parallel_ingestion(self):
+        # the workers run in threads on one mongomock client, each with its own migrator as in a process
+        client = mongomock.MongoClient()
+        for shard in range(3):
+            self.write_shard("summary", [{"material_id": f"mp-{shard}-{i}"} for i in range(10)], shard=f"shard-{shard}")
+        with mock.patch.object(s3_migrator.pymongo, "MongoClient", lambda *args, **kwargs: client), \
+             mock.patch.object(s3_migrator, "ProcessPoolExecutor", ThreadPoolExecutor):
+            migrator = s3_migrator.Matproj_db_migrator(print_fn=lambda *args, **kwargs: None)
+            self.assertEqual(migrator.add_s3_collections_to_db("summary", self.base_path, processes=2, resume=True), 30)
+        collection = client.matproj_s3.summary
+        for shard in range(3):
+            self.assertEqual(collection.count_documents({s3_migrator.SHARD_TAG_FIELD: f"summary/f1/shard-{shard}.jsonl.gz"}), 10)
+        self.assertEqual(sorted((checkpoint["status"], checkpoint["num_docs"]) for checkpoint in client.matproj_s3.ingest_checkpoints.find()),
+                         [("done", 10)] * 3)
+        # the stage timings and counters of the workers are added to the migrator's
+        self.assertEqual(migrator.progress["docs"], 30)
+        self.assertGreater(migrator.stage_seconds["insert"], 0)
+
+    def test_write_throttle(self):
+        throttle = s3_migrator.Write_throttle(1000)
+        with mock.patch.object(s3_migrator.time, "sleep") as sleep:
+            self.assertEqual(throttle.acquire(600), 0.0)
+            # the bucket is 400 bytes short: 0.4s at 1000 bytes/s (minus the few µs since)
+            self.assertAlmostEqual(throttle.acquire(800), 0.4, places=2)
+            sleep.assert_called_once()
+        self.assertAlmostEqual(throttle.waited_seconds, 0.4, places=2)
+
+    def test_orchestrator(self):
+        client = mongomock.MongoClient()
+        self.write_shard("materials", [{"material_id": f"mp-{i}"} for i in range(5)])
+        self.write_shard("other", [{"material_id": "mp-1"}], "kind=a")
+        spec = {"concurrency": 2, "precompute_details": False, "max_write_mb_per_s": 10,
+                "jobs": [{"collection_name": "materials", "collection_path": self.base_path},
+                         # no key for a partition: the job fails, the other one goes on
+                         {"collection_name": "other", "collection_path": self.base_path, "sub_path": "kind=a", "mode": "incremental"}]}
+        messages = []
+        storage_stats = {"storageStats": {"indexSizes": {}}}
+        with mock.patch.object(s3_migrator.pymongo, "MongoClient", lambda *args, **kwargs: client), \
+             mock.patch.object(mongomock.Collection, "aggregate", return_value=iter([storage_stats])):
+            summaries = s3_migrator.Migration_orchestrator(spec, messages.append).run(progress_interval=0.1)
+        self.assertEqual([(summary["job"], summary["status"], summary["docs"]) for summary in summaries],
+                         [("materials", "done", 5), ("other/kind=a", "failed", 0)])
+        self.assertIn("ValueError", summaries[1]["error"])
+        self.assertEqual(client.matproj_s3.materials.count_documents({}), 5)
+        self.assertIn("material_id_1", client.matproj_s3.materials.index_information())
+        self.assertTrue(any(message.startswith("[other/kind=a] failed") for message in messages))
+        for invalid_spec in ({"jobs": []}, dict(spec, concurrency=0), dict(spec, jobs=[dict(spec["jobs"][0], mode="fast")])):
+            with self.assertRaises(ValueError):
+                s3_migrator.Migration_orchestrator(invalid_spec, messages.append)
+
+    def test_update_upserts_changed_documents(self):
+        self.write_shard("summary", [{"material_id": f"mp-{i}", "band_gap": i} for i in range(3)])
+        self.assertEqual(self.migrator.update_s3_collection("summary", self.base_path), {"unchanged": 0, "upserted": 3, "removed": 0})
+        self.write_shard("summary", [{"material_id": f"mp-{i}", "band_gap": 5 if i == 1 else i} for i in range(3)])
+        self.assertEqual(self.migrator.update_s3_collection("summary", self.base_path), {"unchanged": 2, "upserted": 1, "removed": 0})
+        self.assertEqual(self.migrator.db_s3.summary.find_one({"material_id": "mp-1"})["band_gap"], 5)
+        self.assertEqual(self.migrator.db_s3.summary.count_documents({}), 3)
+
+    def test_partitioned_update(self):
+        for thermo_type in ("GGA", "R2SCAN"):
+            self.write_shard("thermo", [{"material_id": f"mp-{i}", "thermo_id": f"mp-{i}_{thermo_type}", "thermo_type": thermo_type}
+                                        for i in range(3)], f"thermo_type={thermo_type}")
+            self.migrator.update_s3_collection("thermo", self.base_path, f"thermo_type={thermo_type}")
+        # a material has a document per partition
+        self.assertEqual(self.migrator.db_s3.thermo.count_documents({"material_id": "mp-1"}), 2)
+        with self.assertRaises(ValueError):
+            self.migrator.update_s3_collection("xas", self.base_path, "spectrum_type=XANES", key=None, remove_deprecated=True)
+        self.write_shard("other", [{"material_id": "mp-1"}], "kind=a")
+        with self.assertRaises(ValueError):
+            self.migrator.update_s3_collection("other", self.base_path, "kind=a")
+
+    def test_resume_skips_added_shards(self):
+        for shard in range(3):
+            self.write_shard("summary", [{"material_id": f"mp-{shard}-{i}"} for i in range(4)], shard=f"shard-{shard}")
+        self.assertEqual(self.migrator.add_s3_collections_to_db("summary", self.base_path, resume=True), 12)
+        # an unchanged rerun adds nothing, a changed shard replaces its documents
+        self.assertEqual(self.migrator.add_s3_collections_to_db("summary", self.base_path, resume=True), 0)
+        self.write_shard("summary", [{"material_id": f"mp-1-{i}"} for i in range(5)], shard="shard-1")
+        self.assertEqual(self.migrator.add_s3_collections_to_db("summary", self.base_path, resume=True), 5)
+        self.assertEqual(self.migrator.db_s3.summary.count_documents({}), 13)
+        self.assertEqual(self.migrator.db_s3.summary.count_documents({"material_id": {"$regex": "^mp-1-"}}), 5)
+
+    def test_resume_refuses_untagged_documents(self):
+        self.write_shard("summary", [{"material_id": f"mp-{i}"} for i in range(4)])
+        self.migrator.add_s3_collections_to_db("summary", self.base_path)
+        with self.assertRaises(ValueError):
+            self.migrator.add_s3_collections_to_db("summary", self.base_path, resume=True)
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class ExportTests(SimpleTestCase):
+
+    def setUp(self):
+        db = mongomock.MongoClient().db
+        db.summary.insert_many([dict(doc, _source_shard="summary/f1/shard-0", _content_hash="abc") for doc in _summary_docs(30)])
+        patch = mock.patch.object(views, "db", db)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def export(self, query_string:str) -> list:
+        response = views.export(RequestFactory().get(f"/summary/export/?{query_string}"))
+        content = b"".join(response.streaming_content)
+        if response["Content-Type"] == "application/gzip":
+            content = gzip.decompress(content)
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_whole_documents(self):
+        docs = self.export("nelements_min=2")
+        self.assertEqual(len(docs), sum(doc["nelements"] >= 2 for doc in _summary_docs(30)))
+        for doc in docs:
+            self.assertNotIn("_source_shard", doc)
+            self.assertNotIn("_content_hash", doc)
+            self.assertIn("symmetry", doc)
+
+    def test_fields_sort_limit(self):
+        docs = self.export("_fields=material_id,band_gap&_sort_fields=-material_id&_limit=5&_compress=gzip")
+        self.assertEqual([doc["material_id"] for doc in docs], sorted((f"mp-{i}" for i in range(30)), reverse=True)[:5])
+        self.assertTrue(all(set(doc) <= {"material_id", "band_gap"} for doc in docs))
+
+class FacetTests(SimpleTestCase):
+
+    def test_parse_facets(self):
+        self.assertEqual(parse_facets(QueryDict("")), {"nelements": None, "elements": None, "crystal_system": None, "band_gap": 0.5})
+        self.assertEqual(parse_facets(QueryDict("facets=band_gap,is_stable&band_gap_bin=0.25")), {"band_gap": 0.25, "is_stable": None})
+        for query_string in ("facets=unknown", "facets=", "facets=band_gap&band_gap_bin=0", "facets=band_gap&band_gap_bin=x",
+                             "facets=band_gap&band_gap_bin=nan"):
+            with self.subTest(query_string), self.assertRaises(FilterError):
+                parse_facets(QueryDict(query_string))
+
+    @unittest.skipIf(mongomock is None, "needs mongomock")
+    def test_facet_results(self):
+        collection = mongomock.MongoClient().db.summary
+        docs = _summary_docs(300)
+        collection.insert_many([dict(doc) for doc in docs])
+        requested = parse_facets(QueryDict("facets=nelements,elements,crystal_system,band_gap"))
+        response = facet_results(next(collection.aggregate(facet_pipeline({"nelements": {"$gte": 2}}, requested))), requested)
+        docs = [doc for doc in docs if doc["nelements"] >= 2]
+        self.assertEqual(response["meta"], {"total_doc": len(docs), "truncated": []})
+        self.assertEqual({bucket["value"]: bucket["count"] for bucket in response["data"]["nelements"]},
+                         dict(Counter(doc["nelements"] for doc in docs)))
+        self.assertEqual({bucket["value"]: bucket["count"] for bucket in response["data"]["elements"]},
+                         dict(Counter(element for doc in docs for element in doc["elements"])))
+        self.assertEqual(sum(bucket["count"] for bucket in response["data"]["crystal_system"]), len(docs))
+        band_gaps = [doc["band_gap"] for doc in docs if doc.get("band_gap") is not None]
+        self.assertEqual(sum(bucket["count"] for bucket in response["data"]["band_gap"]), len(band_gaps))
+        self.assertEqual(response["data"]["band_gap"][0]["min"], math.floor(min(band_gaps) / 0.5) * 0.5)
+
+    @unittest.skipIf(mongomock is None, "needs mongomock")
+    def test_truncated_histogram(self):
+        collection = mongomock.MongoClient().db.summary
+        collection.insert_many(_summary_docs(300))
+        requested = {"band_gap": 0.1}
+        with mock.patch.dict(FACETS_BY_NAME, band_gap=FACETS_BY_NAME["band_gap"]._replace(max_bins=5)):
+            response = facet_results(next(collection.aggregate(facet_pipeline({}, requested))), requested)
+        self.assertEqual(len(response["data"]["band_gap"]), 5)
+        self.assertEqual(response["meta"]["truncated"], ["band_gap"])
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class CountCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.db.summary.insert_many(_summary_docs(50))
+        for patch in (mock.patch.object(views, "db", self.db),
+                      mock.patch.dict(cache._generation, value=None, checked=0.0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        views.count_cache.clear()
+        self.addCleanup(views.count_cache.clear)
+
+    def test_count_modes(self):
+        query_json = {"nelements": 2}
+        expected = self.db.summary.count_documents(query_json)
+        self.assertEqual(views._total_doc(query_json, "none"), {"total_doc": None})
+        self.assertEqual(views._total_doc(query_json), {"total_doc": expected})
+        with mock.patch.object(views, "COUNT_ESTIMATE_LIMIT", 5):
+            # a cached count is exact, whatever the mode
+            self.assertEqual(views._total_doc(query_json, "estimate"), {"total_doc": expected})
+            self.assertEqual(views._total_doc({"nelements": 1}, "estimate"), {"total_doc": 5, "total_doc_estimated": True})
+
+    def test_normalized_query(self):
+        views._total_doc({"nelements": 2, "elements": {"$all": ["O"]}})
+        hits = views.count_cache.hits
+        views._total_doc({"elements": {"$all": ["O"]}, "nelements": 2})
+        self.assertEqual(views.count_cache.hits, hits + 1)
+
+    def test_new_generation(self):
+        self.assertEqual(views._total_doc({}), {"total_doc": 50})
+        self.db.summary.insert_one({"material_id": "mp-50"})
+        # the cached count until the ingestion bumps the generation
+        self.assertEqual(views._total_doc({}), {"total_doc": 50})
+        bump_generation(self.db)
+        cache._generation["checked"] = 0.0
+        self.assertEqual(views._total_doc({}), {"total_doc": 51})
+
+class ResultCacheTests(SimpleTestCase):
+
+    def test_lru(self):
+        lru = LRUCache(max_entries=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(lru.get("a"), 1)
+        lru.set("c", 3)
+        # "b" is the least recently used
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual((lru.get("a"), lru.get("c")), (1, 3))
+        self.assertEqual(lru.stats(), {"entries": 2, "max_entries": 2, "hits": 3, "misses": 1, "evictions": 1})
+        expired = LRUCache(ttl_seconds=-1)
+        expired.set("a", 1)
+        self.assertIsNone(expired.get("a"))
+
+    def test_make_key(self):
+        key = QueryResultCache.make_key(1, {"nelements": 2, "chemsys": "Fe-O"}, [("band_gap", 1)], 15)
+        self.assertEqual(key, QueryResultCache.make_key(1, {"chemsys": "Fe-O", "nelements": 2}, [("band_gap", 1)], 15))
+        self.assertNotEqual(key, QueryResultCache.make_key(2, {"chemsys": "Fe-O", "nelements": 2}, [("band_gap", 1)], 15))
+        self.assertNotEqual(key, QueryResultCache.make_key(1, {"chemsys": "Fe-O", "nelements": 2}, [("band_gap", -1)], 15))
+
+    def test_shared_tier(self):
+        shared = QueryResultCache(LRUCache(), "default", 60)
+        shared.shared.clear()
+        self.addCleanup(shared.shared.clear)
+        shared.set("key", {"data": [1]})
+        # another worker: an empty local tier in front of the same shared cache
+        other = QueryResultCache(LRUCache(), "default", 60)
+        self.assertEqual(other.get("key"), {"data": [1]})
+        self.assertIsNone(other.get("missing"))
+        self.assertEqual(other.stats()["shared"], {"hits": 1, "misses": 1})
+        self.assertEqual(other.local.get("key"), {"data": [1]})
+        self.assertEqual(asyncio.run(other.aget("key")), {"data": [1]})
+
+    def test_generation_clears_registered_caches(self):
+        lru = register_generation_cache(LRUCache())
+        self.addCleanup(cache._generation_caches.remove, lru)
+        with mock.patch.dict(cache._generation, value=None, checked=0.0):
+            cache._set_generation(3)
+            lru.set("a", 1)
+            cache._set_generation(3)
+            self.assertEqual(lru.get("a"), 1)
+            cache._set_generation(4)
+            self.assertIsNone(lru.get("a"))
+
+class FilterTests(SimpleTestCase):
+
+    def test_compile_filters(self):
+        self.assertEqual(compile_filters(QueryDict("band_gap_min=1&band_gap_max=3&is_stable_eq=true&nelements_eq=2&chemsys=Fe-O")),
+                         {"band_gap": {"$gte": 1.0, "$lte": 3.0}, "is_stable": {"$eq": True}, "nelements": {"$eq": 2}})
+        self.assertEqual(compile_filters(QueryDict("is_metal_eq=0&density_max= 5.5")),
+                         {"is_metal": {"$eq": False}, "density": {"$lte": 5.5}})
+        self.assertEqual(compile_filters(QueryDict("")), {})
+
+    def test_invalid_values(self):
+        for query_string in ("band_gap_min=x", "band_gap_min=nan", "band_gap_max=inf", "nelements_min=2.5", "nelements_min=-1",
+                             "is_stable_eq=yes", "band_gap_min=3&band_gap_max=1", "density_min=-0.1"):
+            with self.subTest(query_string), self.assertRaises(FilterError):
+                compile_filters(QueryDict(query_string))
+
+    def test_unknown_operators_are_ignored(self):
+        # band_gap has no _eq, is_stable no _min: not filter parameters
+        self.assertEqual(compile_filters(QueryDict("band_gap_eq=1&is_stable_min=1")), {})
+
+    def test_index_specs(self):
+        indexed = [spec[0][0] for spec in filter_index_specs()]
+        self.assertIn("band_gap", indexed)
+        self.assertNotIn("is_metal", indexed)
+        self.assertTrue(all(spec[1] == ("material_id", 1) for spec in filter_index_specs()))
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class PartitionTests(SimpleTestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.docs = [dict(doc, structure={"lattice": {"a": i}, "sites": [{"label": "O"}] * (i % 3)}) for i, doc in enumerate(_summary_docs(20))]
+        self.split = write_split(self.db, "summary", ("structure",))
+        for doc in self.docs:
+            doc = dict(doc)
+            heavy = split_document(doc, self.split["fields"], self.split["key"])
+            self.db.summary.insert_one(doc)
+            self.db[self.split["companion"]].insert_one(heavy)
+
+    def find(self, projection:dict, batch_size:int = None) -> list:
+        main_projection, heavy_projection, added_key = split_projection(projection, read_split(self.db, "summary"))
+        cursor = self.db.summary.find({}, main_projection).sort("material_id", 1)
+        companion = self.db[self.split["companion"]]
+        if batch_size:
+            return list(join_split_batches(companion, self.split, cursor, heavy_projection, added_key, batch_size))
+        return join_split(companion, self.split, list(cursor), heavy_projection, added_key)
+
+    def test_split_record(self):
+        self.assertEqual(read_split(self.db, "summary"), {"companion": "summary_heavy", "fields": ["structure"], "key": "material_id"})
+        self.assertNotIn("structure", self.db.summary.find_one())
+        self.assertIsNone(write_split(self.db, "summary", ()))
+        self.assertIsNone(read_split(self.db, "summary"))
+
+    def test_split_projection(self):
+        self.assertEqual(split_projection({"_id": 0, "band_gap": 1}, None), ({"_id": 0, "band_gap": 1}, None, False))
+        self.assertEqual(split_projection({"_id": 0, "band_gap": 1}, self.split), ({"_id": 0, "band_gap": 1}, None, False))
+        self.assertEqual(split_projection({"_id": 0, "structure.lattice": 1}, self.split),
+                         ({"_id": 0, "material_id": 1}, {"_id": 0, "material_id": 1, "structure.lattice": 1}, True))
+        self.assertEqual(split_projection({"_id": 0}, self.split),
+                         ({"_id": 0}, {"_id": 0, "material_id": 1, "structure": 1}, False))
+
+    def test_round_trip(self):
+        expected = sorted(self.docs, key=lambda doc: doc["material_id"])
+        self.assertEqual(self.find({"_id": 0}), expected)
+        self.assertEqual(self.find({"_id": 0}, batch_size=7), expected)
+        self.assertEqual(self.find({"_id": 0, "band_gap": 1, "structure.lattice": 1}),
+                         [dict({"band_gap": doc["band_gap"]} if "band_gap" in doc else {}, structure={"lattice": doc["structure"]["lattice"]})
+                          for doc in expected])
+
+class BundleTests(SimpleTestCase):
+
+    def bundle(self) -> dict:
+        rng = numpy.random.default_rng(0)
+        return {
+            "material_id": "mp-1",
+            "bands": {"1": rng.normal(size=(8, 100)).tolist(), "-1": rng.normal(size=(8, 100)).tolist()},
+            "kpoints": rng.integers(-5, 5, size=(100, 3)).tolist(),
+            "labels": ["G", "X"],
+            # short and ragged lists stay lists
+            "efermi": [1.5],
+            "ragged": [[1.0, 2.0], [3.0]],
+        }
+
+    def test_round_trip(self):
+        bundle = self.bundle()
+        stored = encode_document(bundle, compression="zlib")
+        self.assertTrue(stored["bands"]["1"][ARRAY_FIELD])
+        self.assertEqual(stored["kpoints"]["dtype"], "<i4")
+        self.assertEqual(stored["efermi"], [1.5])
+        decoded = decode_document(stored)
+        numpy.testing.assert_array_equal(decoded["bands"]["1"], numpy.array(bundle["bands"]["1"]))
+        numpy.testing.assert_array_equal(decoded["kpoints"], numpy.array(bundle["kpoints"]))
+        self.assertEqual((decoded["labels"], decoded["ragged"]), (["G", "X"], [[1.0, 2.0], [3.0]]))
+        # float32 storage rounds, doesn't reshape
+        decoded = decode_document(encode_document(bundle, float_dtype="float32", compression="none"))
+        numpy.testing.assert_allclose(decoded["bands"]["-1"], numpy.array(bundle["bands"]["-1"]), rtol=1e-6)
+
+    def test_chunks(self):
+        bundle = self.bundle()
+        stored = encode_document(bundle, compression="none")
+        chunk_docs = split_chunks(stored, chunk_bytes=1000, inline_limit=10**6)
+        # every array of more than 1000 bytes is chunked, the other ones stay inline
+        self.assertEqual(sorted(chunked_paths(stored)), ["bands.-1", "bands.1", "kpoints"])
+        self.assertEqual(sorted({chunk["path"] for chunk in chunk_docs}), ["bands.-1", "bands.1", "kpoints"])
+        self.assertTrue(all(len(chunk["data"]) <= 1000 and chunk["bundle_id"] == stored["_id"] for chunk in chunk_docs))
+        with self.assertRaises(ValueError):
+            decode_document(stored)
+        chunks = {}
+        for chunk in sorted(chunk_docs, key=lambda chunk: (chunk["path"], chunk["n"])):
+            chunks[chunk["path"]] = chunks.get(chunk["path"], b"") + bytes(chunk["data"])
+        decoded = decode_document(stored, chunks)
+        numpy.testing.assert_array_equal(decoded["bands"]["1"], numpy.array(bundle["bands"]["1"]))
+        numpy.testing.assert_array_equal(decoded["kpoints"], numpy.array(bundle["kpoints"]))
+
+    def test_inline_limit(self):
+        stored = encode_document(self.bundle(), compression="none")
+        # the largest arrays leave until the document fits
+        split_chunks(stored, chunk_bytes=10**6, inline_limit=8000)
+        self.assertEqual(len(chunked_paths(stored)), 1)
+
+    @unittest.skipIf(mongomock is None, "needs mongomock")
+    def test_read_chunks(self):
+        chunks_collection = mongomock.MongoClient().db[chunks_name("bs")]
+        stored = encode_document(self.bundle())
+        chunks_collection.insert_many(split_chunks(stored, chunk_bytes=500, inline_limit=10**6))
+        decoded = decode_document(stored, read_chunks(chunks_collection, stored["_id"], chunked_paths(stored)))
+        numpy.testing.assert_array_equal(decoded["bands"]["-1"], numpy.array(self.bundle()["bands"]["-1"]))
+
+    def test_npz(self):
+        decoded = decode_document(encode_document(self.bundle()))
+        with numpy.load(io.BytesIO(to_npz(decoded))) as npz:
+            numpy.testing.assert_array_equal(npz["bands.1"], decoded["bands"]["1"])
+            self.assertEqual(json.loads(npz["__meta__"].item())["labels"], ["G", "X"])
+
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        for patch in (mock.patch.object(metrics, "_histograms", {}), mock.patch.object(metrics, "_shapes", set()),
+                      mock.patch.object(metrics, "SAMPLE_RATE", 1.0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def timer(self, mongo_seconds:float) -> StageTimer:
+        timer = StageTimer()
+        timer.stages.append(("mongo", mongo_seconds))
+        return timer
+
+    def test_query_shape(self):
+        self.assertEqual(query_shape({"elements": {"$all": ["Fe", "O"]}, "nelements": 3}),
+                         query_shape({"nelements": 2, "elements": {"$all": ["Li"]}}))
+        self.assertEqual(query_shape({"$and": [{"$or": [{"chemsys": "Fe-O"}]}]}), '{"$and": [{"$or": [{"chemsys": "?"}]}]}')
+
+    def test_server_timing(self):
+        timer = StageTimer()
+        with timer.stage("parse"):
+            pass
+        self.assertRegex(timer.server_timing(), r"^parse;dur=\d+\.\d\d, total;dur=\d+\.\d\d$")
+
+    def test_exposition(self):
+        shape = query_shape({"chemsys": "Fe-O"})
+        for seconds in (0.1, 0.2, 0.3):
+            record("index", shape, self.timer(seconds))
+        lines = exposition().splitlines()
+        self.assertEqual(lines[1], "# TYPE summary_stage_seconds summary")
+        labels = 'route="index",shape="{\\"chemsys\\": \\"?\\"}",stage="mongo"'
+        self.assertIn(f"summary_stage_seconds_count{{{labels}}} 3", lines)
+        self.assertIn(f"summary_stage_seconds_sum{{{labels}}} 0.600000", lines)
+        self.assertIn(f'summary_stage_seconds{{{labels},quantile="0.5"}} 0.200000', lines)
+        # every route is also recorded under the "*" shape
+        self.assertIn('summary_stage_seconds_count{route="index",shape="*",stage="mongo"} 3', lines)
+
+    def test_max_shapes(self):
+        with mock.patch.object(metrics, "MAX_SHAPES", 2):
+            for field in ("a", "b", "c", "d"):
+                record("index", query_shape({field: 1}), self.timer(0.1))
+        self.assertEqual({shape for route, shape, stage in metrics._histograms},
+                         {"*", query_shape({"a": 1}), query_shape({"b": 1}), "other"})
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class BatchTests(SimpleTestCase):
+
+    def setUp(self):
+        db = mongomock.MongoClient().db
+        db.summary.insert_many(_summary_docs(10))
+        patch = mock.patch.object(views, "db", db)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def post(self, body, content_type:str = "application/json"):
+        return views.batch(RequestFactory().post("/summary/batch/", body, content_type=content_type))
+
+    def test_invalid_requests(self):
+        for body in ('[1, 2]', '{"material_ids": "mp-1", "fields": [1]}', '{"material_ids": [1, 2]}', "{", '{"material_ids": []}',
+                     json.dumps({"material_ids": [f"mp-{i}" for i in range(views.BATCH_MAX_IDS + 1)]})):
+            with self.subTest(body[:40]):
+                self.assertEqual(self.post(body).status_code, 400)
+        self.assertEqual(views.batch(RequestFactory().put("/summary/batch/")).status_code, 405)
+
+    def test_documents_and_missing(self):
+        response = self.post(json.dumps({"material_ids": ["mp-3", "mp-1", "mp-99", "mp-3"], "fields": ["material_id", "nelements"]}))
+        content = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(set(content["data"]), {"mp-1", "mp-3"})
+        self.assertEqual(content["data"]["mp-3"], {"material_id": "mp-3", "nelements": _summary_docs(10)[3]["nelements"]})
+        self.assertEqual(content["missing"], ["mp-99"])
+        # a comma separated body, and the query string
+        response = self.post("mp-2,mp-4", "text/plain")
+        self.assertEqual(set(json.loads(b"".join(response.streaming_content))["data"]), {"mp-2", "mp-4"})
+        response = views.batch(RequestFactory().get("/summary/batch/?material_ids=mp-5&_fields=chemsys"))
+        self.assertEqual(json.loads(b"".join(response.streaming_content))["data"], {"mp-5": {"chemsys": _summary_docs(10)[5]["chemsys"]}})
+
+class ExplainTests(SimpleTestCase):
+
+    IXSCAN = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "chemsys_1", "keyPattern": {"chemsys": 1}}}
+
+    def test_plan_summary(self):
+        output = {"queryPlanner": {"winningPlan": self.IXSCAN},
+                   "executionStats": {"totalKeysExamined": 10, "totalDocsExamined": 10, "nReturned": 10, "executionTimeMillis": 2}}
+        self.assertEqual(plan_summary(output), {"winning_plan": ["FETCH", "IXSCAN chemsys_1"],
+                                                "indexes": [{"name": "chemsys_1", "keys": {"chemsys": 1}}],
+                                                "collection_scan": False, "keys_examined": 10, "docs_examined": 10,
+                                                "docs_returned": 10, "execution_ms": 2})
+
+    def test_nested_plans(self):
+        # in the $cursor stage of a pipeline, and in the queryPlan of slot based execution
+        cursor_stage = {"stages": [{"$cursor": {"queryPlanner": {"winningPlan": {"queryPlan": {"stage": "COLLSCAN"}}}}}, {"$sort": {}}]}
+        self.assertEqual(plan_summary(cursor_stage), {"winning_plan": ["COLLSCAN"], "indexes": [], "collection_scan": True})
+        or_plan = {"queryPlanner": {"winningPlan": {"stage": "OR", "inputStages": [self.IXSCAN, {"stage": "COLLSCAN"}]}}}
+        self.assertEqual(plan_summary(or_plan)["winning_plan"], ["OR", "FETCH", "IXSCAN chemsys_1", "COLLSCAN"])
+        self.assertEqual(plan_summary({}), {"winning_plan": [], "indexes": [], "collection_scan": None})
+
+    def test_slow_query_log(self):
+        log = SlowQueryLog(max_entries=2)
+        with mock.patch.object(explain, "SLOW_QUERY_MS", 500):
+            self.assertTrue(log.is_slow(0.5))
+            self.assertFalse(log.is_slow(0.1))
+        with mock.patch.object(explain, "SLOW_QUERY_MS", None):
+            self.assertFalse(log.is_slow(60))
+        with self.assertLogs("summary.slow_queries", "WARNING"):
+            for route in ("index", "facets", "export"):
+                log.add(route, "{}", 0.6, {})
+        self.assertEqual([entry["route"] for entry in log.latest()], ["facets", "export"])
+        self.assertEqual(log.latest()[0]["ms"], 600.0)
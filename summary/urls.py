@@ -1,10 +1,19 @@
 from django.urls import path
 
-from . import views
+from . import views, async_views
 
 app_name = "summary"
 urlpatterns = [
     path("", views.index, name="index"),
-    # path("<int:materialID_num>/", views.detail, name="detail"),
+    path("cache/stats/", views.cache_stats, name="cache_stats"),
+    path("metrics/", views.metrics, name="metrics"),
+    path("slow_queries/", views.slow_queries, name="slow_queries"),
+    path("export/", views.export, name="export"),
+    path("facets/", views.facets, name="facets"),
+    path("batch/", views.batch, name="batch"),
+    path("bundles/<str:col>/<str:bundle_id>/", views.bundle, name="bundle"),
+    path("async/", async_views.index, name="async_index"),
+    path("async/<str:materialID_str>/", async_views.detail_dash, name="async_detail_dash"),
+    path("<int:materialID_num>/", views.detail, name="detail"),
     path("<str:materialID_str>/", views.detail_dash, name="detail_dash"),
 ]
\ No newline at end of file
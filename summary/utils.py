@@ -36,6 +36,30 @@ def generate_all_chemsyses_from_wildcard(elements):
             all_chemsyses.append({"chemsys": {"$regex": regex_pattern}})
     return all_chemsyses
 
+def chemsys_query_from_wildcard(elements):
+    """
+    build an index friendly query for a chemsys with wildcards, based on the precomputed
+    elements and nelements fields instead of regexes. Every wildcard stands for exactly
+    one element other than the given ones
+
+    Args:
+        elements list(str): chemical elements and wildcards
+
+    Returns:
+        dict: A query on elements and nelements
+
+    Example usage:
+        elements = "Li-Fe-*".split('-')
+        result = chemsys_query_from_wildcard(elements)
+        print(result)
+        >> {"elements": {"$all": ["Fe", "Li"]}, "nelements": 3}
+    """
+    fixed_elements = sorted(set(element for element in elements if element != '*'))
+    nelements = len(fixed_elements) + elements.count('*')
+    if len(fixed_elements) == 0:
+        return {"nelements": nelements}
+    return {"elements": {"$all": fixed_elements}, "nelements": nelements}
+
 def extract_components(chemical_formula):
     """
     Extracts the components from a chemical formula.
@@ -139,4 +163,18 @@ def float_to_fraction(float_value, tolerance = 1e-4, limit_denominator = 2**6):
         else:
             return f"{float_value:.4f}"
     except (ValueError, OverflowError):
-        return f"{float_value:.4f}"
\ No newline at end of file
+        return f"{float_value:.4f}"
+
+def get_dotted(doc:dict, field:str):
+    """
+    Returns the value of a dotted field of a document, None if it is missing.
+
+    Example usage:
+        get_dotted({"symmetry": {"crystal_system": "Cubic"}}, "symmetry.crystal_system")
+        >> 'Cubic'
+    """
+    for key in field.split('.'):
+        if type(doc) is not dict:
+            return None
+        doc = doc.get(key)
+    return doc
@@ -1,227 +1,743 @@
 from django.shortcuts import render
-from django.http import HttpResponse
-import pymongo, json
-# from pymatgen.core import Structure
-# from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-# import crystal_toolkit.components as ctc
-from .utils import extract_components, extract_components_with_wildcard, float_to_fraction, verified_elements
-from .utils import get_formula_anonymous, generate_all_chemsyses_from_wildcard
-from .utils import replace_nd_array
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from bson import json_util
+import pymongo, json, base64, zlib, logging
+from .utils import extract_components, extract_components_with_wildcard, verified_elements
+from .utils import get_formula_anonymous, generate_all_chemsyses_from_wildcard, chemsys_query_from_wildcard, get_dotted
+from .cache import LRUCache, QueryResultCache, register_generation_cache, current_generation
+from .generation import INGESTION_FIELDS
+from .metrics import StageTimer, query_shape, record, exposition
+from .explain import explain_command, plan_summary, slow_query_log, SLOW_QUERY_MS, SLOW_QUERY_VERBOSITY
+from .responses import dumps, encoded_response, detail_etag, if_none_match, not_modified, cache_control
+from .detail import find_detail, compute_and_store_detail
+from .columnar import ColumnarEngine, Unsupported
+from .filters import compile_filters, FilterError
+from .formula import FORMULA_FIELD, canonical_formula
+from .facets import parse_facets, facet_pipeline, facet_results
+from .partition import read_split, split_projection, is_split_field, join_split, join_split_batches
+from .bundles import BUNDLE_KEYS, chunks_name, chunked_paths, read_chunks, decode_document, to_npz
+from arg_enums import Bundle_col
 
 
-client = pymongo.MongoClient()
-db = client.matproj_s3
+# debug logging of the query parameters and compiled queries, opt-in through LOGGING
+query_logger = logging.getLogger("summary.queries")
+# payloads of the detail view that fail to compute on demand
+detail_logger = logging.getLogger("summary.detail")
+
+client = pymongo.MongoClient(getattr(settings, "SUMMARY_MONGO_URI", None))
+db = client[getattr(settings, "SUMMARY_MONGO_DB", "matproj_s3")]
+
+# "elements" matches wildcards with index friendly queries on elements/nelements,
+# "regex" with the permutations of anchored chemsys regexes
+WILDCARD_STRATEGY = getattr(settings, "SUMMARY_WILDCARD_STRATEGY", "elements")
+
+# "reduced" matches a formula exactly on the canonical reduced formula stored at ingestion (see formula.py),
+# and on formula_anonymous + chemsys for the documents without it, "anonymous" only on formula_anonymous + chemsys
+FORMULA_SEARCH = getattr(settings, "SUMMARY_FORMULA_SEARCH", "reduced")
+
+COUNT_ESTIMATE_LIMIT = getattr(settings, "SUMMARY_COUNT_ESTIMATE_LIMIT", 10000)
+count_cache = register_generation_cache(LRUCache(getattr(settings, "SUMMARY_COUNT_CACHE_SIZE", 10000),
+                                                 getattr(settings, "SUMMARY_COUNT_CACHE_TTL", 3600)))
+result_cache = QueryResultCache(register_generation_cache(LRUCache(getattr(settings, "SUMMARY_RESULT_CACHE_SIZE", 1024),
+                                                                   getattr(settings, "SUMMARY_RESULT_CACHE_TTL", 600))),
+                                getattr(settings, "SUMMARY_RESULT_CACHE_ALIAS", None),
+                                getattr(settings, "SUMMARY_RESULT_CACHE_TTL", 600))
+
+EXPORT_BATCH_SIZE = getattr(settings, "SUMMARY_EXPORT_BATCH_SIZE", 1000)
+EXPORT_CHUNK_BYTES = 2**16
+
+BATCH_MAX_IDS = getattr(settings, "SUMMARY_BATCH_MAX_IDS", 1000)
+
+# searches on the scalar fields are evaluated on in-memory columns, see columnar.py
+columnar_engine = ColumnarEngine(db['summary']) if getattr(settings, "SUMMARY_COLUMNAR_ENGINE", False) else None
+
+# band structure and DOS bundles, see bundles.py
+bundle_db = client[getattr(settings, "SUMMARY_BUNDLE_MONGO_DB", "matproj")]
+BUNDLE_COLLECTIONS = {col.value for col in Bundle_col}
+
+# the heavy fields s3_migrator moved out of summary (see partition.py), read once per generation
+split_cache = register_generation_cache(LRUCache(16, 3600))
 
 # Create your views here.
 
-def _pipeline(query_json:dict = {}, skip:int = 0, limit:int = 15, project_json:dict = {"_id": 0}, sort_list:list = []):
+def _wildcard_chemsys_query(elements):
+    if WILDCARD_STRATEGY == "regex":
+        return {"$or": generate_all_chemsyses_from_wildcard(elements)}
+    return chemsys_query_from_wildcard(elements)
+
+def _normalized_query(query_json:dict) -> str:
+    return json_util.dumps(query_json, sort_keys=True)
+
+def _total_doc(query_json:dict = {}, count_mode:str = "exact") -> dict:
+    """
+        Returns the meta of the total number of documents matching query_json
+            exact    : counted, and cached per normalized query and ingestion generation
+            estimate : the cached count if there is one, else the collection metadata
+                       for an empty query or a count capped at COUNT_ESTIMATE_LIMIT
+            none     : not counted
+    """
+    if count_mode == "none":
+        return {"total_doc": None}
     collection = db['summary']
-    pipeline =[{
-        "$facet": {
-            "data": [
-                {"$match": query_json},
-                {"$skip": skip},
-                {"$limit": limit},
-                {"$project": project_json}
-            ],
-            "meta" : [{"$match": query_json},
-                    #   {"$match": {"tags": {"exists": False}}},
-                      {"$count": "total_doc"}]
-        }
-    }]
-    pipeline[0]["$facet"]["data"].extend([{"$sort": {sort[0]: sort[1]}} for sort in sort_list])
-    paginated_response = list(collection.aggregate(pipeline))
-    paginated_response[0]["meta"] = paginated_response[0]["meta"][0]
-    return paginated_response[0]
+    cache_key = (current_generation(db), _normalized_query(query_json))
+    total_doc = count_cache.get(cache_key)
+    if total_doc is not None:
+        return {"total_doc": total_doc}
+    if count_mode == "estimate":
+        if not query_json:
+            return {"total_doc": collection.estimated_document_count(), "total_doc_estimated": True}
+        total_doc = collection.count_documents(query_json, limit=COUNT_ESTIMATE_LIMIT)
+        if total_doc == COUNT_ESTIMATE_LIMIT:
+            return {"total_doc": total_doc, "total_doc_estimated": True}
+    else:
+        total_doc = collection.count_documents(query_json)
+    count_cache.set(cache_key, total_doc)
+    return {"total_doc": total_doc}
 
-def index(request):
-    # query builder
-    query_json = {}
-    print("===========Query_params=================")
-    for key, value in request.GET.items():
-        print(f"{key}: {value}")
-    print("=========== End =================")
+def _skip_pipeline(query_json:dict = {}, skip:int = 0, limit:int = 15, project_json:dict = {"_id": 0}, sort_list:list = []) -> list:
+    pipeline = [{"$match": query_json}]
+    if sort_list:
+        pipeline.append({"$sort": {sort[0]: sort[1] for sort in sort_list}})
+    pipeline.extend([
+        {"$skip": skip},
+        {"$limit": limit},
+        {"$project": project_json}
+    ])
+    return pipeline
+
+def _pipeline(query_json:dict = {}, skip:int = 0, limit:int = 15, project_json:dict = {"_id": 0}, sort_list:list = [], count_mode:str = "exact"):
+    collection = db['summary']
+    pipeline = _skip_pipeline(query_json, skip, limit, project_json, sort_list)
+    data = list(collection.aggregate(pipeline, allowDiskUse=True))
+    return {"data": data, "meta": _total_doc(query_json, count_mode)}
+
+def _encode_cursor(last_values:list) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(last_values).encode()).decode()
+
+def _decode_cursor(cursor:str, sort_list:list) -> list:
+    """ raises ValueError for tokens that were not made by _encode_cursor for the sort of sort_list """
+    last_values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if type(last_values) is not list or len(last_values) != len(sort_list):
+        raise ValueError("Invalid cursor")
+    # the values go into equality and range clauses as they are, documents would be read as operators
+    if any(isinstance(value, (dict, list)) for value in last_values):
+        raise ValueError("Invalid cursor")
+    return last_values
+
+def _pop_dotted(doc:dict, field:str):
+    # removes field and the parent documents it leaves empty
+    parent_key, _, key = field.rpartition('.')
+    parent = get_dotted(doc, parent_key) if parent_key else doc
+    if type(parent) is dict:
+        parent.pop(key, None)
+        if parent_key and len(parent) == 0:
+            _pop_dotted(doc, parent_key)
+
+def _keyset_query(sort_list:list, last_values:list) -> dict:
+    """
+        Builds the query for the documents that come after last_values in the sort order.
+        Missing/null values sort before everything else in mongodb
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(sort_list):
+        clause = {sort[0]: value for sort, value in zip(sort_list[:i], last_values[:i])}
+        value = last_values[i]
+        if value is None:
+            if direction == -1:
+                # nothing comes after null in a descending sort
+                continue
+            clause[field] = {"$ne": None}
+        elif direction == 1:
+            clause[field] = {"$gt": value}
+        else:
+            clause["$or"] = [{field: {"$lt": value}}, {field: None}]
+        clauses.append(clause)
+    return {"$or": clauses} if clauses else {"_id": {"$in": []}}
+
+def _keyset_plan(query_json:dict = {}, cursor:str = '', limit:int = 15, project_json:dict = {"_id": 0}, sort_list:list = []):
+    """
+        Cursor based pagination: the page starts after the sort key and material_id
+        encoded in cursor, so it costs the same at any depth and the sort can be served by an index.
+        Returns the pipeline, the full sort list and the fields added to the projection for the cursor
+    """
+    sort_list = list(sort_list)
+    if "material_id" not in [sort[0] for sort in sort_list]:
+        sort_list.append(("material_id", 1))
+    page_query_json = query_json
+    if cursor:
+        keyset_json = _keyset_query(sort_list, _decode_cursor(cursor, sort_list))
+        page_query_json = {"$and": [query_json, keyset_json]} if query_json else keyset_json
+    # the sort fields are needed to make the next cursor
+    added_fields = []
+    for field, _ in sort_list:
+        if not any(field == requested or field.startswith(requested + '.') or requested.startswith(field + '.')
+                   for requested in project_json if requested != "_id"):
+            added_fields.append(field)
+    project_json = dict(project_json, **{field: 1 for field in added_fields})
+    pipeline = [
+        {"$match": page_query_json},
+        {"$sort": {sort[0]: sort[1] for sort in sort_list}},
+        {"$limit": limit + 1},
+        {"$project": project_json},
+    ]
+    return pipeline, sort_list, added_fields
+
+def _keyset_page(data:list, limit:int, sort_list:list, added_fields:list):
+    """ trims the extra document fetched by the keyset pipeline and makes the next cursor """
+    next_cursor = None
+    if len(data) > limit:
+        data = data[:limit]
+        next_cursor = _encode_cursor([get_dotted(data[-1], sort[0]) for sort in sort_list])
+    for doc in data:
+        for field in added_fields:
+            _pop_dotted(doc, field)
+    return data, next_cursor
+
+def _keyset_pipeline(query_json:dict = {}, cursor:str = '', limit:int = 15, project_json:dict = {"_id": 0}, sort_list:list = [], count_mode:str = "exact"):
+    collection = db['summary']
+    pipeline, sort_list, added_fields = _keyset_plan(query_json, cursor, limit, project_json, sort_list)
+    data, next_cursor = _keyset_page(list(collection.aggregate(pipeline)), limit, sort_list, added_fields)
+    return {"data": data, "meta": dict(_total_doc(query_json, count_mode), next_cursor=next_cursor)}
+
+def _columnar_page(generation:int, query_json:dict = {}, cursor:str = None, skip:int = 0, limit:int = 15, sort_list:list = [], count_mode:str = "exact"):
+    """
+        The material ids and meta of a page evaluated on the columns of a generation.
+        None if the columns aren't loaded or can't evaluate it
+    """
+    if columnar_engine is None:
+        return None
+    columns = columnar_engine.ready(generation)
+    if columns is None:
+        return None
+    last_values = None
+    if cursor is not None:
+        sort_list = list(sort_list)
+        if "material_id" not in [sort[0] for sort in sort_list]:
+            sort_list.append(("material_id", 1))
+        last_values = _decode_cursor(cursor, sort_list) if cursor else None
+    try:
+        rows, total_doc = columns.select(query_json, sort_list, skip, limit + (1 if cursor is not None else 0), last_values)
+    except Unsupported as error:
+        query_logger.debug("columnar engine fallback: %s", error)
+        return None
+    meta = {"total_doc": total_doc if count_mode != "none" else None}
+    if cursor is not None:
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_cursor([columns.value(field, rows[-1]) for field, _ in sort_list])
+        meta["next_cursor"] = next_cursor
+    return [columns.value("material_id", row) for row in rows], meta
+
+def _columnar_docs(found_docs, material_ids:list, project_json:dict) -> list:
+    """ the documents of a columnar page (found with project_json plus material_id), in the order of the columns """
+    # material_id is only sent if it was asked for
+    keep_material_id = "material_id" in project_json
+    docs = {}
+    for doc in found_docs:
+        docs.setdefault(doc["material_id"] if keep_material_id else doc.pop("material_id"), doc)
+    return [docs[material_id] for material_id in material_ids if material_id in docs]
+
+def _columnar_search(query_json:dict = {}, cursor:str = None, skip:int = 0, limit:int = 15, project_json:dict = {"_id": 0}, sort_list:list = [], count_mode:str = "exact"):
+    """
+        The response of a search evaluated on the columns of the current generation, with a single
+        $in query for the documents of the page. None if the columns aren't loaded or can't evaluate it
+    """
+    if columnar_engine is None:
+        return None
+    page = _columnar_page(current_generation(db), query_json, cursor, skip, limit, sort_list, count_mode)
+    if page is None:
+        return None
+    material_ids, meta = page
+    found_docs = db['summary'].find({"material_id": {"$in": material_ids}}, dict(project_json, material_id=1))
+    return {"data": _columnar_docs(found_docs, material_ids, project_json), "meta": meta}
+
+def _summary_split() -> dict:
+    """ the split record of summary, None if every field is in summary """
+    key = ("summary", current_generation(db))
+    split = split_cache.get(key)
+    if split is None:
+        split = read_split(db, "summary") or {}
+        split_cache.set(key, split)
+    return split or None
+
+def _split_sort_error(sort_list:list, split:dict) -> str:
+    for field, _ in sort_list:
+        if split and is_split_field(field, split):
+            return f"Can't sort on {field}, it is stored apart from the searchable fields"
+    return None
 
-    if "chemsys" in request.GET:
-        elements = request.GET["chemsys"].split('-')
+def _build_query(query_params) -> dict:
+    """
+        Compiles the search parameters of the summary endpoints into a mongodb query,
+        raises FilterError for invalid filter values or formulas
+    """
+    query_json = {}
+    if "chemsys" in query_params:
+        elements = query_params["chemsys"].split('-')
         if '*' in elements:
-            # if wildcard is used for search, then generate all the possible combination of chemsyses
-            all_chemsyses = generate_all_chemsyses_from_wildcard(elements)
+            # if wildcard is used for search, then match the given elements and the number of elements
+            wildcard_query = _wildcard_chemsys_query(elements)
             if "$and" in query_json:
-                query_json["$and"].append({"$or": all_chemsyses})
+                query_json["$and"].append(wildcard_query)
             else:
-                query_json["$and"] = [{"$or": all_chemsyses}]
+                query_json["$and"] = [wildcard_query]
         else:
             query_json["chemsys"] = "-".join(sorted(elements))
 
-    if "elements" in request.GET:
-        elements = verified_elements(request.GET["elements"].split(','))
+    if "elements" in query_params:
+        elements = verified_elements(query_params["elements"].split(','))
         if "elements" in query_json:
             query_json["elements"].update({"$all": elements})
         else:    
             query_json["elements"] = {"$all": elements}
 
-    if "exclude_elements" in request.GET:
-        exclude_elements = verified_elements(request.GET["exclude_elements"].split(','))
+    if "exclude_elements" in query_params:
+        exclude_elements = verified_elements(query_params["exclude_elements"].split(','))
         if "elements" in query_json:
             query_json["elements"].update({"$nin": exclude_elements})
         else:    
             query_json["elements"] = {"$nin": exclude_elements}
 
-    if "formula" in request.GET:
-        formula = request.GET["formula"]
+    if "formula" in query_params:
+        formula = query_params["formula"]
         # if chemical formula is used, then extract formula_anonymous and chemsys, then run search 
-        if '*' in request.GET["formula"]:
+        if '*' in query_params["formula"]:
             # if wildcard is used in formula, then generate all chemsyses and formula_anonymous
             normal_components = extract_components(formula)
             wildcard_components = extract_components_with_wildcard(formula)
             elements = list(normal_components.keys())
             elements.extend(["*" for wildcard in wildcard_components])
-            print(">>> elements", elements)
-            all_chemsyses = generate_all_chemsyses_from_wildcard(elements)
+            query_logger.debug("wildcard formula elements: %s", elements)
+            wildcard_query = _wildcard_chemsys_query(elements)
             if "$and" in query_json:
-                query_json["$and"].append({"$or": all_chemsyses})
+                query_json["$and"].append(wildcard_query)
             else:
-                query_json["$and"] = [{"$or": all_chemsyses}]
+                query_json["$and"] = [wildcard_query]
             # get formula_anonymous
             normal_components.update(wildcard_components)
             query_json["formula_anonymous"] = get_formula_anonymous(normal_components)
+        elif FORMULA_SEARCH == "reduced":
+            # a document without the reduced formula (ingested before it existed) is matched as with "anonymous"
+            components = extract_components(formula)
+            formula_query = {"$or": [{FORMULA_FIELD: canonical_formula(formula)},
+                                     {FORMULA_FIELD: None,
+                                      "formula_anonymous": get_formula_anonymous(components),
+                                      "chemsys": "-".join(sorted(list(components.keys())))}]}
+            if "$and" in query_json:
+                query_json["$and"].append(formula_query)
+            else:
+                query_json["$and"] = [formula_query]
         else:
             components = extract_components(formula)
             query_json["formula_anonymous"] = get_formula_anonymous(components)
             query_json["chemsys"] = "-".join(sorted(list(components.keys())))
 
-    if "material_ids" in request.GET:
-        material_ids = request.GET["material_ids"]
+    if "material_ids" in query_params:
+        material_ids = query_params["material_ids"]
         mp_ids = [mp_id.strip() for mp_id in material_ids.split(',')]
         query_json["material_id"] = {"$in":mp_ids}
 
-    if "nelements_min" in request.GET or "nelements_max" in request.GET:
-        nelements_query = {}
-        if "nelements_min" in request.GET:
-            nelements_query["$gte"] = int(request.GET["nelements_min"])
-        if "nelements_max" in request.GET:
-            nelements_query["$lte"] = int(request.GET["nelements_max"])
-        query_json["nelements"] = nelements_query
+    # <field>_min, <field>_max and <field>_eq of the filter registry
+    query_json.update(compile_filters(query_params))
+    return query_json
 
-
-    print("===========Query_JSON=================")
-    print(query_json)
-    print("=========== End =================")
-    # get options for the query
-    required_fields = request.GET['_fields'].split(',')
+def _build_options(query_params, default_fields:list = None):
+    """
+        Returns the projection and the sort list of the _fields and _sort_fields parameters
+    """
     required_fields_json = {"_id": 0}
+    if '_fields' in query_params or default_fields is None:
+        required_fields = query_params['_fields'].split(',')
+    else:
+        required_fields = default_fields
     for required_field in required_fields:
         required_fields_json[required_field] = 1
     sort_fields_list = []
-    if '_sort_fields' in request.GET:
-        sort_fields = request.GET['_sort_fields'].split(',')
+    if '_sort_fields' in query_params:
+        sort_fields = query_params['_sort_fields'].split(',')
         for sort_field in sort_fields:
             if sort_field.startswith('-'):
                 sort_fields_list.append((sort_field[1:], -1))
             else:
                 sort_fields_list.append((sort_field, 1))
-    limit_docs = int(request.GET['_limit'])
-    skip_docs = int(request.GET['_skip'])
-    # run query and return response
-    response = _pipeline(query_json,skip_docs,limit_docs,required_fields_json,sort_fields_list)
-    print("===========Response=================")
-    print(response)
-    print("=========== End =================")
-    return HttpResponse(json.dumps(response))
-
-
-# def detail(request, materialID_num):
-#     print(request)
-#     print("---------")
-#     print(materialID_num)
-#     materialID = f"mp-{materialID_num}"
-#     # get summary data
-#     collection = db['summary']
-#     project = {"_id": 0, 
-#                "formula_pretty": 1, 
-#                "energy_above_hull": 1,
-#                "symmetry.symbol": 1,
-#                "band_gap": 1,
-#                "formation_energy_per_atom": 1,
-#                "ordering": 1,
-#                "total_magnetization": 1,
-#                "theoretical": 1,
-#                "structure": 1,
-#                }
-#     result = collection.find_one({"material_id": materialID}, project)
-#     magnetic_ordering = {
-#         'NM': 'Non-magnetic', 
-#         'FM': 'Ferro-magnetic', 
-#         'FiM': 'Ferrimagnetic'
-#     }
-#     summary_data = {
-#       'Energy Above Hull': f"{result['energy_above_hull']:.3f} eV/atom",
-#       'Space Group': f"{result['symmetry']['symbol']}",
-#       'Band Gap': f"{result['band_gap']:.2f} eV",
-#       'Predicted Formation Energy': f"{result['formation_energy_per_atom']:.3f} eV/atom",
-#       'Magnetic Ordering': magnetic_ordering[result['ordering']],
-#       'Total Magnetization': f"{result['total_magnetization']:.2f} µB/f.u.",
-#       'Experimentally Observed': 'No' if result['theoretical'] else 'Yes',
-#     }
-#     lattice = result['structure']['lattice']
-#     lattice_data ={
-#         'a': f"{lattice['a']:.2f} Å",
-#         'b': f"{lattice['b']:.2f} Å",
-#         'c': f"{lattice['c']:.2f} Å",
-#         'α': f"{lattice['alpha']:.2f} º",
-#         'β': f"{lattice['beta']:.2f} º",
-#         'ɣ': f"{lattice['gamma']:.2f} º",
-#     }
-#     # get CrystalToolkit Scene & legend data
-#     pymat_structure = Structure.from_dict(result['structure'])
-#     structure_component = ctc.StructureMoleculeComponent(pymat_structure, id="my_structure")
-#     scene_data = structure_component.initial_data['scene']
-#     legend_data = structure_component.initial_data['legend_data']
-#     replace_nd_array(scene_data)
-#     # get description data
-#     description = db['robocrys'].find({"material_id": materialID}, {"_id": 0, "description": 1}).next()
-#     # get symmetry data
-#     sg_analyzer = SpacegroupAnalyzer(pymat_structure)
-#     sym_dataset = sg_analyzer.get_symmetry_dataset()
-#     sym_data = {
-#         "Crystal System": sg_analyzer.get_crystal_system().capitalize(),
-#         "Lattice System": sg_analyzer.get_lattice_type().capitalize(),
-#         "Hall Number": sym_dataset['hall'],
-#         "International Number": sym_dataset['number'],
-#         "Symbol": sym_dataset['international'],
-#         "Point Group": sym_dataset['pointgroup'],
-#     }
-#     # get Wyckoff sites
-#     sym_struct = sg_analyzer.get_symmetrized_structure()
-#     wyckoff_data = sorted(
-#                           zip(sym_struct.wyckoff_symbols, sym_struct.equivalent_sites),
-#                           key=lambda x: "".join(filter(str.isalpha, x[0])),
-#                          )
-#     wyckoff_sites = []
-#     for sym_sites in wyckoff_data:
-#         site_symbol = sym_sites[0]
-#         wyckoff_site = sym_sites[1][0]
-#         wyckoff_sites.append({
-#                 "Wyckoff": site_symbol,
-#                 "Element": f"{wyckoff_site.specie}",
-#                 "x": float_to_fraction(wyckoff_site.a),
-#                 "y": float_to_fraction(wyckoff_site.b),
-#                 "z": float_to_fraction(wyckoff_site.c),
-#             })
-#     # response with data
-#     response = {
-#         "summary_data": summary_data,
-#         "lattice_data": lattice_data,
-#         "scene_data": scene_data,
-#         "legend_data": legend_data,
-#         "description": description,
-#         "sym_data": sym_data,
-#         "wyckoff_sites": wyckoff_sites,
-#     }
-#     return HttpResponse(json.dumps({"data": response}))
+    return required_fields_json, sort_fields_list
+
+def _page_options(query_params):
+    """
+        Returns limit, skip, cursor and count mode of a search, raises ValueError for invalid values
+    """
+    limit_docs = int(query_params['_limit'])
+    skip_docs = int(query_params.get('_skip', 0))
+    cursor = query_params.get('_cursor')
+    count_mode = query_params.get('_count', 'exact')
+    if count_mode not in ("none", "estimate", "exact"):
+        raise ValueError("_count must be one of none, estimate, exact")
+    return limit_docs, skip_docs, cursor, count_mode
+
+def _search_pipeline(query_json:dict, cursor:str, skip:int, limit:int, project_json:dict, sort_list:list) -> list:
+    if cursor is not None:
+        return _keyset_plan(query_json, cursor, limit, project_json, sort_list)[0]
+    return _skip_pipeline(query_json, skip, limit, project_json, sort_list)
+
+def _explain(pipeline:list, verbosity:str = "executionStats") -> dict:
+    return db.command({"explain": explain_command("summary", pipeline), "verbosity": verbosity})
+
+def _log_if_slow(route:str, query_json:dict, pipeline:list, seconds:float):
+    if not slow_query_log.is_slow(seconds):
+        return
+    try:
+        plan = plan_summary(_explain(pipeline, SLOW_QUERY_VERBOSITY))
+    except pymongo.errors.PyMongoError as error:
+        plan = {"error": str(error)}
+    slow_query_log.add(route, query_shape(query_json), seconds, plan)
+
+def index(request):
+    timer = StageTimer()
+    query_logger.debug("query params: %s", dict(request.GET.items()))
+    # get options for the query
+    with timer.stage("parse"):
+        required_fields_json, sort_fields_list = _build_options(request.GET)
+        try:
+            limit_docs, skip_docs, cursor, count_mode = _page_options(request.GET)
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+    # query builder
+    with timer.stage("compile"):
+        try:
+            query_json = _build_query(request.GET)
+        except FilterError as error:
+            return HttpResponseBadRequest(str(error))
+    query_logger.debug("query json: %s", query_json)
+    # the fields of the companion collection are joined on the documents of the page
+    split = _summary_split()
+    sort_error = _split_sort_error(sort_fields_list, split)
+    if sort_error:
+        return HttpResponseBadRequest(sort_error)
+    main_fields_json, heavy_fields_json, added_key = split_projection(required_fields_json, split)
+    if request.GET.get('_explain') in ('1', 'true'):
+        try:
+            pipeline = _search_pipeline(query_json, cursor, skip_docs, limit_docs, main_fields_json, sort_fields_list)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid _cursor")
+        explain = _explain(pipeline)
+        return HttpResponse(json_util.dumps({"query": query_json, "pipeline": pipeline,
+                                             "plan": plan_summary(explain), "explain": explain}),
+                            content_type="application/json")
+    # run query (or take it from the result cache) and return response
+    cache_key = QueryResultCache.make_key(current_generation(db), query_json, required_fields_json, sort_fields_list,
+                                          cursor, skip_docs, limit_docs, count_mode)
+    with timer.stage("cache"):
+        response = result_cache.get(cache_key)
+    if response is None and columnar_engine is not None:
+        with timer.stage("columnar"):
+            try:
+                response = _columnar_search(query_json, cursor, skip_docs, limit_docs, main_fields_json, sort_fields_list, count_mode)
+            except ValueError:
+                return HttpResponseBadRequest("Invalid _cursor")
+        if response is not None:
+            if heavy_fields_json is not None:
+                with timer.stage("join"):
+                    join_split(db[split["companion"]], split, response["data"], heavy_fields_json, added_key)
+            result_cache.set(cache_key, response)
+    if response is None:
+        with timer.stage("mongo"):
+            if cursor is not None:
+                try:
+                    response = _keyset_pipeline(query_json,cursor,limit_docs,main_fields_json,sort_fields_list,count_mode)
+                except ValueError:
+                    return HttpResponseBadRequest("Invalid _cursor")
+            else:
+                response = _pipeline(query_json,skip_docs,limit_docs,main_fields_json,sort_fields_list,count_mode)
+        if heavy_fields_json is not None:
+            with timer.stage("join"):
+                join_split(db[split["companion"]], split, response["data"], heavy_fields_json, added_key)
+        result_cache.set(cache_key, response)
+        _log_if_slow("index", query_json,
+                     _search_pipeline(query_json, cursor, skip_docs, limit_docs, main_fields_json, sort_fields_list),
+                     timer.seconds("mongo"))
+    with timer.stage("serialize"):
+        http_response = encoded_response(request, dumps(response))
+    query_logger.debug("response: %d documents, %d bytes", len(response["data"]), len(http_response.content))
+    record("index", query_shape(query_json), timer)
+    http_response["Server-Timing"] = timer.server_timing()
+    return http_response
+
+def facets(request):
+    """
+        Distributions of the documents matching the search parameters of index (facets=nelements,
+        elements,crystal_system,band_gap by default, <name>_bin for the width of a histogram),
+        computed in one aggregation and cached per query and ingestion generation
+    """
+    timer = StageTimer()
+    with timer.stage("compile"):
+        try:
+            query_json = _build_query(request.GET)
+            requested_facets = parse_facets(request.GET)
+        except FilterError as error:
+            return HttpResponseBadRequest(str(error))
+    pipeline = facet_pipeline(query_json, requested_facets)
+    if request.GET.get('_explain') in ('1', 'true'):
+        explain = _explain(pipeline)
+        return HttpResponse(json_util.dumps({"query": query_json, "pipeline": pipeline,
+                                             "plan": plan_summary(explain), "explain": explain}),
+                            content_type="application/json")
+    cache_key = QueryResultCache.make_key(current_generation(db), "facets", query_json, requested_facets)
+    with timer.stage("cache"):
+        response = result_cache.get(cache_key)
+    if response is None:
+        with timer.stage("mongo"):
+            response = facet_results(next(db['summary'].aggregate(pipeline, allowDiskUse=True)), requested_facets)
+        result_cache.set(cache_key, response)
+        _log_if_slow("facets", query_json, pipeline, timer.seconds("mongo"))
+    with timer.stage("serialize"):
+        http_response = encoded_response(request, dumps(response))
+    record("facets", query_shape(query_json), timer)
+    http_response["Server-Timing"] = timer.server_timing()
+    return http_response
+
+def _ndjson_chunks(cursor):
+    # groups the serialized documents into chunks of about EXPORT_CHUNK_BYTES
+    lines = []
+    num_bytes = 0
+    for doc in cursor:
+        line = dumps(doc) + b"\n"
+        lines.append(line)
+        num_bytes += len(line)
+        if num_bytes >= EXPORT_CHUNK_BYTES:
+            yield b"".join(lines)
+            lines = []
+            num_bytes = 0
+    if lines:
+        yield b"".join(lines)
+
+def _gzip_chunks(chunks):
+    # every chunk is flushed, so the client receives data while the export is running
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def export(request):
+    """
+        Streams every document matching the search parameters of index as NDJSON
+        (_compress=gzip for a gzipped file), the whole documents unless _fields is given.
+        The mongodb cursor is read in batches, so memory stays constant whatever the size of the result
+    """
+    try:
+        query_json = _build_query(request.GET)
+    except FilterError as error:
+        return HttpResponseBadRequest(str(error))
+    required_fields_json, sort_fields_list = _build_options(request.GET, default_fields=[])
+    if len(required_fields_json) == 1:
+        # whole documents, without the bookkeeping of the ingestion
+        required_fields_json.update({field: 0 for field in INGESTION_FIELDS})
+    try:
+        limit_docs = int(request.GET['_limit']) if '_limit' in request.GET else None
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+    split = _summary_split()
+    sort_error = _split_sort_error(sort_fields_list, split)
+    if sort_error:
+        return HttpResponseBadRequest(sort_error)
+    main_fields_json, heavy_fields_json, added_key = split_projection(required_fields_json, split)
+    cursor = db['summary'].find(query_json, main_fields_json, batch_size=EXPORT_BATCH_SIZE)
+    if sort_fields_list:
+        cursor = cursor.sort(sort_fields_list).allow_disk_use(True)
+    if limit_docs is not None:
+        cursor = cursor.limit(limit_docs)
+    if heavy_fields_json is not None:
+        cursor = join_split_batches(db[split["companion"]], split, cursor, heavy_fields_json, added_key, EXPORT_BATCH_SIZE)
+    chunks = _ndjson_chunks(cursor)
+    if request.GET.get('_compress') == 'gzip':
+        response = StreamingHttpResponse(_gzip_chunks(chunks), content_type="application/gzip")
+        response["Content-Disposition"] = 'attachment; filename="summary.ndjson.gz"'
+    else:
+        response = StreamingHttpResponse(chunks, content_type="application/x-ndjson")
+    return response
+
+def _batch_ids_and_fields(request):
+    """
+        Returns the material ids and fields of a batch request, from the JSON body of a POST
+        ({"material_ids": [...], "fields": [...]}), a comma separated POST body or the query string
+    """
+    material_ids = request.GET.get('material_ids', '')
+    fields = request.GET.get('_fields')
+    if request.method == "POST":
+        if request.content_type == "application/json":
+            body = json.loads(request.body)
+            if not isinstance(body, dict):
+                raise ValueError('the JSON body must be an object {"material_ids": [...], "fields": [...]}')
+            material_ids = body.get('material_ids', [])
+            fields = body.get('fields', fields)
+        elif 'material_ids' in request.POST:
+            material_ids = request.POST['material_ids']
+            fields = request.POST.get('_fields', fields)
+        else:
+            material_ids = request.body.decode()
+    if isinstance(material_ids, str):
+        material_ids = material_ids.split(',')
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    if not isinstance(material_ids, list) or not all(isinstance(mp_id, str) for mp_id in material_ids):
+        raise ValueError("material_ids must be a list of strings or a comma separated string")
+    if fields is not None and (not isinstance(fields, list) or not all(isinstance(field, str) for field in fields)):
+        raise ValueError("fields must be a list of strings or a comma separated string")
+    # duplicates are fetched once, the order of the request is kept
+    material_ids = list(dict.fromkeys(mp_id.strip() for mp_id in material_ids if mp_id.strip()))
+    return material_ids, fields or ["structure"]
+
+def _batch_chunks(cursor, material_ids, keep_material_id):
+    # {"data": {"<material_id>": {...}, ...}, "missing": [...]}, written while the cursor is read
+    yield b'{"data": {'
+    found = set()
+    lines = []
+    num_bytes = 0
+    for doc in cursor:
+        material_id = doc["material_id"] if keep_material_id else doc.pop("material_id")
+        line = (b"" if not found else b", ") + dumps(material_id) + b": " + dumps(doc)
+        found.add(material_id)
+        lines.append(line)
+        num_bytes += len(line)
+        if num_bytes >= EXPORT_CHUNK_BYTES:
+            yield b"".join(lines)
+            lines = []
+            num_bytes = 0
+    missing = [mp_id for mp_id in material_ids if mp_id not in found]
+    yield b"".join(lines) + b'}, "missing": ' + dumps(missing) + b"}"
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def batch(request):
+    """
+        Returns the documents of up to BATCH_MAX_IDS material ids with a single $in query
+        (and one on the companion collection for split fields), keyed by material id (structure only unless other fields are asked for).
+        The ids that weren't found are listed in "missing"
+    """
+    try:
+        material_ids, fields = _batch_ids_and_fields(request)
+    except (ValueError, AttributeError) as e:
+        return HttpResponseBadRequest(f"Invalid batch request: {e}")
+    if not material_ids:
+        return HttpResponseBadRequest("No material_ids given")
+    if len(material_ids) > BATCH_MAX_IDS:
+        return HttpResponseBadRequest(f"At most {BATCH_MAX_IDS} material_ids per request, got {len(material_ids)}")
+    project_json = {"_id": 0, "material_id": 1}
+    for field in fields:
+        project_json[field] = 1
+    split = _summary_split()
+    project_json, heavy_fields_json, added_key = split_projection(project_json, split)
+    cursor = db['summary'].find({"material_id": {"$in": material_ids}}, project_json, batch_size=EXPORT_BATCH_SIZE)
+    if heavy_fields_json is not None:
+        cursor = join_split_batches(db[split["companion"]], split, cursor, heavy_fields_json, added_key, EXPORT_BATCH_SIZE)
+    return StreamingHttpResponse(_batch_chunks(cursor, material_ids, "material_id" in fields),
+                                 content_type="application/json")
+
+def bundle(request, col, bundle_id):
+    """
+        A band structure or DOS bundle (by material_id or task_id) with its arrays decoded,
+        as JSON or, with format=npz, as an .npz file of the arrays (named by their path)
+        plus the rest of the document in __meta__. _fields limits the fields read
+    """
+    if col not in BUNDLE_COLLECTIONS:
+        return HttpResponseNotFound(f"No bundle collection {col}")
+    response_format = request.GET.get('format', 'json')
+    if response_format not in ('json', 'npz'):
+        return HttpResponseBadRequest("format must be json or npz")
+    projection = None
+    if '_fields' in request.GET:
+        projection = {field: 1 for field in request.GET['_fields'].split(',')}
+    timer = StageTimer()
+    with timer.stage("mongo"):
+        doc = bundle_db[col].find_one({"$or": [{key: bundle_id} for key in BUNDLE_KEYS]}, projection)
+        if doc is None:
+            return HttpResponseNotFound(f"No {col} bundle {bundle_id}")
+        paths = chunked_paths(doc)
+        chunks = read_chunks(bundle_db[chunks_name(col)], doc["_id"], paths) if paths else None
+    with timer.stage("decode"):
+        doc.pop("_id")
+        try:
+            decoded = decode_document(doc, chunks)
+        except ImportError as error:
+            return HttpResponse(f"Bundle {bundle_id} can't be decoded here: {error}", status=503)
+    with timer.stage("serialize"):
+        if response_format == 'npz':
+            http_response = HttpResponse(to_npz(decoded), content_type="application/octet-stream")
+            http_response["Content-Disposition"] = f'attachment; filename="{col}-{bundle_id}.npz"'
+        else:
+            http_response = encoded_response(request, dumps(decoded))
+    record("bundle", col, timer)
+    http_response["Server-Timing"] = timer.server_timing()
+    return http_response
+
+def detail(request, materialID_num):
+    """
+        Symmetry data, Wyckoff sites, crystal toolkit scene and description of a material,
+        read from the precomputed summary_detail collection. A material without a stored
+        payload is computed on demand and written back
+    """
+    timer = StageTimer()
+    materialID = f"mp-{materialID_num}"
+    etag = detail_etag(current_generation(db), "detail", materialID)
+    matched_tag = if_none_match(request, etag)
+    if matched_tag:
+        return not_modified(matched_tag)
+    with timer.stage("mongo"):
+        response = find_detail(db, materialID)
+    if response is None:
+        with timer.stage("compute"):
+            # as in compute_detail_docs, a material that fails doesn't fail the server
+            try:
+                response = compute_and_store_detail(db, materialID)
+            except (ImportError, pymongo.errors.PyMongoError) as error:
+                detail_logger.error("detail of %s can't be computed: %s", materialID, error)
+                return HttpResponse(f"Detail of {materialID} is not precomputed and can't be computed here: {error}", status=503)
+            except Exception as error:
+                detail_logger.exception("detail of %s failed to compute", materialID)
+                return HttpResponseNotFound(f"No detail for {materialID}: {type(error).__name__}: {error}")
+        if response is None:
+            return HttpResponseNotFound(f"No material {materialID}")
+    with timer.stage("serialize"):
+        http_response = cache_control(encoded_response(request, dumps({"data": response}), etag=etag))
+    record("detail", "material_id", timer)
+    http_response["Server-Timing"] = timer.server_timing()
+    return http_response
 
 def detail_dash(requst, materialID_str):
+    timer = StageTimer()
+    # the structure only changes with an ingestion, a client with the etag of this generation is up to date
+    etag = detail_etag(current_generation(db), "detail_dash", materialID_str)
+    matched_tag = if_none_match(requst, etag)
+    if matched_tag:
+        return not_modified(matched_tag)
     collection = db['summary']
-    result = collection.find_one({"material_id": materialID_str}, {"_id": 0, "structure": 1})
-    return HttpResponse(json.dumps(result))
+    split = _summary_split()
+    projection, heavy_projection, added_key = split_projection({"_id": 0, "structure": 1}, split)
+    with timer.stage("mongo"):
+        result = collection.find_one({"material_id": materialID_str}, projection)
+        if result is not None and heavy_projection is not None:
+            join_split(db[split["companion"]], split, [result], heavy_projection, added_key)
+    with timer.stage("serialize"):
+        if result is None:
+            http_response = encoded_response(requst, dumps(result))
+        else:
+            http_response = cache_control(encoded_response(requst, dumps(result), etag=etag))
+    record("detail_dash", "material_id", timer)
+    http_response["Server-Timing"] = timer.server_timing()
+    return http_response
+
+def cache_stats(request):
+    return JsonResponse({
+        "generation": current_generation(db),
+        "count_cache": count_cache.stats(),
+        "result_cache": result_cache.stats(),
+    })
+
+def metrics(request):
+    return HttpResponse(exposition(), content_type="text/plain; version=0.0.4")
+
+def slow_queries(request):
+    return JsonResponse({"threshold_ms": SLOW_QUERY_MS, "queries": slow_query_log.latest()})